@@ -256,6 +256,27 @@ class Config(object):
             'record-actions': False,
             # Imagecache save on exit: 'never', 'ask' or 'always'
             'imagecache-save-on-exit': 'ask',
+            # Memory budget (in MB) for in-memory snapshots. Least
+            # recently used snapshots are spilled to disk. 0 means no limit.
+            'imagecache-memory-limit': 64,
+            # Number of worker threads for thread-safe actions. 0
+            # means that they are executed like other actions.
+            'action-workers': 2,
+            # Default timeout (in s) for actions executed by workers
+            'action-timeout': 30,
+            # Number of events kept in the event history, when
+            # record-actions is set. 0 means no limit.
+            'event-history-size': 10000,
+            # Load annotations lazily: their DOM elements are only
+            # built when they are modified.
+            'package-lazy-load': True,
+            # Maximum number of undoable operations per package. 0
+            # means no limit.
+            'undo-depth': 1000,
+            # Memory (in MB) used by the undo history of each
+            # package. Older operations are stored in a log next to
+            # the package file. 0 means no limit.
+            'undo-memory-limit': 8,
             'quicksearch-ignore-case': True,
             # quicksearch sources. If [], it is all package's annotations.
             # Else it is a list of TALES expression applied to the current package
@@ -268,6 +289,9 @@ class Config(object):
             'package-auto-save-interval': 5 * 60 * 1000,
             # slave player automatic synchronization delay. 0 to disable.
             'slave-player-sync-delay': 3000,
+            # Maximum delay (in ms) between two position queries to
+            # the player. In between, the position is interpolated.
+            'player-sync-interval': 1000,
             # Interface language. '' means system default.
             'language': '',
             'save-default-workspace': 'always',
@@ -326,6 +350,8 @@ class Config(object):
             'snapshot': True,
             'caption': True,
             'snapshot-width': 160,
+            # Number of parallel snapshotter pipelines
+            'snapshotter-workers': 1,
             'dvd-device': '/dev/dvd',
             'fullscreen-timestamp': False,
             # Name of audio device for gstrecorder
@@ -342,6 +368,10 @@ class Config(object):
             'displaymode': 'raw',
             # engine: simple (for SimpleHTTPServer) or cherrypy (for CherryPy)
             'engine': 'simple',
+            # Number of rendered responses kept in cache
+            'response-cache-size': 200,
+            # Lifetime (in seconds) of initialized snapshots in browser caches
+            'snapshot-max-age': 3600,
             }
 
         # Global context options
@@ -630,12 +660,18 @@ class Config(object):
             self.content_handlers.append(handler)
         return True
 
-    def register_global_method(self, method, name=None):
+    def register_global_method(self, method, name=None, pure=False):
         """Register a global method.
+
+        @param pure: the method result only depends on its target and
+        on the package data, so that the webserver can cache the
+        responses using it
+        @type pure: boolean
         """
         # FIXME: check signature ?
         if name is None:
             name=method.func_name
+        getattr(method, 'im_func', method).pure=pure
         self.global_methods[name]=method
         return True
 
@@ -40,7 +40,6 @@ import StringIO
 import gobject
 import shlex
 import itertools
-import operator
 
 import advene.core.config as config
 
@@ -50,6 +49,10 @@ import advene.core.plugin
 from advene.core.mediacontrol import PlayerFactory
 from advene.core.imagecache import ImageCache
 import advene.core.idgenerator
+from advene.core.packageloader import PackageLoader
+from advene.core.positionclock import PositionClock
+from advene.util.intervaltree import AnnotationIndex
+from advene.util.textindex import TextIndex
 
 from advene.rules.elements import RuleSet, RegisteredAction, SimpleQuery, Quicksearch
 import advene.rules.ecaengine
@@ -64,7 +67,7 @@ from advene.model.fragment import MillisecondFragment
 from advene.model.view import View
 from advene.model.query import Query
 from advene.model.util.defaultdict import DefaultDict
-from advene.model.tal.context import AdveneTalesException
+from advene.model.tal.context import AdveneTalesException, template_cache
 from advene.util.website_export import WebsiteExporter
 
 import advene.model.tal.context
@@ -133,14 +136,17 @@ class AdveneController(object):
     On loading, we append the following attributes to package:
       - L{imagecache} : the associated imagecache
       - L{_idgenerator} : the associated idgenerator
+      - L{_annotation_index} : the interval index of its annotations
+      - L{_text_index} : the quicksearch index of its annotations
       - L{_modified} : boolean
+      - L{_generation} : modification generation (see L{update_generation})
+      - L{_modification_time} : time of the last modification
 
     @ivar active_annotations: the currently active annotations.
     @type active_annotations: list
-    @ivar future_begins: the annotations that should be activated next (sorted)
-    @type future_begins: list
-    @ivar future_ends: the annotations that should be desactivated next (sorted)
-    @type future_ends: list
+    @ivar annotation_cursor: the position up to which annotation
+    boundaries have been notified (None after a seek)
+    @type annotation_cursor: int
 
     @ivar last_position: a cache to check whether an update is necessary
     @type last_position: int
@@ -180,6 +186,11 @@ class AdveneController(object):
         self.aliases = {}
         self.current_alias = None
 
+        # Method table for build_context
+        self._context_methods = None
+        # Package modification generations
+        self._generation_counter = itertools.count(1)
+
         # Unknown arguments (neither a package nor a video file)
         self.unknown_args = []
 
@@ -192,9 +203,14 @@ class AdveneController(object):
 
         # List of active annotations
         self.active_annotations = []
-        self.future_begins = None
-        self.future_ends = None
+        self.annotation_cursor = None
         self.last_position = -1
+        # Interpolated player position
+        self.position_clock = PositionClock(config.data.preferences['player-sync-interval'])
+        # source-id of the timeout notifying the next annotation
+        # boundary, and the (boundary, clock sample) it was computed for
+        self.boundary_timeout = None
+        self.boundary_key = None
 
         # List of (time, action) tuples, sorted along time
         # When the player or usertime reaches 'time', execute the action.
@@ -244,7 +260,13 @@ class AdveneController(object):
         self.event_handler = advene.rules.ecaengine.ECAEngine (controller=self)
         self.modifying_events = self.event_handler.catalog.modifying_events
         self.event_queue = []
+        # Actions can be queued from any thread
+        self.event_queue_lock = threading.Lock()
+        # Pending background package loader
+        self.package_loader = None
         self.tracers=[]
+        # Thread running the application mainloop
+        self.main_thread = threading.currentThread()
 
         # Load default actions
         advene.rules.actions.register(self)
@@ -327,9 +349,10 @@ class AdveneController(object):
 
         The method will be called in the application mainloop, i.e. in
         the main application thread. This can prevent problems when
-        running in a GUI environment.
+        running in a GUI environment. It can be called from any thread.
         """
-        self.event_queue.append( (method, args, kw) )
+        with self.event_queue_lock:
+            self.event_queue.append( (method, args, kw) )
         return True
 
     def queue_registered_action(self, ra, parameters):
@@ -347,8 +370,9 @@ class AdveneController(object):
         events can generate new notification.
         """
         # Dump the pending events into a local queue
-        ev=self.event_queue[:]
-        self.event_queue=[]
+        with self.event_queue_lock:
+            ev=self.event_queue
+            self.event_queue=[]
 
         # Now we can process the events
         for (method, args, kw) in ev:
@@ -398,10 +422,10 @@ class AdveneController(object):
         """
         config.data.register_content_handler(handler)
 
-    def register_global_method(self, method, name=None):
+    def register_global_method(self, method, name=None, pure=False):
         """Register a global method.
         """
-        config.data.register_global_method(method, name)
+        config.data.register_global_method(method, name, pure)
 
     def register_action(self, action):
         """Register an action.
@@ -519,15 +543,15 @@ class AdveneController(object):
                     # There is a least one other annotation of the
                     # same type which is also active. We can just wait for its end.
                     return True
-                # future_begins holds a sorted list of (annotation, begin, end)
+                # l holds a sorted list of (annotation, begin, end)
                 if self.restricted_annotations:
                     l=[(an, an.fragment.begin, an.fragment.end)
                        for an in self.restricted_annotations
                        if an.fragment.begin > a.fragment.end ]
                 else:
-                    l=[an
-                       for an in self.future_begins
-                       if an[0].type == t ]
+                    l=[(an, an.fragment.begin, an.fragment.end)
+                       for an in self.annotation_index.starting(a.fragment.end + 1, sys.maxint)
+                       if an.type == t ]
                 if l and l[0][1] > a.fragment.end:
                     self.queue_action(self.update_status, 'set', l[0][1])
                 else:
@@ -615,11 +639,31 @@ class AdveneController(object):
         exceptions=[ w[1:] for w in words if w.startswith('-') ]
         normal=[ w for w in words if not w.startswith('+') and not w.startswith('-') ]
 
+        def fallback(e):
+            """Check elements which are not indexed.
+            """
+            data=data_func(e)
+            for w in mandatory:
+                if normalize_case(w) not in data:
+                    return False
+            for w in exceptions:
+                if normalize_case(w) in data:
+                    return False
+            if not normal:
+                return True
+            for w in normal:
+                if normalize_case(w) in data:
+                    return True
+            return False
+
+        index=p._text_index.check()
         result=[]
 
         for source in sources:
+            tags=False
             if source == 'tags':
                 sourcedata=itertools.chain( p.annotations, p.relations )
+                tags=True
                 if case_sensitive:
                     data_func=lambda e: e.tags
                 else:
@@ -638,23 +682,9 @@ class AdveneController(object):
                 c=self.build_context()
                 sourcedata=c.evaluateValue(source)
 
-            for w in mandatory:
-                w=normalize_case(w)
-                sourcedata=[ e for e in sourcedata if w in data_func(e) ]
-            for w in exceptions:
-                w=normalize_case(w)
-                sourcedata=[ e for e in sourcedata if w not in data_func(e) ]
-            if not normal:
-                # No "normal" search terms. Return the result.
-                result.extend(sourcedata)
-            else:
-                normal=[ normalize_case(w) for w in normal ]
-                for e in sourcedata:
-                    data=data_func(e)
-                    for w in normal:
-                        if w in data:
-                            result.append(e)
-                            break
+            result.extend(index.search(sourcedata, mandatory, exceptions, normal,
+                                       tags=tags, case_sensitive=case_sensitive,
+                                       fallback=fallback))
         return result
 
     def evaluate_query(self, query=None, context=None, expr=None):
@@ -692,6 +722,8 @@ class AdveneController(object):
             # Parse quicksearch query
             qexpr=Quicksearch(controller=self)
             qexpr.from_xml(query.content.stream)
+            # The search options come from the configuration
+            context.mark_volatile('quicksearch')
             if expr is not None:
                 # Override the sources... Is it a good idea ?
                 qexpr.sources=[ expr ]
@@ -700,12 +732,20 @@ class AdveneController(object):
             raise Exception("Unsupported query type for %s" % query.id)
         return result, qexpr
 
+    @property
+    def annotation_index(self):
+        """Return the interval index of the current package annotations.
+
+        @rtype: advene.util.intervaltree.AnnotationIndex
+        """
+        return self.package._annotation_index.check()
+
     @property
     def typed_active(self):
         """Return a DefaultDict of active annotations grouped by type id.
         """
         d=DefaultDict(default=False)
-        for a in self.active_annotations:
+        for a in self.annotation_index.at(self.player.current_position_value):
             d.setdefault(a.type.id, []).append(a)
         return d
 
@@ -724,14 +764,26 @@ class AdveneController(object):
                 u'config': config.data.web,
                 u'aliases': self.aliases,
                 u'controller': self,
-                })
+                }, methods=self.get_context_methods())
         c.addGlobal(u'package', self.package)
         c.addGlobal(u'packages', self.packages)
         c.addGlobal(u'player', self.player)
-        for name, method in config.data.global_methods.iteritems():
-            c.addMethod(name, method)
         return c
 
+    def get_context_methods(self):
+        """Return the method table used by build_context.
+
+        It holds the default TALES methods and the registered global
+        methods. It is computed once, and updated only when the
+        global methods are modified.
+        """
+        key=tuple(config.data.global_methods.iteritems())
+        if self._context_methods is None or self._context_methods[0] != key:
+            methods=dict(advene.model.tal.context.AdveneContext.defaultMethodTable())
+            methods.update(config.data.global_methods)
+            self._context_methods=(key, methods)
+        return self._context_methods[1]
+
     def busy_port_info(self):
         """Display the processes using the webserver port.
         """
@@ -942,12 +994,34 @@ class AdveneController(object):
             el=kw[el_name]
             p=el.ownerPackage
             p._modified = True
+            self.update_generation(p)
             if event_name.endswith('Delete'):
                 # We removed an element, so remove its id from the _idgenerator set
                 p._idgenerator.remove(el.id)
             elif event_name.endswith('Create'):
                 # We created an element. Make sure its id is registered in the _idgenerator
                 p._idgenerator.add(el.id)
+            if el_name == 'annotation':
+                # Keep the annotation interval index up-to-date
+                if event_name == 'AnnotationDelete':
+                    p._annotation_index.remove_annotation(el)
+                    if el in self.active_annotations:
+                        self.active_annotations.remove(el)
+                else:
+                    p._annotation_index.update_annotation(el)
+                # Keep the quicksearch index up-to-date
+                if event_name == 'AnnotationDelete':
+                    p._text_index.remove_annotation(el)
+                else:
+                    p._text_index.update_annotation(el)
+            elif el_name == 'relation':
+                if event_name == 'RelationDelete':
+                    p._text_index.remove_element(el)
+                else:
+                    p._text_index.update_element(el)
+            elif el_name == 'view' and event_name != 'ViewCreate':
+                # Discard the compiled templates of the view
+                template_cache.invalidate(el.getUri(absolute=True))
 
         if 'immediate' in kw:
             self.event_handler.notify(event_name, *param, **kw)
@@ -955,6 +1029,17 @@ class AdveneController(object):
             self.queue_action(self.event_handler.notify, event_name, *param, **kw)
         return
 
+    def update_generation(self, p):
+        """Update the modification generation of the package p.
+
+        The generation is a number which is unique among all the
+        packages loaded by the controller, and which changes on each
+        modification of the package. It is used to validate cached
+        data, such as webserver responses.
+        """
+        p._generation = self._generation_counter.next()
+        p._modification_time = time.time()
+
     def set_volume(self, v):
         """Set the audio volume.
         """
@@ -1188,13 +1273,17 @@ class AdveneController(object):
             # FIXME: check for the existence of the file
             pass
         else:
-            mediafile=self.locate_mediafile(mediafile)
+            mediafile=self.locate_mediafile(mediafile, package)
 
         return mediafile
 
-    def locate_mediafile(self, mediafile):
+    def locate_mediafile(self, mediafile, package=None):
         """Locate the given media file.
+
+        @param package: the package used to resolve the '_' (package dir) moviepath item
         """
+        if package is None:
+            package=self.package
         if not os.path.exists(mediafile.encode(sys.getfilesystemencoding(), 'ignore')):
             # It is a file. It should exist. Else check for a similar
             # one in moviepath
@@ -1205,7 +1294,7 @@ class AdveneController(object):
             for d in config.data.path['moviepath'].split(os.pathsep):
                 if d == '_':
                   # Get package dirname
-                    d=self.package.uri
+                    d=package.uri
                     # And convert it to a pathname (for Windows)
                     if d.startswith('file:'):
                         d=d.replace('file://', '')
@@ -1250,6 +1339,7 @@ class AdveneController(object):
         p.playlist_clear()
         if uri is not None:
             p.playlist_add_item (uri)
+        self.position_clock.invalidate()
         # Reset cached_duration so that it will be updated on play
         self.pending_duration_update = True
         self.notify("MediaChange", uri=uri)
@@ -1540,6 +1630,7 @@ class AdveneController(object):
 
         # Start the new one
         self.player=p()
+        self.position_clock.invalidate()
         if not 'record' in p.player_capabilities:
             # Store the selected player if it is not a recorder.
             config.data.player['plugin']=p.player_id
@@ -1551,6 +1642,7 @@ class AdveneController(object):
     def restart_player (self):
         """Restart the media player."""
         self.player.restart_player ()
+        self.position_clock.invalidate()
         mediafile = self.get_default_media()
         if mediafile != "":
             self.set_media(mediafile)
@@ -1610,7 +1702,7 @@ class AdveneController(object):
                     color=self.get_element_color(container)
         return color
 
-    def load_package (self, uri=None, alias=None, activate=True):
+    def load_package (self, uri=None, alias=None, activate=True, background=False):
         """Load a package.
 
         This method is esp. used as a callback for webserver. If called
@@ -1621,7 +1713,22 @@ class AdveneController(object):
         @type uri: string
         @param alias: the name of the package (ignored in the GUI, always "advene")
         @type alias: string
-        """
+        @param background: load the package in a separate thread
+        @type background: boolean
+        @return: the PackageLoader if background is True
+        """
+        # A pending background loading would install its package
+        # after this one
+        if self.package_loader is not None:
+            self.package_loader.cancel()
+            self.package_loader=None
+
+        if background and uri and not uri.lower().endswith('.apl'):
+            loader=PackageLoader(self, uri, alias, activate)
+            self.package_loader=loader
+            loader.start()
+            return loader
+
         if uri is None or uri == "":
             try:
                 self.package = Package (uri="new_pkg",
@@ -1660,20 +1767,55 @@ class AdveneController(object):
             return
         else:
             t=time.time()
-            p = Package(uri=uri)
+            p = self.read_package(uri)
             dur=time.time()-t
             self.log("Loaded package in %f seconds" % dur)
-            # Check if the imported package was found. Else it will
-            # fail when accessing elements...
-            for i in p.imports:
-                try:
-                    imp=i.package
-                except Exception, e:
-                    raise Exception(_("Cannot read the imported package %(uri)s: %(error)s") % {
-                            'uri': i.uri,
-                            'error': unicode(e)})
             self.package=p
 
+        self.install_package(self.package, uri, alias, activate)
+
+    def read_package(self, uri):
+        """Read the package from the given URI.
+
+        It checks that the imported packages can be read. It does not
+        modify the controller state, so that it can be used from a
+        PackageLoader thread.
+
+        @param uri: the URI of the package
+        @type uri: string
+        @return: the package
+        """
+        p = Package(uri=uri)
+        # Check if the imported package was found. Else it will
+        # fail when accessing elements...
+        for i in p.imports:
+            try:
+                imp=i.package
+            except Exception, e:
+                raise Exception(_("Cannot read the imported package %(uri)s: %(error)s") % {
+                        'uri': i.uri,
+                        'error': unicode(e)})
+        return p
+
+    def init_package_indexes(self, p):
+        """Build the id generator and the annotation indexes of the package.
+
+        It can be called from a PackageLoader thread.
+        """
+        p._idgenerator = advene.core.idgenerator.Generator(p)
+        p._annotation_index = AnnotationIndex(p)
+        p._text_index = TextIndex(p)
+
+    def install_package(self, p, uri=None, alias=None, activate=True):
+        """Register a loaded package.
+
+        @param p: the package
+        @param uri: the URI of the package
+        @type uri: string
+        @param alias: the name of the package
+        @type alias: string
+        """
+        self.package = p
         if alias is None:
             # Autogenerate the alias
             if uri:
@@ -1685,9 +1827,14 @@ class AdveneController(object):
         # letting the user specify a valid alias.
         alias = re.sub('[^a-zA-Z0-9_]', '_', alias)
 
-        self.package.imagecache=ImageCache()
-        self.package._idgenerator = advene.core.idgenerator.Generator(self.package)
+        # The indexes and the imagecache may have been prepared by a
+        # PackageLoader
+        if getattr(self.package, 'imagecache', None) is None:
+            self.package.imagecache=ImageCache()
+        if getattr(self.package, '_text_index', None) is None:
+            self.init_package_indexes(self.package)
         self.package._modified = False
+        self.update_generation(self.package)
 
         # State dictionary
         self.package.state=DefaultDict(default=0)
@@ -1900,6 +2047,8 @@ class AdveneController(object):
 
         p.save(name=name)
         p._modified = False
+        # The package URI may have changed
+        self.update_generation(p)
 
         self.notify ("PackageSave", package=p)
         if old_uri != name:
@@ -1933,8 +2082,13 @@ class AdveneController(object):
             else:
                 at._fieldnames=set()
 
-        p.imagecache.clear ()
         mediafile = self.get_default_media()
+        if getattr(p, '_preloaded_media', None) == mediafile:
+            # The imagecache was loaded by the PackageLoader
+            p._preloaded_media = None
+            mediafile = None
+        else:
+            p.imagecache.clear ()
         if mediafile is not None and mediafile != "":
             # Load the imagecache
             id_ = helper.mediafile2id (mediafile)
@@ -2067,7 +2221,12 @@ class AdveneController(object):
         @type msg: string
         """
         if self.gui:
-            self.gui.log(msg, level)
+            if threading.currentThread() is not self.main_thread:
+                # Action worker or background thread: the GUI must be
+                # updated from the main loop.
+                self.queue_action(self.gui.log, msg, level)
+            else:
+                self.gui.log(msg, level)
         else:
             print unicode(msg).encode('utf-8')
 
@@ -2101,7 +2260,14 @@ class AdveneController(object):
                 for l in diff.compare(start, end):
                     print l
                 print "-----------"
+                for l in self.event_handler.dump_statistics():
+                    print l
+                print "-----------"
+                for l in template_cache.dump_statistics():
+                    print l
+                print "-----------"
             self.event_handler.reset_queue()
+            self.event_handler.action_pool.stop()
             self.event_handler.clear_state()
             self.event_handler.update_rulesets()
 
@@ -2110,6 +2276,8 @@ class AdveneController(object):
 
             # Cleanup the ZipPackage directories
             ZipPackage.cleanup()
+            # and the snapshots spilled by the imagecaches
+            ImageCache.cleanup()
 
             # Terminate the web server
             try:
@@ -2212,6 +2380,8 @@ class AdveneController(object):
             # devise a better feedback than a simple print
             import traceback
             self.log(_("Raised exception in update_status: %s") % traceback.format_exc())
+        # Query the player position on the next update
+        self.position_clock.invalidate()
         en=self.status2eventname.get(status, None)
         if en and notify:
             self.notify (en,
@@ -2226,22 +2396,45 @@ class AdveneController(object):
         This method, regularly called, restarts the player in case of
         a communication failure.
 
-        It updates the slider range if necessary.
+        The player is only queried when the position clock needs to
+        be synchronized (after a status change, or every
+        player-sync-interval ms). Otherwise, the position is
+        interpolated.
 
         @return: the current position in ms
         @rtype: a long
         """
+        p = self.player
+        clock = self.position_clock
+        if not clock.needs_sync():
+            p.current_position_value = clock.get_position()
+            if hasattr(p, 'update_overlays'):
+                p.update_overlays(p.current_position_value)
+            return p.current_position_value
+
         try:
-            self.player.position_update ()
-        except self.player.InternalException, e:
+            p.position_update ()
+        except p.InternalException, e:
             # The server is down. Restart it.
             print "Restarting player...", str(e)
             self.player_restarted += 1
             if self.player_restarted > 5:
                 raise Exception (_("Unable to start the player."))
             self.restart_player ()
+            return self.player.current_position_value
 
-        return self.player.current_position_value
+        try:
+            rate = p.get_rate()
+        except AttributeError:
+            rate = 1.0
+        clock.sync(p.current_position_value,
+                   p.status == p.PlayingStatus,
+                   rate,
+                   p.stream_duration)
+        if clock.running:
+            # Keep the position monotonic in case of small backward drift
+            p.current_position_value = clock.get_position()
+        return p.current_position_value
 
     def player_scrub(self, pos):
         """Scrub to a given position.
@@ -2273,57 +2466,98 @@ class AdveneController(object):
 
         return True
 
-    def generate_sorted_lists (self, position):
-        """Return two sorted lists and a list of active annotations valid for a given position.
+    def reset_annotation_lists (self):
+        """Reset the active annotations list.
 
-        (i.e. all annotations beginning or ending after the
-        position). The lists are sorted according to the begin and end
-        position respectively.
+        The active annotations will be recomputed from the annotation
+        index on the next update.
+        """
+        self.annotation_cursor = None
+        self.active_annotations = []
 
-        The elements of the begin/end lists are (annotation, begin,
-        end). The elements of active_annotations are annotations.
+    def update_annotation_boundaries (self, pos):
+        """Notify the annotation boundaries crossed since the last update.
+
+        The annotation_cursor holds the position up to which
+        boundaries have already been notified. After a seek (cursor is
+        None), the active annotations are initialized from the
+        annotation index.
+
+        @param pos: the current position
+        @type pos: int
+        """
+        index=self.annotation_index
+        if self.annotation_cursor is None:
+            # Substract 20ms to the current position, so that in case
+            # the update is triggered due to selecting an annotation,
+            # its AnnotationBegin gets correctly notified.
+            self.annotation_cursor = pos - 20
+            self.active_annotations = [ a for a in index.at(self.annotation_cursor)
+                                        if a.fragment.begin < self.annotation_cursor ]
+        if pos < self.annotation_cursor:
+            return
 
-        The update_display method only has to check the first element
-        of each list. If there is a match, it should trigger the
-        events and pop the element.
+        for a in index.starting(self.annotation_cursor, pos + 1):
+            # Ignore if we were after the annotation end
+            if a.fragment.end > pos:
+                self.notify ("AnnotationBegin",
+                             annotation=a,
+                             immediate=True)
+                self.active_annotations.append(a)
 
-        If there is a seek operation, we should regenerate the lists.
+        for a in index.ending(self.annotation_cursor, pos + 1):
+            try:
+                self.active_annotations.remove(a)
+            except ValueError:
+                pass
+            self.notify ("AnnotationEnd",
+                         annotation=a,
+                         immediate=True)
 
-        @param position: the current position
-        @type position: int
-        @return: a tuple of three lists containing triplets or simple annotations
-        @rtype: tuple
-        """
-        # Substract 20ms to the current position, so that in case the
-        # generate_sorted_lists is triggered due to selecting an
-        # annotation, the annotation is put in future_begins and its
-        # AnnotatioBegin gets correctly notified.
-        position -= 20
+        self.annotation_cursor = pos + 1
 
-        future_begins = []
-        future_ends = []
-        active = []
+    def schedule_boundary_update (self, pos):
+        """Schedule an update at the next annotation boundary.
 
-        for a in self.package.annotations:
-            if a.fragment.begin >= position:
-                future_begins.append( (a, a.fragment.begin, a.fragment.end) )
-                future_ends.append( (a, a.fragment.begin, a.fragment.end) )
-            elif a.fragment.end >= position:
-                future_ends.append( (a, a.fragment.begin, a.fragment.end) )
-                active.append(a)
-        future_begins.sort(key=operator.itemgetter(1))
-        future_ends.sort(key=operator.itemgetter(2))
+        While playing, the next annotation begin or end (or videotime
+        bookmark) is notified at its exact time, computed from the
+        position clock, instead of at the next regular update.
 
-        #print "Position: %s" % helper.format_time(position)
-        #print "Begins: %s\nEnds: %s" % ([ a[0].id for a in future_begins[:4] ],
-        #                                [ a[0].id for a in future_ends[:4] ])
-        return future_begins, future_ends, active
+        @param pos: the current position
+        @type pos: int
+        """
+        p = self.player
+        clock = self.position_clock
+        t = None
+        if p.status == p.PlayingStatus and self.package is not None:
+            t = self.annotation_index.next_boundary(pos + 1)
+            if self.videotime_bookmarks:
+                b = self.videotime_bookmarks[0][0]
+                if b and (t is None or b < t):
+                    t = b
+        key = (t, clock.wallclock)
+        if key == self.boundary_key and self.boundary_timeout is not None:
+            return
+        if self.boundary_timeout is not None:
+            gobject.source_remove(self.boundary_timeout)
+            self.boundary_timeout = None
+        self.boundary_key = None
+        if t is None:
+            return
+        delay = clock.delay(t)
+        if delay is None or delay > clock.sync_interval:
+            # The clock may be resynchronized before. Let a
+            # regular update schedule it.
+            return
 
-    def reset_annotation_lists (self):
-        """Reset the future annotations lists."""
-        self.future_begins = None
-        self.future_ends = None
-        self.active_annotations = []
+        def boundary_update():
+            self.boundary_timeout = None
+            self.boundary_key = None
+            self.update()
+            return False
+
+        self.boundary_key = key
+        self.boundary_timeout = gobject.timeout_add(delay, boundary_update)
 
     def update (self):
         """Update the information.
@@ -2346,8 +2580,7 @@ class AdveneController(object):
         if pos < self.last_position or pos > self.last_position + 1000:
             # We did a seek compared to the last time (backward, or
             # more than 1s forward), so we invalidate the
-            # future_begins and future_ends lists as well as the
-            # active_annotations
+            # annotation cursor as well as the active_annotations
             self.reset_annotation_lists()
 
         self.last_position = pos
@@ -2373,43 +2606,9 @@ class AdveneController(object):
                 else:
                     t = 0
 
-        if self.future_begins is None or self.future_ends is None:
-            self.future_begins, self.future_ends, self.active_annotations = self.generate_sorted_lists(pos)
-            #print "New lists", [a.id for a in self.active_annotations], [t[0].id for t in self.future_begins ]
-
-        if self.future_begins and (p.status == p.PlayingStatus or p.status == p.PauseStatus):
-            a, b, e = self.future_begins[0]
-            #print "Future begin", a.id, b, pos
-            while b <= pos:
-                # Ignore if we were after the annotation end
-                self.future_begins.pop(0)
-                if e > pos:
-                    #print "AnnotationBegin", a.id, e, pos
-                    self.notify ("AnnotationBegin",
-                                 annotation=a,
-                                 immediate=True)
-                    self.active_annotations.append(a)
-                if self.future_begins:
-                    a, b, e = self.future_begins[0]
-                else:
-                    break
-
-        if self.future_ends and (p.status == p.PlayingStatus or p.status == p.PauseStatus):
-            a, b, e = self.future_ends[0]
-            while e <= pos:
-                #print "Comparing %d < %d for %s" % (e, pos, a.content.data)
-                try:
-                    self.active_annotations.remove(a)
-                except ValueError:
-                    pass
-                self.future_ends.pop(0)
-                self.notify ("AnnotationEnd",
-                             annotation=a,
-                             immediate=True)
-                if self.future_ends:
-                    a, b, e = self.future_ends[0]
-                else:
-                    break
+        if p.status == p.PlayingStatus or p.status == p.PauseStatus:
+            self.update_annotation_boundaries(pos)
+        self.schedule_boundary_update(pos)
 
         if p.stream_duration > self.cached_duration + 2000:
             # Something wrong here. Can be a live stream, or a unknown
@@ -48,7 +48,8 @@ class Generator:
 
     def __init__(self, package=None):
         self.last_used={}
-        self.existing=[]
+        self.existing=set()
+        self.package=package
         for k in self.prefix.keys():
             self.last_used[k]=0
         if package is not None:
@@ -57,20 +58,19 @@ class Generator:
     def exists(self, id_):
         """Check if an id already exists.
         """
-        return id_ in self.existing
+        return (id_ in self.existing
+                or (self.package is not None
+                    and self.package.get_element_by_id(id_) is not None))
 
     def add(self, id_):
         """Add a new known id.
         """
-        self.existing.append(id_)
+        self.existing.add(id_)
 
     def remove(self, id_):
         """Remove an id from the existing set.
         """
-        try:
-            self.existing.remove(id_)
-        except ValueError:
-            pass
+        self.existing.discard(id_)
 
     def init(self, package):
         """Initialize the indexes for the given package."""
@@ -86,7 +86,7 @@ class Generator:
                   package.annotationTypes, package.relationTypes,
                   package.views, package.queries):
             for i in l.ids():
-                self.existing.append(i)
+                self.existing.add(i)
                 m=re_id.match(i)
                 if m:
                     n=long(m.group(2))
@@ -107,13 +107,21 @@ class Generator:
         #self.existing.append(id_)
         return id_
 
+    def get_ids(self, elementtype, count):
+        """Return a list of count not-yet used ids.
+        """
+        prefix=self.prefix[elementtype]
+        index=self.last_used[prefix]
+        self.last_used[prefix]=index + count
+        return [ prefix + str(i) for i in xrange(index + 1, index + count + 1) ]
+
     def new_from_title(self, title):
         """Generate a new (title, identifier) from a given title.
         """
         root=helper.title2id(title)
         index=1
         i="%s%d" % (root, index)
-        while i in self.existing:
+        while self.exists(i):
             index += 1
             i="%s%d" % (root, index)
         if index != 1:
@@ -21,10 +21,16 @@ Imagecache module for advene
 """
 
 import advene.core.config as config
-import operator
 
+import bisect
+import mmap
 import os
 import re
+import shutil
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
 
 class CachedString:
     """String cached in a file.
@@ -50,6 +56,359 @@ class CachedString:
     def __repr__(self):
         return "Cached content from " + self._filename
 
+class PackedString:
+    """String stored in a PackedSnapshotStore.
+
+    The data is read from the memory-mapped store file. The buffer()
+    method gives a zero-copy access to it. The buffer stays valid
+    when the store is remapped, but not after it is closed or
+    compacted: use str() to get a copy.
+    """
+    def __init__(self, store, timestamp, offset, length):
+        self._store=store
+        self.timestamp=timestamp
+        self.offset=offset
+        self.length=length
+        self.contenttype='image/png'
+
+    def buffer(self):
+        return self._store.read(self.offset, self.length)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self._store.read_string(self.offset, self.length)
+
+    def __repr__(self):
+        return "Packed content from %s (%d)" % (self._store.directory, self.timestamp)
+
+class PackedSnapshotStore(object):
+    """Append-only snapshot container.
+
+    Snapshots are stored in a single data file (snapshots.pack), and
+    located through an index file (snapshots.idx). The index starts
+    with a header (magic, number of sorted records), followed by
+    fixed-size (timestamp, offset, length) records. The first records
+    are sorted along timestamps and are binary-searched through mmap,
+    so that opening the store does not depend on its size. Records
+    appended since the last save (autosync, spilled snapshots) follow
+    them unsorted, and are read on opening.
+
+    Snapshots may be read from other threads (webserver, exporters)
+    while they are appended, so the accesses to the data file and its
+    mapping are serialized through a lock.
+    """
+    magic='ADVSNAP1'
+    # The data file is rewritten when more than this ratio of its
+    # size is not referenced anymore (recaptured or invalidated
+    # snapshots)
+    max_garbage_ratio=.5
+    header=struct.Struct('<8sQ')
+    record=struct.Struct('<qQQ')
+    data_filename='snapshots.pack'
+    index_filename='snapshots.idx'
+
+    def __init__(self, directory):
+        self.directory=directory
+        self.data_path=os.path.join(directory, self.data_filename)
+        self.index_path=os.path.join(directory, self.index_filename)
+        self._data=None
+        self._data_map=None
+        self._index_map=None
+        self.lock=threading.RLock()
+        # Number of sorted records
+        self.count=0
+        # Unsorted records, as a dict timestamp -> (offset, length)
+        self.tail={}
+
+    @staticmethod
+    def open_store(directory, create=False):
+        """Open the store in directory.
+
+        If the store does not exist but the directory contains
+        snapshots in the legacy layout (one PNG file per timestamp),
+        they are imported. If create is True, an empty store is
+        created if necessary.
+
+        @return: the store, or None
+        """
+        store=PackedSnapshotStore(directory)
+        if not os.path.exists(store.index_path):
+            if not os.path.isdir(directory):
+                if not create:
+                    return None
+                os.makedirs(directory)
+            legacy=store.legacy_snapshots()
+            if legacy:
+                store.import_legacy(legacy)
+            elif create:
+                store.write_index([])
+            else:
+                return None
+        store.open()
+        return store
+
+    def legacy_snapshots(self):
+        """Return a list of (timestamp, filename) for legacy snapshot files.
+        """
+        res=[]
+        for name in os.listdir (self.directory):
+            (n, ext) = os.path.splitext(name)
+            # We must do some checks, in case there are non-well
+            # formatted filenames in the directory
+            if ext.lower() == '.png':
+                try:
+                    n=n.lstrip('0')
+                    if n == '':
+                        n=0
+                    i=long(n)
+                except ValueError:
+                    print "Invalid filename in imagecache: " + name
+                    continue
+                res.append( (i, os.path.join(self.directory, name)) )
+        return res
+
+    def import_legacy(self, snapshots):
+        """Import snapshots from a list of (timestamp, filename).
+        """
+        entries=[]
+        for t, filename in sorted(snapshots):
+            f=open(filename, 'rb')
+            data=f.read()
+            f.close()
+            entries.append( (t, self.append_data(data)) )
+        self.write_index(entries)
+
+    def open(self):
+        """Map the index and data files.
+        """
+        self.close()
+        f=open(self.index_path, 'rb')
+        size=os.fstat(f.fileno()).st_size
+        if size >= self.header.size:
+            self._index_map=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        if self._index_map is None:
+            raise IOError("Invalid snapshot index " + self.index_path)
+        magic, count=self.header.unpack_from(self._index_map, 0)
+        if magic != self.magic:
+            raise IOError("Invalid snapshot index " + self.index_path)
+        # Records may have been appended since the last save.
+        total=(size - self.header.size) // self.record.size
+        self.count=min(count, total)
+        self.tail={}
+        for i in xrange(self.count, total):
+            t, offset, length=self.record.unpack_from(self._index_map, self.header.size + i * self.record.size)
+            self.tail[t]=(offset, length)
+        self._map_data()
+
+    def _map_data(self):
+        # The superseded map is not closed: buffers returned by read()
+        # may still reference it. It is released with them.
+        self._data_map=None
+        if os.path.exists(self.data_path) and os.path.getsize(self.data_path):
+            f=open(self.data_path, 'rb')
+            self._data_map=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            f.close()
+
+    def close(self):
+        with self.lock:
+            for m in (self._index_map, self._data_map):
+                if m is not None:
+                    m.close()
+            self._index_map=None
+            self._data_map=None
+            if self._data is not None:
+                self._data.close()
+                self._data=None
+
+    def timestamp(self, i):
+        """Return the timestamp of the i-th sorted record.
+        """
+        return self.record.unpack_from(self._index_map, self.header.size + i * self.record.size)[0]
+
+    def entry(self, i):
+        """Return the (timestamp, offset, length) i-th sorted record.
+        """
+        return self.record.unpack_from(self._index_map, self.header.size + i * self.record.size)
+
+    def bisect(self, key):
+        """Return the index of the first sorted record with timestamp >= key.
+        """
+        lo, hi=0, self.count
+        while lo < hi:
+            mid=(lo + hi) // 2
+            if self.timestamp(mid) < key:
+                lo=mid + 1
+            else:
+                hi=mid
+        return lo
+
+    def timestamps(self):
+        """Return the list of sorted record timestamps.
+        """
+        return [ self.timestamp(i) for i in xrange(self.count) ]
+
+    def nearest(self, key, epsilon, ignore=None):
+        """Return the nearest sorted timestamp no further than epsilon from key.
+
+        @param ignore: a set of timestamps to ignore
+        @return: a timestamp, or None
+        """
+        i=self.bisect(key)
+        after=None
+        j=i
+        while j < self.count:
+            t=self.timestamp(j)
+            if t - key > epsilon:
+                break
+            if not ignore or t not in ignore:
+                after=t
+                break
+            j += 1
+        before=None
+        j=i - 1
+        while j >= 0:
+            t=self.timestamp(j)
+            if key - t > epsilon:
+                break
+            if not ignore or t not in ignore:
+                before=t
+                break
+            j -= 1
+        if before is not None and (after is None or key - before <= after - key):
+            return before
+        return after
+
+    def get(self, key):
+        """Return the PackedString for the exact timestamp key, or None.
+        """
+        i=self.bisect(key)
+        if i < self.count:
+            t, offset, length=self.entry(i)
+            if t == key:
+                return PackedString(self, t, offset, length)
+        if key in self.tail:
+            offset, length=self.tail[key]
+            return PackedString(self, key, offset, length)
+        return None
+
+    def _mapped(self, offset, length):
+        """Return the data map, remapping it if necessary.
+
+        The caller must hold the lock.
+        """
+        if self._data_map is None or offset + length > len(self._data_map):
+            # Data was appended since the file was mapped
+            if self._data is not None:
+                self._data.flush()
+            self._map_data()
+        return self._data_map
+
+    def read(self, offset, length):
+        """Return a zero-copy buffer on the stored data.
+        """
+        with self.lock:
+            return buffer(self._mapped(offset, length), offset, length)
+
+    def read_string(self, offset, length):
+        """Return a copy of the stored data.
+        """
+        with self.lock:
+            return self._mapped(offset, length)[offset:offset + length]
+
+    def append_data(self, data):
+        """Append data to the data file.
+
+        @return: a (offset, length) tuple
+        """
+        with self.lock:
+            if self._data is None:
+                self._data=open(self.data_path, 'ab')
+            self._data.seek(0, 2)
+            offset=self._data.tell()
+            self._data.write(data)
+            return (offset, len(data))
+
+    def append(self, key, data):
+        """Append a snapshot to the store.
+
+        The index record is appended after the sorted records. It
+        will be sorted on the next write_index.
+
+        @return: a PackedString
+        """
+        with self.lock:
+            offset, length=self.append_data(data)
+            self._data.flush()
+            f=open(self.index_path, 'ab')
+            f.write(self.record.pack(key, offset, length))
+            f.close()
+            self.tail[key]=(offset, length)
+        return PackedString(self, key, offset, length)
+
+    def garbage(self, entries):
+        """Return the size of the data which is not referenced by entries.
+
+        @param entries: a list of (timestamp, (offset, length))
+        """
+        with self.lock:
+            if self._data is not None:
+                self._data.flush()
+        if not os.path.exists(self.data_path):
+            return 0
+        return os.path.getsize(self.data_path) - sum(length for t, (offset, length) in entries)
+
+    def needs_compaction(self, entries):
+        size=os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        return size and self.garbage(entries) > size * self.max_garbage_ratio
+
+    def compact(self, entries):
+        """Rewrite the data file and the index with only the given entries.
+
+        The PackedString instances referencing the previous data file
+        become invalid.
+
+        @param entries: a list of (timestamp, (offset, length)), sorted by timestamp
+        @return: the list of new entries
+        """
+        with self.lock:
+            tmp=self.data_path + '.tmp'
+            f=open(tmp, 'wb')
+            res=[]
+            for t, (offset, length) in entries:
+                res.append( (t, (f.tell(), length)) )
+                f.write(self.read(offset, length))
+            f.close()
+            self.close()
+            if config.data.os == 'win32' and os.path.exists(self.data_path):
+                os.unlink(self.data_path)
+            os.rename(tmp, self.data_path)
+            self.write_index(res)
+        return res
+
+    def write_index(self, entries):
+        """Atomically write a new sorted index.
+
+        @param entries: a list of (timestamp, (offset, length)), sorted by timestamp
+        """
+        with self.lock:
+            if self._data is not None:
+                self._data.flush()
+            tmp=self.index_path + '.tmp'
+            f=open(tmp, 'wb')
+            f.write(self.header.pack(self.magic, len(entries)))
+            for t, (offset, length) in entries:
+                f.write(self.record.pack(t, offset, length))
+            f.close()
+            if self._index_map is not None:
+                self._index_map.close()
+                self._index_map=None
+            if config.data.os == 'win32' and os.path.exists(self.index_path):
+                os.unlink(self.index_path)
+            os.rename(tmp, self.index_path)
+
 class TypedString(str):
     """String with a mimetype and a timestamp attribute.
     """
@@ -63,7 +422,22 @@ class ImageCache(dict):
     """ImageCache class.
 
     It interacts with the player to return annotation snapshots. It approximates
-    key values to a given precision (20 by default).
+    key values to a given precision (35 by default).
+
+    Valid keys are kept in a sorted list, so that the approximation
+    is done through a binary search. Valid and missing keys are also
+    kept in separate sets.
+
+    Saved snapshots are stored in a PackedSnapshotStore. Its entries
+    are looked up through a binary search on the memory-mapped index,
+    and only materialized in the cache when they are accessed.
+
+    The memory used by in-memory snapshots is bounded by
+    config.data.preferences['imagecache-memory-limit'] (in MB). Least
+    recently used snapshots are spilled to a temporary store (in a
+    session directory of config.data.path['imagecache']) and
+    transparently replaced by PackedString instances. They are only
+    written to the persistent store by save().
 
     @ivar not_yet_available_image: the image returned for not-yet-captured images
     @type not_yet_available_image: PNG data
@@ -75,6 +449,10 @@ class ImageCache(dict):
     @type name: string
     @ivar autosync: if True, directly store snapshots on disk
     @type autosync: boolean
+    @ivar max_memory: memory budget in bytes for in-memory snapshots. If None, use the imagecache-memory-limit preference
+    @type max_memory: integer
+    @ivar stats: hit, miss and eviction counters
+    @type stats: dict
     """
     # The content of the not_yet_available_file file. We could use
     # CachedString but as it is frequently used, let us keep it in memory.
@@ -84,6 +462,22 @@ class ImageCache(dict):
     not_yet_available_image.contenttype='image/png'
     not_yet_available_image.timestamp=-1
 
+    # Spill directories created during the session
+    spill_directory_list = []
+
+    def cleanup():
+        """Remove the spill directories created during the session.
+
+        This method is intended to be used at the end of the
+        application.
+        """
+        for d in ImageCache.spill_directory_list:
+            if os.path.isdir(d):
+                shutil.rmtree(d, ignore_errors=True)
+        del ImageCache.spill_directory_list[:]
+
+    cleanup = staticmethod(cleanup)
+
     def __init__ (self, name=None, epsilon=35):
         """Initialize the Imagecache
 
@@ -98,6 +492,29 @@ class ImageCache(dict):
         # not yet been updated.
         dict.__init__ (self)
 
+        # Sorted list of the positions of valid snapshots
+        self._sorted_valid=[]
+        self._valid=set()
+        # Sorted list of the positions of valid snapshots, including
+        # the ones which are only in the store. It is built on demand
+        # and then kept up-to-date.
+        self._sorted_all=None
+        self._missing=set()
+
+        # In-memory snapshots, in least recently used order. Values
+        # are the snapshot sizes.
+        self._lru=OrderedDict()
+        self._memory=0
+        self.max_memory=None
+        # Temporary store (and its directory) used to spill
+        # snapshots. It is removed on save, clear and reset.
+        self._spill_directory=None
+        self._spill_store=None
+        # On-disk snapshot store, and its invalidated timestamps
+        self._store=None
+        self._masked=set()
+        self.stats={ 'hit': 0, 'miss': 0, 'eviction': 0 }
+
         self._modified=False
 
         self.name=None
@@ -118,7 +535,198 @@ class ImageCache(dict):
         if key is None:
             return
         if not dict.has_key (self, key):
-            dict.__setitem__(self, key, self.not_yet_available_image)
+            if self._store is not None and key not in self._masked:
+                s=self._store.get(key)
+                if s is not None:
+                    self._set_valid(key, s)
+                    return
+            self._set_missing(key)
+
+    def _set_missing(self, key):
+        """Store the not-yet-available image for key.
+        """
+        if key in self._valid:
+            self._valid.remove(key)
+            del self._sorted_valid[bisect.bisect_left(self._sorted_valid, key)]
+            self._forget(key)
+            self._remove_sorted_all(key)
+            if self._store is not None:
+                # Do not use the stored snapshot anymore
+                self._masked.add(key)
+        self._missing.add(key)
+        dict.__setitem__(self, key, self.not_yet_available_image)
+
+    def _remove_sorted_all(self, key):
+        l=self._sorted_all
+        if l is not None:
+            i=bisect.bisect_left(l, key)
+            if i < len(l) and l[i] == key:
+                del l[i]
+
+    def _set_valid(self, key, value):
+        """Store a valid image for key.
+        """
+        if key not in self._valid:
+            self._valid.add(key)
+            self._missing.discard(key)
+            bisect.insort(self._sorted_valid, key)
+            l=self._sorted_all
+            if l is not None:
+                i=bisect.bisect_left(l, key)
+                if i == len(l) or l[i] != key:
+                    l.insert(i, key)
+        else:
+            self._forget(key)
+        self._masked.discard(key)
+        dict.__setitem__(self, key, value)
+        if isinstance(value, TypedString):
+            self._lru[key]=len(value)
+            self._memory += len(value)
+            self._evict()
+
+    def _forget(self, key):
+        """Remove key from the in-memory snapshots.
+        """
+        size=self._lru.pop(key, None)
+        if size is not None:
+            self._memory -= size
+
+    def _hit(self, key):
+        """Update statistics and LRU order when accessing key.
+        """
+        if key in self._valid:
+            self.stats['hit'] += 1
+            size=self._lru.pop(key, None)
+            if size is not None:
+                self._lru[key]=size
+        else:
+            self.stats['miss'] += 1
+
+    def get_memory_limit(self):
+        """Return the memory budget in bytes (0 for no limit).
+        """
+        if self.max_memory is not None:
+            return self.max_memory
+        return config.data.preferences['imagecache-memory-limit'] * 1024 * 1024
+
+    def _attach_store(self, store):
+        """Use the given PackedSnapshotStore as backing store.
+        """
+        if self._store is not None and self._store is not store:
+            self._store.close()
+        self._store=store
+        self._masked.clear()
+        self._sorted_all=None
+        # Records appended since the last save are not sorted: make
+        # them directly available.
+        for t, (offset, length) in store.tail.iteritems():
+            if t not in self._valid:
+                self._set_valid(t, PackedString(store, t, offset, length))
+
+    def get_store(self):
+        """Return the snapshot store, creating it if necessary.
+
+        @return: a PackedSnapshotStore, or None if the cache has no name
+        """
+        if self._store is None and self.name is not None:
+            store=PackedSnapshotStore.open_store(os.path.join(config.data.path['imagecache'], self.name),
+                                                 create=True)
+            self._attach_store(store)
+        return self._store
+
+    def get_spill_directory(self):
+        """Return the session directory used to store evicted snapshots.
+        """
+        if self._spill_directory is None:
+            self._spill_directory=tempfile.mkdtemp(prefix='advene_imagecache',
+                                                   dir=config.data.path['imagecache'])
+            self.spill_directory_list.append(self._spill_directory)
+        return self._spill_directory
+
+    def get_spill_store(self):
+        """Return the temporary store used to spill evicted snapshots.
+        """
+        if self._spill_store is None:
+            self._spill_store=PackedSnapshotStore.open_store(self.get_spill_directory(),
+                                                             create=True)
+        return self._spill_store
+
+    def remove_spill_directory(self):
+        """Remove the spill directory and the snapshots it contains.
+
+        The spilled snapshots must not be referenced anymore.
+        """
+        if self._spill_store is not None:
+            self._spill_store.close()
+            self._spill_store=None
+        d=self._spill_directory
+        if d is None:
+            return
+        self._spill_directory=None
+        try:
+            self.spill_directory_list.remove(d)
+        except ValueError:
+            pass
+        shutil.rmtree(d, ignore_errors=True)
+
+    def _evict(self):
+        """Spill least recently used snapshots to disk if necessary.
+        """
+        limit=self.get_memory_limit()
+        if not limit:
+            return
+        while self._memory > limit and self._lru:
+            key, size=self._lru.popitem(last=False)
+            self._memory -= size
+            value=dict.__getitem__(self, key)
+            try:
+                # Do not use the persistent store: the snapshots
+                # must only be kept if the imagecache is saved.
+                s=self.get_spill_store().append(key, value)
+            except (IOError, OSError), e:
+                print "Cannot spill snapshot %d to disk: %s" % (key, unicode(e))
+                # Keep it in memory, and do not try further.
+                self._lru[key]=size
+                self._memory += size
+                return
+            dict.__setitem__(self, key, s)
+            self.stats['eviction'] += 1
+
+    def statistics(self):
+        """Return a dict with usage information.
+        """
+        d=dict(self.stats)
+        d.update({ 'valid': len(self._valid),
+                   'missing': len(self._missing),
+                   'in-memory': len(self._lru),
+                   'memory': self._memory,
+                   'memory-limit': self.get_memory_limit() })
+        return d
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        if key in self._valid:
+            self._valid.remove(key)
+            del self._sorted_valid[bisect.bisect_left(self._sorted_valid, key)]
+            self._forget(key)
+            if (self._store is None or key in self._masked
+                or self._store.get(key) is None):
+                self._remove_sorted_all(key)
+        self._missing.discard(key)
+
+    def clear(self):
+        dict.clear(self)
+        del self._sorted_valid[:]
+        self._sorted_all=None
+        self._valid.clear()
+        self._missing.clear()
+        self._lru.clear()
+        self._memory=0
+        if self._store is not None:
+            self._store.close()
+            self._store=None
+        self._masked.clear()
+        self.remove_spill_directory()
 
     def has_key (self, key):
         if key is None:
@@ -143,6 +751,7 @@ class ImageCache(dict):
         if key is None:
             return self.not_yet_available_image
         key = self.approximate(key)
+        self._hit(key)
         return dict.__getitem__(self, key)
 
     def get(self, key, epsilon=None):
@@ -158,6 +767,7 @@ class ImageCache(dict):
         if key is None:
             return self.not_yet_available_image
         key = self.approximate(key, epsilon)
+        self._hit(key)
         return dict.__getitem__(self, key)
 
     def __setitem__ (self, key, value):
@@ -173,20 +783,12 @@ class ImageCache(dict):
         if value != self.not_yet_available_image:
             self._modified=True
             if self.autosync and self.name is not None:
-                d=os.path.join(config.data.path['imagecache'], self.name)
-                if not os.path.isdir(d):
-                    os.mkdir (d)
-                filename=os.path.join(d, "%010d.png" % key)
-                f = open(filename, 'wb')
-                f.write (value)
-                f.close ()
-                value=CachedString(filename)
-                value.contenttype='image/png'
+                value=self.get_store().append(key, str(value))
             elif isinstance(value, basestring):
                 value=TypedString(value)
                 value.timestamp=key
                 value.contenttype='image/png'
-            return dict.__setitem__(self, key, value)
+            return self._set_valid(key, value)
         else:
             return self.not_yet_available_image
 
@@ -199,23 +801,29 @@ class ImageCache(dict):
         if key is None:
             return None
         key=long(key)
-        if dict.has_key(self, key) and dict.__getitem__(self, key) != self.not_yet_available_image:
+        if key in self._valid:
             return key
 
         if epsilon is None:
             epsilon=self.epsilon
-        valids = [ (pos, abs(pos-key))
-                   for pos in self.keys()
-                   if abs(pos - key) <= epsilon
-                   and dict.__getitem__(self, pos) != self.not_yet_available_image ]
-        valids.sort(key=operator.itemgetter(1))
-
-        if valids:
-            key = valids[0][0]
-#            print "Approximate key: %d (%d)" % valids[0]
-#            if len(valids) > 1:
-#                print "Imagecache: more than 1 valid snapshot for %d: %s" % (key,
-#                                                                              valids)
+        # Find the nearest valid keys around key
+        valids=self._sorted_valid
+        i=bisect.bisect_left(valids, key)
+        nearest=None
+        if i < len(valids) and valids[i] - key <= epsilon:
+            nearest=valids[i]
+        if i > 0 and key - valids[i - 1] <= epsilon and (nearest is None
+                                                         or key - valids[i - 1] <= nearest - key):
+            nearest=valids[i - 1]
+        if self._store is not None:
+            t=self._store.nearest(key, epsilon, self._masked)
+            if t is not None and (nearest is None or abs(t - key) < abs(nearest - key)):
+                # Materialize the stored snapshot
+                self._set_valid(t, self._store.get(t))
+                nearest=t
+
+        if nearest is not None:
+            key = nearest
         else:
             self.init_value (key)
 
@@ -232,8 +840,8 @@ class ImageCache(dict):
         if epsilon is None:
             epsilon=self.epsilon
         key = self.approximate(key, epsilon)
-        if dict.__getitem__(self, key) != self.not_yet_available_image:
-            dict.__setitem__(self, key, self.not_yet_available_image)
+        if key in self._valid:
+            self._set_missing(key)
         return key
 
     def missing_snapshots (self):
@@ -241,18 +849,20 @@ class ImageCache(dict):
 
         @return: a list of keys
         """
-        return [ pos
-                 for pos in self.keys()
-                 if dict.__getitem__(self, pos) == self.not_yet_available_image ]
+        return list(self._missing)
 
     def valid_snapshots (self):
         """Return the list of positions of valid snapshots.
 
         @return: a list of keys
         """
-        return [ pos
-                 for pos in self.keys()
-                 if dict.__getitem__(self, pos) != self.not_yet_available_image ]
+        if self._store is None:
+            return list(self._sorted_valid)
+        if self._sorted_all is None:
+            self._sorted_all=sorted(self._valid.union(t
+                                                      for t in self._store.timestamps()
+                                                      if t not in self._masked))
+        return list(self._sorted_all)
 
     def is_initialized (self, key, epsilon=None):
         """Return True if the given key is initialized.
@@ -263,16 +873,15 @@ class ImageCache(dict):
         if key is None:
             return False
         key = self.approximate(key, epsilon)
-        if dict.__getitem__(self, key) == self.not_yet_available_image:
-            return False
-        else:
-            return True
+        return key in self._valid
 
     def save (self, name):
         """Save the content of the cache under a specified name (id).
 
         The method creates a directory in some other directory
-        (config.data.path['imagecache']) and saves the content.
+        (config.data.path['imagecache']) and saves the content in a
+        PackedSnapshotStore. Snapshots already present in the store are
+        not rewritten.
 
         @param name: the name
         @type name: string
@@ -296,15 +905,39 @@ class ImageCache(dict):
             else:
                 os.mkdir (d)
 
-        for k in self.iterkeys():
-            i=dict.__getitem__(self, k)
-            if i == self.not_yet_available_image:
-                continue
-            if isinstance(i, CachedString):
-                continue
-            f = open(os.path.join (d, "%010d.png" % k), 'wb')
-            f.write (i)
-            f.close ()
+        if (self._store is not None
+            and os.path.abspath(self._store.directory) == os.path.abspath(d)):
+            store=self._store
+        else:
+            # Start a new store
+            store=PackedSnapshotStore(d)
+            if os.path.exists(store.data_path):
+                os.unlink(store.data_path)
+
+        entries=[]
+        for k in self.valid_snapshots():
+            if k in self._valid:
+                i=dict.__getitem__(self, k)
+            else:
+                i=self._store.get(k)
+            if isinstance(i, PackedString) and i._store is store:
+                entries.append( (k, (i.offset, i.length)) )
+            else:
+                entries.append( (k, store.append_data(str(i))) )
+        if store.needs_compaction(entries):
+            # Drop the recaptured and invalidated snapshots
+            entries=store.compact(entries)
+        else:
+            store.write_index(entries)
+        store.open()
+        # The in-memory, spilled or compacted snapshots are now
+        # available from the store
+        for k, (offset, length) in entries:
+            if k in self._valid:
+                self._forget(k)
+                dict.__setitem__(self, k, PackedString(store, k, offset, length))
+        self._attach_store(store)
+        self.remove_spill_directory()
 
         self._modified=False
         return d
@@ -322,34 +955,32 @@ class ImageCache(dict):
             return
         else:
             self.name=name
-            for name in os.listdir (d):
-                (n, ext) = os.path.splitext(name)
-                # We must do some checks, in case there are non-well
-                # formatted filenames in the directory
-                if ext.lower() == '.png':
-                    try:
-                        n=n.lstrip('0')
-                        if n == '':
-                            n=0
-                        i=long(n)
-                    except ValueError:
-                        print "Invalid filename in imagecache: " + name
-                        continue
-                    s=CachedString(os.path.join (d, name))
-                    s.contenttype='image/png'
-                    dict.__setitem__(self, i, s)
+            # Legacy caches (one file per snapshot) are converted
+            store=PackedSnapshotStore.open_store(d)
+            if store is not None:
+                self._attach_store(store)
         self._modified=False
 
     def reset(self):
         """Reset imagecache.
         """
-        for pos in self.keys():
+        if self._store is not None:
+            self._masked.update(self._store.timestamps())
+            self._masked.update(self._store.tail)
+        self._sorted_all=None
+        for pos in self._valid:
             dict.__setitem__(self, pos, self.not_yet_available_image)
+        self._missing.update(self._valid)
+        self._valid.clear()
+        del self._sorted_valid[:]
+        self._lru.clear()
+        self._memory=0
+        self.remove_spill_directory()
 
     def ids (self):
         """Return the list of currents ids.
         """
-        return [ str(k) for k in self.keys () ]
+        return [ str(k) for k in sorted(set(self.keys()).union(self.valid_snapshots())) ]
 
     def __str__ (self):
         return "ImageCache object (%d images)" % len(self)
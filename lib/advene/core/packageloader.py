@@ -0,0 +1,160 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Background package loader.
+
+The L{PackageLoader} thread reads a package, and prepares the data
+that the controller builds when loading a package (id generator,
+annotation index, imagecache). The package is then installed by the
+controller in the main thread.
+
+The progress is reported through PackageLoadProgress events, with the
+following parameters:
+  - package: the package (None if it is not parsed yet)
+  - uri: the package URI
+  - progress: a float between 0 and 1
+  - message: a description of the current step
+  - error: the error message, if the loading failed
+
+The package is only installed (and the views updated) once it is
+completely loaded, since the model bundles cannot be built
+concurrently from two threads.
+"""
+
+import time
+import threading
+
+from gettext import gettext as _
+
+from advene.core.imagecache import ImageCache
+import advene.util.helper as helper
+
+class PackageLoader(threading.Thread):
+    """Thread loading a package.
+
+    @ivar package: the loaded package, or None
+    @ivar error: the error message if the loading failed, or None
+    """
+    # Number of annotations parsed between two PackageLoadProgress events
+    chunk_size = 1000
+
+    def __init__(self, controller, uri, alias=None, activate=True):
+        threading.Thread.__init__(self, name='PackageLoader %s' % uri)
+        self.setDaemon(True)
+        self.controller = controller
+        self.uri = uri
+        self.alias = alias
+        self.activate = activate
+        self.package = None
+        self.error = None
+        self.cancelled = False
+
+    def progress(self, value, message, error=None):
+        # The events are queued, and handled in the main thread
+        self.controller.notify('PackageLoadProgress',
+                               package=self.package,
+                               uri=self.uri,
+                               progress=value,
+                               message=message,
+                               error=error)
+
+    def cancel(self):
+        """Cancel the loading.
+
+        The package will not be installed. It is called by
+        load_package when another package is loaded.
+        """
+        self.cancelled = True
+
+    def load_imagecache(self, p):
+        """Load the imagecache for the package media.
+        """
+        p.imagecache = ImageCache()
+        mediafile = self.controller.get_default_media(p)
+        if mediafile:
+            p.imagecache.load(helper.mediafile2id(mediafile))
+            for a in p.annotations:
+                p.imagecache.init_value(a.fragment.begin)
+                p.imagecache.init_value(a.fragment.end)
+        # Tell manage_package_load that the imagecache is ready
+        p._preloaded_media = mediafile
+
+    def run(self):
+        c = self.controller
+        try:
+            t = time.time()
+            self.progress(0.0, _("Reading %s") % self.uri)
+            p = c.read_package(self.uri)
+            c.queue_action(c.log, _("Loaded package in %f seconds") % (time.time() - t))
+
+            # Build the element bundles in this thread. Schemas and
+            # types are published first.
+            for s in p.schemas:
+                s.getAnnotationTypes()
+                s.getRelationTypes()
+            p.getAnnotationTypes()
+            p.getRelationTypes()
+            self.package = p
+            self.progress(0.2, _("Schemas loaded"))
+
+            annotations = p.getAnnotations()
+            p.getRelations()
+            n = len(annotations)
+            for i in xrange(0, n, self.chunk_size):
+                if self.cancelled:
+                    self.progress(1.0, _("Cancelled"))
+                    return
+                chunk = annotations[i:i + self.chunk_size]
+                for a in chunk:
+                    # Parse the fragment, used by the indexes
+                    a.getFragment()
+                self.progress(0.2 + 0.6 * (i + len(chunk)) / n,
+                              _("Loading annotations"))
+
+            # Build the indexes and load the imagecache in parallel
+            self.progress(0.8, _("Building indexes"))
+            workers = [ threading.Thread(target=c.init_package_indexes, args=(p,)),
+                        threading.Thread(target=self.load_imagecache, args=(p,)) ]
+            for w in workers:
+                w.setDaemon(True)
+                w.start()
+            for w in workers:
+                w.join()
+        except Exception, e:
+            self.error = unicode(e)
+            c.queue_action(c.log, _("Cannot load package from file %(uri)s: %(error)s") % {
+                    'uri': self.uri,
+                    'error': self.error })
+            self.progress(1.0, _("Error"), error=self.error)
+            return
+
+        if not self.cancelled:
+            c.queue_action(self.install)
+
+    def install(self):
+        """Install the package in the controller.
+
+        It is called in the main thread.
+        """
+        if self.controller.package_loader is self:
+            self.controller.package_loader = None
+        if self.cancelled:
+            return True
+        self.progress(1.0, _("Package loaded"))
+        self.controller.install_package(self.package, self.uri, self.alias, self.activate)
+        return True
@@ -0,0 +1,129 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Media position clock.
+
+Querying the player position can be expensive (it goes through the
+GStreamer pipeline or the VLC library). The L{PositionClock} stores
+the last position sample obtained from the player, along with the
+wallclock time and playing rate, and interpolates the current
+position from it.
+
+The controller synchronizes the clock with the player when the player
+status changes (L{PositionClock.invalidate}), and regularly to correct
+the drift (every sync_interval ms).
+"""
+
+import time
+
+class PositionClock(object):
+    """Interpolated media position.
+
+    @ivar position: the position (in ms) of the last sample
+    @ivar wallclock: the time (in s) of the last sample, or None if
+    the clock is not synchronized
+    @ivar rate: the playing rate
+    @ivar running: True if the position increases (playing status)
+    @ivar duration: the stream duration, used as an upper bound. 0 if unknown.
+    @ivar drift: the difference (in ms) between the player position
+    and the interpolated position at the last synchronization
+    """
+    # Backward drift (in ms) absorbed without moving the position
+    # backwards, so that jitter is not interpreted as a seek.
+    drift_tolerance = 250
+
+    def __init__(self, sync_interval=1000):
+        """
+        @param sync_interval: maximum delay (in ms) between two synchronizations
+        @type sync_interval: int
+        """
+        self.sync_interval = sync_interval
+        self.position = 0
+        self.wallclock = None
+        self.rate = 1.0
+        self.running = False
+        self.duration = 0
+        self.drift = 0
+        # Lower bound of the interpolated position, to keep it
+        # monotonic while playing
+        self.floor = 0
+
+    def invalidate(self):
+        """Force a synchronization on the next update.
+        """
+        self.wallclock = None
+
+    def needs_sync(self, now=None):
+        """Check if the clock must be synchronized with the player.
+        """
+        if self.wallclock is None:
+            return True
+        if now is None:
+            now = time.time()
+        return (now - self.wallclock) * 1000 >= self.sync_interval or now < self.wallclock
+
+    def sync(self, position, running, rate=1.0, duration=0, now=None):
+        """Store a position sample obtained from the player.
+
+        @param position: the player position (in ms)
+        @param running: True if the player is playing
+        @param rate: the playing rate
+        @param duration: the stream duration (in ms), 0 if unknown
+        """
+        if now is None:
+            now = time.time()
+        continuous = (self.wallclock is not None and running and self.running
+                      and rate == self.rate)
+        if continuous:
+            self.drift = position - self.get_position(now)
+            if not -self.drift_tolerance < self.drift < 0:
+                self.floor = 0
+        else:
+            self.drift = 0
+            self.floor = 0
+        self.position = position
+        self.wallclock = now
+        self.running = running
+        self.rate = rate or 1.0
+        self.duration = duration
+
+    def get_position(self, now=None):
+        """Return the interpolated position (in ms).
+        """
+        if not self.running or self.wallclock is None:
+            return self.position
+        if now is None:
+            now = time.time()
+        pos = self.position + long((now - self.wallclock) * 1000 * self.rate)
+        if self.duration > 0 and pos > self.duration:
+            pos = self.duration
+        if self.rate > 0:
+            if pos < self.floor:
+                pos = self.floor
+            self.floor = pos
+        return pos
+
+    def delay(self, position, now=None):
+        """Return the delay (in ms) before the clock reaches position.
+
+        @return: the delay, or None if the clock is not running
+        """
+        if not self.running or self.wallclock is None or self.rate <= 0:
+            return None
+        d = (position - self.get_position(now)) / self.rate
+        return max(0, long(d + .999))
@@ -42,6 +42,10 @@ import urllib
 import cgi
 import socket
 import imghdr
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
 from gettext import gettext as _
 
@@ -53,9 +57,12 @@ if int(cherrypy.__version__.split('.')[0]) < 3:
 from advene.model.fragment import MillisecondFragment
 from advene.model.annotation import Annotation, Relation
 from advene.model.view import View
+from advene.model.schema import Schema, AnnotationType, RelationType
+from advene.model.query import Query
 from advene.model.resources import Resources
 
 from advene.model.exception import AdveneException
+from advene.model.tal.context import template_cache
 
 import simpletal.simpleTAL
 import simpletal.simpleTALES as simpleTALES
@@ -63,6 +70,70 @@ import simpletal.simpleTALES as simpleTALES
 import advene.util.helper as helper
 
 DEBUG=True
+
+class ResponseCache(object):
+    """Cache of the responses rendered for package elements.
+
+    Entries are keyed by the package alias, the TALES path, the query
+    parameters, the display mode, the server base URL and the package
+    modification generation (see
+    L{advene.core.controller.AdveneController.update_generation}), so
+    that outdated entries are never used.
+
+    Only responses which depend on the package data alone are
+    cached. The TALES context records the evaluation of any other
+    root, attribute or method (player, imagecache, other packages,
+    configuration, methods which are not declared pure, python
+    expressions), see
+    L{advene.model.tal.context.AdveneContext.mark_volatile}.
+
+    @ivar size: the maximum number of cached responses
+    @type size: int
+    """
+    def __init__(self, size=200):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, alias, package, tales, query, displaymode, base):
+        """Return the cache key for a request, or None.
+        """
+        generation = getattr(package, '_generation', None)
+        if generation is None:
+            return None
+        return (alias, tales,
+                tuple(sorted( (k, repr(v)) for (k, v) in query.iteritems() )),
+                displaymode, base, generation)
+
+    def get(self, key):
+        """Return the (body, content-type, etag, last-modified) entry for key, or None.
+        """
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+        return entry
+
+    def store(self, key, entry):
+        if key is None:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
 class Common:
     """Common functionalities for all cherrypy nodes.
     """
@@ -120,6 +191,57 @@ class Common:
         cherrypy.response.headers['Pragma']='no-cache'
         cherrypy.response.headers['Cache-Control']='max-age=0'
 
+    def not_modified (self, etag, last_modified=None):
+        """Check the conditional headers of the request.
+
+        @param etag: the entity tag of the response
+        @type etag: string
+        @param last_modified: the modification time of the response
+        @type last_modified: float
+        @return: True if the client copy is still valid
+        @rtype: boolean
+        """
+        headers=cherrypy.request.headers
+        if_none_match=headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags=[ t.strip() for t in if_none_match.split(',') ]
+            return etag in tags or '*' in tags
+        if_modified_since=headers.get('If-Modified-Since')
+        if if_modified_since and last_modified is not None:
+            t=parsedate_tz(if_modified_since)
+            return t is not None and long(last_modified) <= mktime_tz(t)
+        return False
+
+    def send_validated (self, body, etag=None, last_modified=None, max_age=0):
+        """Send a response with validation headers.
+
+        The ETag and Last-Modified headers are set, and a 304 (Not
+        Modified) response is sent if the client copy is still valid.
+
+        @param body: the response body
+        @type body: string
+        @param etag: the entity tag (by default, computed from the body)
+        @type etag: string
+        @param last_modified: the modification time of the response
+        @type last_modified: float
+        @param max_age: the lifetime of the response in caches (in seconds)
+        @type max_age: int
+        @return: the response body
+        """
+        if etag is None:
+            etag='"%s"' % hashlib.md5(body).hexdigest()
+        headers=cherrypy.response.headers
+        headers['ETag']=etag
+        if last_modified is not None:
+            headers['Last-Modified']=formatdate(last_modified, usegmt=True)
+        headers['Cache-Control']='max-age=%d' % max_age
+        if 'Pragma' in headers:
+            del headers['Pragma']
+        if self.not_modified(etag, last_modified):
+            cherrypy.response.status=304
+            return ""
+        return body
+
     def start_html (self, title="", headers=None, head_section=None, body_attributes="",
                     mode=None, mimetype=None, duplicate_title=False, cache=False):
         """Starts writing a HTML response (header + common body start).
@@ -432,8 +554,8 @@ class Media(Common):
                 res.append (_("""<p><a href="/media/snapshot/%s?mode=inline">Display with inline images</a></p>""") % alias)
             res.append ("<ul>")
 
-            k = i.keys ()
-            k.sort ()
+            # Stored snapshots are not necessarily loaded in the cache
+            k = sorted(set(i.keys()).union(i.valid_snapshots()))
             for position in k:
                 if i.is_initialized (position):
                     m = _("Done")
@@ -449,10 +571,16 @@ class Media(Common):
             self.no_cache ()
             if 'async-snapshot' in self.controller.player.player_capabilities:
                 self.controller.queue_action(self.controller.update_snapshot, position)
+            snapshot=i[position]
+            cherrypy.response.headers['Content-type']=snapshot.contenttype
+            res.append (str(snapshot))
+            return res
         snapshot=i[position]
         cherrypy.response.headers['Content-type']=snapshot.contenttype
-        res.append (str(snapshot))
-        return res
+        # Initialized snapshots do not change: they can be kept in
+        # browser caches.
+        return self.send_validated(str(snapshot),
+                                   max_age=config.data.webserver['snapshot-max-age'])
     snapshot.exposed=True
 
     def overlay(self, *args, **params):
@@ -953,6 +1081,7 @@ class Admin(Common):
         res.append(_("""
         <p><a href="/admin/access">Update the access list</a></p>
         <p><a href="/admin/methods">List available TALES methods</a></p>
+        <p><a href="/admin/templates">Display view rendering statistics</a></p>
         <p><a href="/action">List available actions</a></p>
         <p><a href="/admin/reset">Reset the server</a></p>
         <p><a href="/media">Media control</a></p>
@@ -1087,6 +1216,18 @@ class Admin(Common):
         return "".join(res)
     methods.exposed=True
 
+    def templates(self):
+        """Display view compilation and rendering statistics.
+        """
+        res=[ self.start_html (_('View rendering statistics'), duplicate_title=True, mode='navigation') ]
+        res.append(_("<p>%d compiled templates in cache</p>") % len(template_cache.templates))
+        res.append('<ul>')
+        for l in template_cache.dump_statistics():
+            res.append("<li>%s</li>\n" % cgi.escape(l))
+        res.append("</ul>")
+        return "".join(res)
+    templates.exposed=True
+
     def display(self, mode=None):
         """Set display mode.
         """
@@ -1107,6 +1248,22 @@ class Admin(Common):
 class Packages(Common):
     """Node for packages access.
     """
+    # Element classes of package bundles, used to resolve
+    # bundle/id paths through the package id index.
+    bundle_classes = {
+        'annotations': Annotation,
+        'relations': Relation,
+        'schemas': Schema,
+        'annotationTypes': AnnotationType,
+        'relationTypes': RelationType,
+        'views': View,
+        'queries': Query,
+        }
+
+    def __init__(self, controller=None):
+        self.controller=controller
+        self.response_cache=ResponseCache(config.data.webserver['response-cache-size'])
+
     def index(self):
         """Display currently available (loaded) packages.
 
@@ -1141,7 +1298,46 @@ class Packages(Common):
         return "".join(res)
     index.exposed=True
 
-    def display_package_element (self, p, tales, query=None):
+    def display_cached_package_element (self, alias, p, tales, query):
+        """Display a view for a TALES expression, using the response cache.
+
+        The response is rendered by L{display_package_element} if it
+        is not available in the response cache. In both cases, the
+        ETag and Last-Modified headers are sent, so that clients can
+        revalidate their copy with a conditional request.
+
+        @param alias: the package alias
+        @type alias: string
+        @param p: the package in which the expression should be evaluated
+        @type p: advene.model.Package
+        @param tales: a TALES expression
+        @type tales: string
+        @param query: options used in TAL/TALES processing
+        @type query: dict
+        """
+        cache=self.response_cache
+        key=cache.key(alias, p, tales, query,
+                      self.controller.server.displaymode, cherrypy.request.base)
+        entry=cache.get(key)
+        if entry is None:
+            volatile=[]
+            body=self.display_package_element (p, tales, query, volatile=volatile)
+            if not isinstance(body, str) or not str(cherrypy.response.status).startswith('200'):
+                return body
+            if volatile:
+                return self.send_validated(body)
+            entry=(body,
+                   cherrypy.response.headers['Content-type'],
+                   '"%s"' % hashlib.md5(body).hexdigest(),
+                   getattr(p, '_modification_time', None))
+            cache.store(key, entry)
+        else:
+            cherrypy.response.status=200
+            cherrypy.response.headers['Content-type']=entry[1]
+        body, mimetype, etag, last_modified=entry
+        return self.send_validated(body, etag, last_modified)
+
+    def display_package_element (self, p, tales, query=None, volatile=None):
         """Display a view for a TALES expression.
 
         This method displays the view for the element defined by the
@@ -1177,6 +1373,8 @@ class Packages(Common):
         @type tales: string
         @param query: options used in TAL/TALES processing
         @type query: dict
+        @param volatile: if not None, the reasons why the response does not only depend on the package data are appended to this list
+        @type volatile: list
         """
         res=[]
         alias = self.controller.aliases[p]
@@ -1192,14 +1390,25 @@ class Packages(Common):
             expr = "here/%s" % tales
 
         context = self.controller.build_context (here=p, alias=alias)
+        context.volatile = volatile
         context.pushLocals()
         context.setLocal('request', query)
         # FIXME: the following line is a hack for having qname-keys work
         #        It is a hack because obviously, p is not a "view"
         context.setLocal (u'view', p)
 
+        objet = None
+        path = tales.split('/')
+        if len(path) == 2 and path[0] in self.bundle_classes:
+            # Direct access to an element: use the id index rather
+            # than the TALES traversal.
+            el = p.get_element_by_id(path[1])
+            if isinstance(el, self.bundle_classes[path[0]]):
+                objet = el
+
         try:
-            objet = context.evaluateValue (expr)
+            if objet is None:
+                objet = context.evaluateValue (expr)
         except AdveneException, e:
             self.start_html (_("Error"), duplicate_title=True, mode='navigation')
             res.append (_("""The TALES expression %s is not valid.""") % tales)
@@ -1264,6 +1473,7 @@ class Packages(Common):
         if hasattr (objet, 'view') and callable (objet.view):
 
             context = self.controller.build_context(here=objet, alias=alias)
+            context.volatile = volatile
             context.pushLocals()
             context.setLocal('request', query)
             # FIXME: should be default view
@@ -1449,7 +1659,7 @@ class Packages(Common):
             return self.send_error(400, 'Unknown method: %s' % cherrypy.request.method)
 
         try:
-            return self.display_package_element (p , tales, query)
+            return self.display_cached_package_element (pkgid, p, tales, query)
         except simpletal.simpleTAL.TemplateParseException, e:
             res=[ self.start_html(_("Error")) ]
             res.append(_("<h1>Error</h1>"))
@@ -70,9 +70,13 @@ class DVDSelect:
                 mediafile=mediafile.encode('utf8')
             self.controller.player.playlist_add_item(mediafile)
             self.controller.player.update_status("start")
+            # The controller is bypassed (the preview must not be
+            # notified nor snapshotted): resynchronize its clock
+            self.controller.position_clock.invalidate()
             button.set_label(_("Stop"))
         else:
             self.controller.player.update_status("stop")
+            self.controller.position_clock.invalidate()
             self.controller.player.playlist_clear()
             for i in self.oldplaylist:
                 if isinstance(i, unicode):
@@ -330,7 +330,7 @@ class AdveneGUI(object):
             fname = rec.get_current_uri()
             try:
                 self.set_busy_cursor(True)
-                self.controller.load_package (uri=fname)
+                self.controller.load_package (uri=fname, background=True)
             except (OSError, IOError), e:
                 self.set_busy_cursor(False)
                 dialog.message_dialog(_("Cannot load package %(filename)s:\n%(error)s") % {
@@ -389,6 +389,7 @@ class AdveneGUI(object):
                 m.append(gtk.MenuItem(_("Snapshotter activity")))
                 m.append(gtk.SeparatorMenuItem())
                 m.append(gtk.MenuItem(_("%d queued requests") % s.timestamp_queue.qsize()))
+                m.append(gtk.MenuItem(_("%.1f snapshots/s") % s.throughput))
                 i = gtk.MenuItem(_("Cancel all requests"))
                 i.connect('activate', lambda i: s.clear() or True)
                 m.append(i)
@@ -1074,6 +1075,7 @@ class AdveneGUI(object):
 
         for events, method in (
             ("PackageLoad", self.manage_package_load),
+            ("PackageLoadProgress", self.manage_package_load_progress),
             ("PackageActivate", self.manage_package_activate),
             ("PackageEditEnd", lambda e, c: self.update_window_title()),
             ("PackageSave", self.manage_package_save),
@@ -1543,6 +1545,7 @@ class AdveneGUI(object):
             v = spin.get_value()
             if self.controller.player.get_rate() != v:
                 self.controller.player.set_rate(v)
+                self.controller.position_clock.invalidate()
             return True
 
         self.rate_control = gtk.SpinButton(gtk.Adjustment(1.0, 0.1, 100.0, 0.2, 0.5),
@@ -2811,6 +2814,26 @@ class AdveneGUI(object):
         self.controller.queue_action(self.check_for_default_adhoc_view, p)
         return True
 
+    def manage_package_load_progress (self, context, parameters):
+        """Event Handler displaying the progress of a background package loading.
+        """
+        cid=self.gui.statusbar.get_context_id('load')
+        self.gui.statusbar.pop(cid)
+        error=context.evaluateValue('error')
+        if error:
+            self.set_busy_cursor(False)
+            dialog.message_dialog(_("Cannot load package %(filename)s:\n%(error)s") % {
+                    'filename': context.evaluateValue('uri'),
+                    'error': error}, gtk.MESSAGE_ERROR)
+            return True
+        progress=context.evaluateValue('progress')
+        if progress < 1.0:
+            self.gui.statusbar.push(cid, _("Loading %(uri)s: %(message)s (%(progress)d%%)") % {
+                    'uri': os.path.basename(context.evaluateValue('uri')),
+                    'message': context.evaluateValue('message'),
+                    'progress': int(progress * 100) })
+        return True
+
     def check_for_default_adhoc_view(self, package):
         # Open the default adhoc view (which is commonly the _default_workspace)
         default_adhoc = package.getMetaData (config.data.namespace, "default_adhoc")
@@ -3141,8 +3164,8 @@ class AdveneGUI(object):
                 if l:
                     if c.tracers and config.data.preferences['record-actions']:
                         try:
-                            fn = c.tracers[0].export()
-                            print "trace exported to %s" % fn
+                            fn = c.tracers[0].checkpoint()
+                            print "trace saved to %s" % fn
                         except Exception, e:
                             print "error exporting trace : %s" % unicode(e).encode('utf-8')
                     if config.data.preferences['package-auto-save'] == 'always':
@@ -3744,7 +3767,7 @@ class AdveneGUI(object):
 
             try:
                 self.set_busy_cursor(True)
-                self.controller.load_package (uri=filename, alias=alias)
+                self.controller.load_package (uri=filename, alias=alias, background=True)
             except (OSError, IOError), e:
                 self.set_busy_cursor(False)
                 dialog.message_dialog(_("Cannot load package %(filename)s:\n%(error)s") % {
@@ -4202,6 +4225,8 @@ class AdveneGUI(object):
                         'custom-updown-keys', 'player-autostart',
                         'language',
                         'display-scroller', 'display-caption', 'imagecache-save-on-exit',
+                        'imagecache-memory-limit', 'action-workers', 'action-timeout',
+                        'undo-depth', 'undo-memory-limit',
                         'remember-window-size', 'expert-mode', 'update-check',
                         'package-auto-save', 'package-auto-save-interval',
                         'bookmark-snapshot-width', 'bookmark-snapshot-precision',
@@ -4277,6 +4302,9 @@ class AdveneGUI(object):
                 (_("always save screenshots"), 'always'),
                 (_("ask before saving screenshots"), 'ask'),
                 )))
+        ew.add_spin(_("Snapshot memory (in MB)"), 'imagecache-memory-limit', _("Memory used to keep snapshots. Older snapshots are stored on disk. 0 means no limit."), 0, 4096)
+        ew.add_spin(_("Undo depth"), 'undo-depth', _("Maximum number of undoable operations. 0 means no limit."), 0, 100000)
+        ew.add_spin(_("Undo memory (in MB)"), 'undo-memory-limit', _("Memory used by the undo history. Older operations are stored next to the package file. 0 means no limit."), 0, 4096)
         ew.add_option(_("Auto-save"), 'package-auto-save',
                       _("Data auto-save functionality"), odict((
                 (_("is desactivated"), 'never'),
@@ -4284,6 +4312,8 @@ class AdveneGUI(object):
                 (_("is done after confirmation"), 'ask'),
                 )))
         ew.add_spin(_("Auto-save interval (in s)"), 'package-auto-save-interval', _("Interval (in seconds) between package auto-saves"), 5, 60 * 60)
+        ew.add_spin(_("Action workers"), 'action-workers', _("Number of threads executing long-running actions (sounds, speech...). 0 to disable."), 0, 16)
+        ew.add_spin(_("Action timeout (in s)"), 'action-timeout', _("Duration after which a long-running action is reported and its thread replaced"), 1, 3600)
 
         ew.add_title(_("Workspace"))
 
@@ -4311,6 +4341,7 @@ class AdveneGUI(object):
 
         ew.add_checkbox(_("Enable snapshots"), "player-snapshot", _("Enable snapshots"))
         ew.add_spin(_("Snapshot width"), "player-snapshot-width", _("Snapshot width in pixels."), 0, 1280)
+        ew.add_spin(_("Snapshot workers"), "player-snapshotter-workers", _("Number of parallel pipelines used to capture snapshots."), 1, 8)
         ew.add_spin(_("Verbosity"), "player-level", _("Verbosity level. -1 for no messages."),
                     -1, 3)
 
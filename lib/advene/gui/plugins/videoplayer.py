@@ -89,6 +89,10 @@ class VideoPlayer(AdhocView):
 
     def synchronize(self, *p):
         """Synchronize the player with the main player.
+
+        self.player is a distinct player instance, so its status
+        changes do not affect the controller position clock (which
+        only interpolates the main player position).
         """
         if self.player is None:
             return True
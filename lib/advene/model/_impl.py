@@ -282,6 +282,7 @@ class Tagged(Metaed):
         else:
             if self.getMetaData (ns, "tags"):
                 self.setMetaData (ns, "tags", None)
+        self._dataChanged()
 
     def addTag(self, tag, ns=None):
         """Add a new tag.
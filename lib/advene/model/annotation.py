@@ -31,6 +31,7 @@ import viewable
 from advene.model.constants import adveneNS
 
 from exception import AdveneException
+from streamloader import LazyAnnotationElement
 from fragment import fragmentFactory, unknownFragment
 
 from advene.model.util.defaultdict import DefaultDict
@@ -98,6 +99,8 @@ class Annotation(modeled.Importable, content.WithContent,
             # mode 1 initialization
             modeled.Importable.__init__(self, element, parent)
             _impl.Uried.__init__(self, parent=self.getOwnerPackage())
+            if isinstance(element, LazyAnnotationElement):
+                element.owner = self
 
         else:
             # should be mode 2, checking parameter consistency
@@ -172,10 +175,27 @@ class Annotation(modeled.Importable, content.WithContent,
         self.setType(None)
         self._cached_type=None
 
+    def _getMeta(self, create=False):
+        model = self._getModel()
+        if (not create and isinstance(model, LazyAnnotationElement)
+            and not model.has_meta):
+            return None
+        return super(Annotation, self)._getMeta(create)
+
+    def _getContentElement(self):
+        model = self._getModel()
+        if isinstance(model, LazyAnnotationElement):
+            return model.get_content_element()
+        return super(Annotation, self)._getContentElement()
+
     def getFragment(self):
         """Return the fragment associated to this annotation"""
         if self.__fragment is None:
-            elt = self.__getFragmentElement()
+            model = self._getModel()
+            if isinstance(model, LazyAnnotationElement):
+                elt = model.get_fragment_element()
+            else:
+                elt = self.__getFragmentElement()
             self.__fragment = fragmentFactory.makeFragment(elt, self)
         return self.__fragment
 
@@ -190,6 +210,7 @@ class Annotation(modeled.Importable, content.WithContent,
                             "(you probably want to clone it before)")
         old = self.__getFragmentElement()
         fragment._bound(old)
+        self._dataChanged()
 
     def delFragment(self):
         """Delete the fragment associated to this annotation"""
@@ -277,6 +277,10 @@ class WritableBundle (AbstractBundle):
         length = len (self)
         self.insert (length, item)
 
+    def extend(self, items):
+        for item in items:
+            self.append (item)
+
     def insert(self, index, item):
         assert self._assert_add_item (item)
 
@@ -349,6 +353,14 @@ class AbstractXmlBundle(WritableBundle, modeled.Modeled,
       - _getViewableType : a method returning the viewable type
     """
 
+    # Index of the element of the last item in the model children
+    _last_index_hint = -1
+
+    # True if the bundle owns its items, i.e. adding or removing an
+    # item adds or removes an element of the package. Only such
+    # bundles update the package id index.
+    _owns_items = False
+
     def __init__ (self, parent, element):
         WritableBundle.__init__ (self)
         modeled.Modeled.__init__ (self, element, parent)
@@ -411,6 +423,7 @@ class AbstractXmlBundle(WritableBundle, modeled.Modeled,
         item = self[index]
         super (AbstractXmlBundle, self).__delitem__ (index)
         self._getModel ().removeChild (self._get_element (item))
+        self._update_id_index (item, added=False)
 
     def insert(self, index, item):
 
@@ -434,11 +447,61 @@ class AbstractXmlBundle(WritableBundle, modeled.Modeled,
             true_index = elt_list.index (ref_elt)
             elt_list.insert (true_index, self._get_element (item))
         else:
-            ref_elt = self._get_element (self._list[-1])
-            ref_index = elt_list.index (ref_elt)
+            ref_index = self._last_element_index (elt_list)
             elt_list.insert (ref_index + 1, self._get_element (item))
+            self._last_index_hint = ref_index + 1
 
         super (AbstractXmlBundle, self).insert (index, item)
+        self._update_id_index (item, added=True)
+
+    def extend(self, items):
+        """Append the items at the end of the bundle.
+
+        The XML elements are inserted in a single operation, which is
+        much faster than appending the items one by one.
+        """
+        items = list (items)
+        if not items:
+            return
+        uris = set ()
+        for item in items:
+            assert self._assert_add_item (item)
+            uri = item.getUri (absolute=True)
+            assert uri not in uris, "uri %s added twice" % uri
+            uris.add (uri)
+
+        elt_list = self._getModel ().childNodes
+        if self._list:
+            index = self._last_element_index (elt_list) + 1
+        else:
+            index = 0
+        elt_list[index:index] = [ self._get_element (item) for item in items ]
+        self._last_index_hint = index + len (items) - 1
+
+        self._list.extend (items)
+        d = self._dict
+        for item in items:
+            d[item.getUri (absolute=True)] = item
+        for item in items:
+            self._update_id_index (item, added=True)
+
+    def _update_id_index (self, item, added):
+        """Update the package id index, if the bundle owns its items.
+        """
+        if self._owns_items:
+            self.getOwnerPackage ()._update_id_index (item, added=added)
+
+    def _last_element_index (self, elt_list):
+        """Return the index of the element of the last item in elt_list.
+        """
+        ref_elt = self._get_element (self._list[-1])
+        # The position of the last element is remembered, to avoid a
+        # linear search when appending several items. It is checked
+        # since the elements may have been modified in the meantime.
+        i = self._last_index_hint
+        if not (0 <= i < len (elt_list) and elt_list[i] is ref_elt):
+            i = elt_list.index (ref_elt)
+        return i
 
 
     def _assert_add_item (self, item):
@@ -460,6 +523,10 @@ class StandardXmlBundle(AbstractXmlBundle):
     on the underlying XML structure.
     """
 
+    # The package elements (annotations, relations, schemas, types,
+    # views, queries) are stored in such bundles
+    _owns_items = True
+
     def __init__ (self, parent, element, cls):
         """
         FIXME
@@ -591,6 +658,9 @@ class InverseDictBundle (StandardXmlBundle):
     themselves are used as keys.
     """
 
+    # Used for the package imports, which are not indexed
+    _owns_items = False
+
     def __init__ (self, parent, element, cls, inverse_key=None):
         """
         FIXME
@@ -35,6 +35,7 @@ from advene.util.expat import PyExpat
 from advene.model.constants import adveneNS, xlinkNS, TEXT_NODE, ELEMENT_NODE
 
 import advene.model.util.dom
+from advene.model.streamloader import LazyElement
 import advene.model.util.uri
 
 from advene.model.util.auto_properties import auto_properties
@@ -118,8 +119,13 @@ class Content(modeled.Modeled,
 
     def getData(self):
         """Return the data associated to the Content"""
-        data = StringIO()
-        advene.model.util.dom.printElementText(self._getModel(), data)
+        model = self._getModel()
+        if isinstance(model, LazyElement):
+            # Do not build the DOM element only to read its text
+            data = StringIO(model.getText())
+        else:
+            data = StringIO()
+            advene.model.util.dom.printElementText(model, data)
         if self._getModel().hasAttributeNS(None, 'encoding'):
             encoding = self._getModel().getAttributeNS(None, 'encoding')
         else:
@@ -142,6 +148,9 @@ class Content(modeled.Modeled,
             self._getModel().setAttributeNS(None, 'encoding', encoding)
             new = self._getDocument().createTextNode(data.encode(encoding))
             self._getModel().appendChild(new)
+        parent = self._getParent()
+        if parent is not None:
+            parent._dataChanged()
 
     def delData(self):
         """Delete the content's data"""
@@ -313,9 +322,12 @@ class WithContent(object):
         self._getModel().appendChild(elt)
         return Content(self, elt)
 
+    def _getContentElement(self):
+        return self._getChild((adveneNS, 'content'))
+
     def getContent(self):
         if self.__content is None:
-            elt = self._getChild((adveneNS, 'content'))
+            elt = self._getContentElement()
             if elt is None:
                 self.__content = self._createContent ()
             else:
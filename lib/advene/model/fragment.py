@@ -28,6 +28,8 @@ class AbstractFragment(viewable.Viewable.withClass('fragment')):
     """Common superclass for every fragment class.
     """
 
+    __slots__ = ()
+
     #
     # Static methods
     #
@@ -79,10 +81,16 @@ class AbstractNbeFragment (AbstractFragment, modeled.Modeled):
 
        Implements operators '==' and 'in' (for other ByteCountFragments and
        numbers).
+
+       Begin and end values are cached, so that reading them does not
+       involve the DOM. Modifications are written through to the DOM
+       element.
     """
 
     __metaclass__ = auto_properties
 
+    __slots__ = ('_begin', '_end')
+
     #
     # Instance methods
     #
@@ -93,6 +101,8 @@ class AbstractNbeFragment (AbstractFragment, modeled.Modeled):
         value and facultative end or duration values"""
 
         AbstractFragment.__init__(self)
+        self._begin = None
+        self._end = None
         if element is None:
             element = _PseudoElement()
             assert begin is not None, "begin is required"
@@ -122,16 +132,35 @@ class AbstractNbeFragment (AbstractFragment, modeled.Modeled):
         return "Begin-End (%d,%d)" % (self.getBegin(), self.getEnd())
 
     def getBegin(self):
-        return long(self._getModel().getAttributeNS(None, 'begin'))
+        b = self._begin
+        if b is None:
+            b = self._begin = long(self._getModel().getAttributeNS(None, 'begin'))
+        return b
 
     def setBegin(self, value):
-        return self._getModel().setAttributeNS(None, 'begin', unicode(long(value)))
+        value = long(value)
+        self._begin = None
+        self._getModel().setAttributeNS(None, 'begin', unicode(value))
+        self._begin = value
+        self.__changed()
 
     def getEnd(self):
-        return long(self._getModel().getAttributeNS(None, 'end'))
+        e = self._end
+        if e is None:
+            e = self._end = long(self._getModel().getAttributeNS(None, 'end'))
+        return e
 
     def setEnd(self, value):
-        return self._getModel().setAttributeNS(None, 'end', unicode(long(value)))
+        value = long(value)
+        self._end = None
+        self._getModel().setAttributeNS(None, 'end', unicode(value))
+        self._end = value
+        self.__changed()
+
+    def __changed(self):
+        parent = self._getParent()
+        if parent is not None:
+            parent._dataChanged()
 
     def getDuration(self):
         return self.getEnd() - self.getBegin()
@@ -184,6 +213,8 @@ class ByteCountFragment(AbstractNbeFragment):
     """ByteCount fragment class.
     """
 
+    __slots__ = ()
+
     #
     # Static methods
     #
@@ -209,6 +240,8 @@ class MillisecondFragment(AbstractNbeFragment):
     Millisecond fragment class.
     """
 
+    __slots__ = ()
+
     #
     # Static methods
     #
@@ -38,6 +38,9 @@ class Modeled(object):
 
     __metaclass__ = auto_properties
 
+    # Subclasses which do not define __slots__ still have a __dict__
+    __slots__ = ('__model', '__parent')
+
     def __init__(self, element, parent):
         """The parameter element is the DOM model of this object.
         """
@@ -50,6 +53,11 @@ class Modeled(object):
         """
         return self.__model
 
+    def _setModel(self, element):
+        """Replace this object's model by an equivalent DOM element.
+        """
+        self.__model = element
+
     def _getParent(self):
         """Return this objects's parent (a Modeled instance, or None).
         """
@@ -66,20 +74,8 @@ class Modeled(object):
            since only Element children are returned (and not, for example,
            Text children or Comment children).
         """
-        source = self.__model.childNodes
-        i = 0
-        start = -1
-        r = []
-        for e in self.__model.childNodes:
-            if e.nodeType == ELEMENT_NODE:
-                if start == -1: start = i
-            else:
-                r = r + source[start:i]
-                start = -1
-            i += 1
-        if start != -1:
-            r = r + source[start:]
-        return r
+        return [ e for e in self.__model.childNodes
+                 if e.nodeType == ELEMENT_NODE ]
 
     def _getChild(self, match=None, before=None, after=None):
         """Looks for the first Element child matching the parameters.
@@ -125,6 +121,21 @@ class Modeled(object):
     def getOwnerPackage(self):
         return self._getParent().getOwnerPackage()
 
+    def _dataChanged(self):
+        """Inform the change listeners of the owner package that the
+        data of this object (fragment, content or tags) was modified.
+
+        The indexes built over the package register such listeners, so
+        that they are kept up-to-date even if no event is notified.
+        """
+        try:
+            p = self.getOwnerPackage()
+        except AttributeError:
+            # Unbounded object
+            return
+        for listener in getattr(p, '_change_listeners', ()):
+            listener(self)
+
     def getRootPackage(self):
         """
         Modeled which are not Importable rely on their parent for the access path.
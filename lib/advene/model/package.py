@@ -23,6 +23,7 @@ import os
 import sys
 import urllib
 import re
+from cStringIO import StringIO
 
 import xml.sax
 import xml.dom
@@ -41,6 +42,7 @@ import advene.model.view as view
 import advene.model.viewable as viewable
 from advene.model.zippackage import ZipPackage
 from advene.util.expat import PyExpat
+from advene.model.streamloader import StreamReader
 
 from advene.model.bundle import StandardXmlBundle, ImportBundle, InverseDictBundle, SumBundle
 from advene.model.constants import adveneNS, xmlNS, xmlnsNS, xlinkNS, dcNS
@@ -74,6 +76,9 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
            Providing None for the source parameter creates a new Package.
         """
         self.meta_cache={}
+        # Functions called with the elements whose data is modified
+        # (see Modeled._dataChanged)
+        self._change_listeners=[]
         if isinstance(uri, unicode):
             uri=uri.encode(sys.getfilesystemencoding())
         if re.match('[a-zA-Z]:', uri):
@@ -96,15 +101,17 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
         if source is None:
             element = self._make_model()
         else:
-            reader = PyExpat.Reader()
+            if config.data.preferences.get('package-lazy-load', True):
+                reader = StreamReader()
+            else:
+                reader = PyExpat.Reader()
             if source is _get_from_uri:
                 # Determine the package format (plain XML or AZP)
                 # FIXME: should be done by content rather than extension
                 if abs_uri.lower().endswith('.azp') or abs_uri.endswith('/'):
                     # Advene Zip Package. Do some magic.
                     self.__zip = ZipPackage(abs_uri)
-                    f=urllib.pathname2url(self.__zip.getContentsFile())
-                    element = reader.fromUri("file://" + f).documentElement
+                    element = self.__read_zip_contents(reader)
                 else:
                     element = reader.fromUri(abs_uri).documentElement
             elif hasattr(source, 'read'):
@@ -122,8 +129,7 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
                 if source_uri.lower().endswith('.azp') or source_uri.endswith('/'):
                     # Advene Zip Package. Do some magic.
                     self.__zip = ZipPackage(source_uri)
-                    f=urllib.pathname2url(self.__zip.getContentsFile())
-                    element = reader.fromUri("file://" + f).documentElement
+                    element = self.__read_zip_contents(reader)
                 else:
                     element = reader.fromUri(source_uri).documentElement
 
@@ -135,6 +141,19 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
         self.__relations = None
         self.__schemas = None
         self.__views = None
+        # id -> element index, built on demand
+        self.__id_index = None
+
+    def __read_zip_contents(self, reader):
+        """Parse the content.xml of the zip package.
+
+        It is read from the archive, without being extracted.
+        """
+        f = self.__zip.getContentsStream()
+        try:
+            return reader.fromStream(f).documentElement
+        finally:
+            f.close()
 
     def close(self):
         if self.__zip:
@@ -281,17 +300,58 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
         else:
             return self.__zip.getResources(package=self)
 
-    def get_element_by_id(self, i):
-        if not i:
-            return None
-        uri=self.uri
+    def __build_id_index(self):
+        """Build the index of the package's own elements, keyed by id.
+        """
+        index = {}
+        prefix = self.uri + '#'
+        n = len(prefix)
+        # In case of duplicate ids, the first bundle has precedence
         for m in (self.getSchemas, self.getViews, self.getAnnotationTypes,
                   self.getRelationTypes, self.getAnnotations, self.getQueries,
                   self.getRelations):
-            el=m().get( '#'.join( (uri, i) ), None )
-            if el is not None:
-                return el
-        return None
+            for uri, el in m().iteritems():
+                if uri.startswith(prefix):
+                    index.setdefault(uri[n:], el)
+        self.__id_index = index
+        return index
+
+    def _update_id_index(self, element, added=True):
+        """Update the id index after an element addition or removal.
+
+        It is called by the package bundles.
+        """
+        index = self.__id_index
+        if index is None:
+            return
+        if isinstance(element, schema.Schema):
+            # The schema types are also added or removed
+            self.__id_index = None
+            return
+        uri = element.getUri(absolute=True)
+        prefix = self.uri + '#'
+        if not uri.startswith(prefix):
+            return
+        i = uri[len(prefix):]
+        if added:
+            index.setdefault(i, element)
+        elif index.get(i) is element:
+            del index[i]
+
+    def get_element_ids(self):
+        """Return the ids of the package's own elements.
+        """
+        if self.__id_index is None:
+            self.__build_id_index()
+        return self.__id_index.keys()
+
+    def get_element_by_id(self, i):
+        if not i:
+            return None
+        index = self.__id_index
+        if index is None:
+            index = self.__build_id_index()
+        return index.get(i)
 
     def generate_statistics(self):
         """Generate the statistics.xml file.
@@ -338,10 +398,11 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
                 z.new()
                 self.__zip = z
 
-            # Save the content.xml
-            stream = open (self.__zip.getContentsFile(), "w")
+            # Save the content.xml. It is not rewritten if it did
+            # not change, so that it is not compressed again.
+            stream = StringIO()
             self.serialize(stream)
-            stream.close ()
+            self.__zip.update_file(u'content.xml', stream.getvalue())
 
             # Generate the statistics
             self.__zip.update_statistics(self)
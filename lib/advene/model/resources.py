@@ -24,8 +24,10 @@
       resources/: associated resources,
                   available through the TALES expression /package/advene/resources/...
 
+    The resources are accessed through the ZipPackage, which reads
+    them from the .azp file. They are extracted only when they are
+    modified or when their filename (file_, dir_) is needed.
 """
-import os
 import mimetypes
 import urllib
 import base64
@@ -52,7 +54,8 @@ class ResourceData(viewable.Viewable.withClass('data', 'getMimetype')):
         self.author=None
         self.date=None
 
-        self.file_ = self.package.tempfile('resources', resourcepath.replace('/', os.path.sep, -1) )
+        # Member name in the package
+        self.member = '/'.join( ('resources', resourcepath) )
         self._mimetype = None
         self.title = str(self)
 
@@ -62,17 +65,23 @@ class ResourceData(viewable.Viewable.withClass('data', 'getMimetype')):
     def getId(self):
         return self.resourcepath.split('/')[-1]
 
+    @property
+    def file_(self):
+        """Filename of the resource.
+
+        The resource is extracted from the package if necessary.
+        """
+        return self.package.extract_member(self.member)
+
     def getData(self):
-        return open(self.file_, 'rb').read()
+        return self.package.read_member(self.member)
 
     def setData(self, data):
-        f=open(self.file_, 'wb')
-        f.write(data)
-        f.close()
+        self.package.update_file(self.member, data)
 
     def getMimetype(self):
         if self._mimetype is None:
-            (mimetype, encoding) = mimetypes.guess_type(self.file_)
+            (mimetype, encoding) = mimetypes.guess_type(self.resourcepath)
             if mimetype is None:
                 mimetype = "text/plain"
             self._mimetype=mimetype
@@ -92,7 +101,7 @@ class ResourceData(viewable.Viewable.withClass('data', 'getMimetype')):
         return "%s#data_%s" % (self.package.uri, p)
 
     def getStream(self):
-        return open(self.file_, 'rb')
+        return self.package.open_member(self.member)
 
     def getDataBase64(self):
         data = self.getData()
@@ -117,17 +126,25 @@ class Resources:
         # Resource path name
         self.resourcepath = resourcepath
 
-        # Real directory
-        self.dir_ = self.package.tempfile( 'resources', resourcepath.replace('/', os.path.sep, -1) )
+        # Member name in the package
+        if resourcepath:
+            self.member = '/'.join( ('resources', resourcepath) )
+        else:
+            self.member = 'resources'
         self.filenames=None
         self.title = str(self)
 
+    @property
+    def dir_(self):
+        """Real directory of the resources.
+
+        The resources are extracted from the package if necessary.
+        """
+        return self.package.extract_member(self.member)
+
     def init_filenames(self):
         if self.filenames is None:
-            try:
-                self.filenames=os.listdir(self.dir_)
-            except OSError:
-                self.filenames=[]
+            self.filenames=self.package.listdir(self.member)
 
     def __str__(self):
         if self.resourcepath == "":
@@ -147,12 +164,11 @@ class Resources:
         return self.filenames
 
     def __contains__(self, key):
-        fname=os.path.join( self.dir_, key )
-        return os.path.exists(fname)
+        return self.package.exists('/'.join( (self.member, key) ))
 
     def __getitem__(self, key):
-        fname=os.path.join( self.dir_, key )
-        if not os.path.exists(fname):
+        name='/'.join( (self.member, key) )
+        if not self.package.exists(name):
             raise KeyError
 
         # resource path for the new resource
@@ -164,7 +180,7 @@ class Resources:
         if p in self._children_cache:
             return self._children_cache[p]
 
-        if os.path.isdir(fname):
+        if self.package.isdir(name):
             r=Resources(self.package, p, parent=self)
         else:
             # It is a file. Return its ResourceData
@@ -178,21 +194,17 @@ class Resources:
         To create a new directory, use item == Resources.DIRECTORY_TYPE
         """
         self.filenames = None
-        if not os.path.exists(self.dir_):
-            os.mkdir(self.dir_)
-        fname=os.path.join( self.dir_, key )
+        name='/'.join( (self.member, key) )
 
         if item == self.DIRECTORY_TYPE:
-            if os.path.exists(fname):
-                if not os.path.isdir(fname):
+            if self.package.exists(name):
+                if not self.package.isdir(name):
                     raise Exception("%s resource exists but is not a folder!" % key)
             else:
-                os.mkdir(fname)
+                self.package.mkdir(name)
         else:
             # Some content
-            f=open(fname, 'wb')
-            f.write(item)
-            f.close()
+            self.package.update_file(name, item)
 
 
     def __delitem__(self, key):
@@ -207,11 +219,7 @@ class Resources:
         except KeyError:
             pass
         self.filenames = None
-        fname=os.path.join( self.dir_, key )
-        if os.path.isdir(fname):
-            os.rmdir(fname)
-        else:
-            os.unlink(fname)
+        self.package.remove('/'.join( (self.member, key) ))
 
     def getUri (self):
         """Return the URI of the element.
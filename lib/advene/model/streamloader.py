@@ -0,0 +1,470 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Streaming package loader.
+
+The L{StreamReader} class has the same interface as the legacy
+PyExpat.Reader, but the annotations of the package are not converted
+into DOM trees. The XML source is scanned with the expat parser, and
+each annotation is represented by a L{LazyAnnotationElement}, which
+only keeps the byte range of the annotation in the raw source and a
+few values (attributes, fragment begin and end, content byte
+range). The rest of the document (schemas, views, relations...) is
+parsed into a standard DOM.
+
+Lazy elements answer the common read accesses (id, type, fragment,
+content data) without building any DOM node. Any other access
+(modification, traversal of children...) materializes the element:
+the XML snippet is parsed and the resulting DOM element replaces the
+lazy one in the document. Unmodified lazy elements are serialized by
+copying their raw source.
+"""
+
+from cStringIO import StringIO
+from urllib2 import urlopen
+from xml.parsers import expat
+import xml.dom.minidom
+
+from advene.model.constants import adveneNS, xmlnsNS, ELEMENT_NODE
+from advene.model.util.dom import printElementText
+
+# Names as reported by expat in namespace mode
+_PACKAGE = adveneNS + ' package'
+_ANNOTATIONS = adveneNS + ' annotations'
+_ANNOTATION = adveneNS + ' annotation'
+_CONTENT = adveneNS + ' content'
+_META = adveneNS + ' meta'
+_FRAGMENT = adveneNS + ' millisecond-fragment'
+
+# Target of the processing instructions temporarily replacing lazy elements
+_PI_TARGET = 'advene-lazy'
+
+def _key(namespaceURI, localName):
+    """Return the expat name of an attribute.
+    """
+    if namespaceURI:
+        return namespaceURI + ' ' + localName
+    else:
+        return localName
+
+class _SlotDict(object):
+    """Write-through mapping on the slots of a lazy element.
+
+    xml.dom.minidom sometimes directly updates the __dict__ of nodes.
+    """
+    __slots__ = ('obj', )
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __getitem__(self, key):
+        return getattr(self.obj, key)
+
+    def __setitem__(self, key, value):
+        setattr(self.obj, key, value)
+
+class Source(object):
+    """Raw XML data shared by the lazy elements of a document.
+    """
+    __slots__ = ('data', 'encoding', 'document')
+
+    def __init__(self, data, encoding='utf-8'):
+        self.data = data
+        self.encoding = encoding
+        self.document = None
+
+    def parse(self, start, end, namespaces=None):
+        """Parse the XML snippet data[start:end].
+
+        @param namespaces: (prefix, uri) namespace declarations in scope
+        @return: the DOM element, owned by a temporary document
+        """
+        decl = ''.join( ' xmlns:%s="%s"' % (prefix, uri) if prefix else ' xmlns="%s"' % uri
+                        for (prefix, uri) in (namespaces or ()) ).encode(self.encoding)
+        snippet = '<?xml version="1.0" encoding="%s"?><advene-lazy%s>%s</advene-lazy>' % (self.encoding,
+                                                                                        decl,
+                                                                                        self.data[start:end])
+        doc = xml.dom.minidom.parseString(snippet)
+        for n in doc.documentElement.childNodes:
+            if n.nodeType == ELEMENT_NODE:
+                return n
+        return None
+
+class LazyElement(object):
+    """Placeholder for a DOM element.
+
+    Known attributes are read from the compact representation. Any
+    other access is forwarded to the materialized DOM element.
+
+    Note that generic DOM traversal (childNodes,
+    getElementsByTagNameNS...) goes through this forwarding, and
+    thus materializes every lazy element it reaches. Code walking the
+    whole document defeats the lazy load, and should use the model
+    API instead.
+
+    Subclasses must implement L{materialize}.
+    """
+    __slots__ = ('_attributes', '_element')
+
+    nodeType = ELEMENT_NODE
+    namespaceURI = None
+    localName = None
+
+    def __init__(self, attributes):
+        self._attributes = attributes
+        self._element = None
+
+    @property
+    def __dict__(self):
+        return _SlotDict(self)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            element = self.materialize()
+        except NotImplementedError:
+            raise AttributeError("%s has no attribute %s" % (repr(self), name))
+        return getattr(element, name)
+
+    def __repr__(self):
+        return "<Lazy %s element at %s>" % (self.localName, hex(id(self)))
+
+    def materialize(self):
+        """Return the real DOM element, building it if necessary.
+
+        This method is abstract, and must be implemented by subclasses.
+
+        @raise NotImplementedError: if the subclass does not implement it
+        """
+        raise NotImplementedError("%s does not implement materialize" % self.__class__.__name__)
+
+    def is_materialized(self):
+        return self._element is not None
+
+    def getAttributeNS(self, namespaceURI, localName):
+        if self.is_materialized():
+            return self.materialize().getAttributeNS(namespaceURI, localName)
+        key = _key(namespaceURI, localName)
+        for (k, v) in self._attributes:
+            if k == key:
+                return v
+        return ""
+
+    def hasAttributeNS(self, namespaceURI, localName):
+        if self.is_materialized():
+            return self.materialize().hasAttributeNS(namespaceURI, localName)
+        key = _key(namespaceURI, localName)
+        for (k, v) in self._attributes:
+            if k == key:
+                return True
+        return False
+
+    def getAttributeNodeNS(self, namespaceURI, localName):
+        if self.is_materialized():
+            return self.materialize().getAttributeNodeNS(namespaceURI, localName)
+        if not self.hasAttributeNS(namespaceURI, localName):
+            return None
+        # Detached node, only meant for reading its value
+        attr = xml.dom.minidom.Attr(localName, namespaceURI, localName)
+        attr.value = self.getAttributeNS(namespaceURI, localName)
+        return attr
+
+class LazyChildElement(LazyElement):
+    """Placeholder for a child element (fragment, content) of a lazy annotation.
+    """
+    __slots__ = ('parent', 'namespaceURI', 'localName', 'start', 'end')
+
+    def __init__(self, parent, name, attributes, start=None, end=None):
+        LazyElement.__init__(self, attributes)
+        self.parent = parent
+        self.namespaceURI, self.localName = name.split(' ', 1)
+        self.start = start
+        self.end = end
+
+    @property
+    def ownerDocument(self):
+        return self.parent.ownerDocument
+
+    def is_materialized(self):
+        return self._element is not None or self.parent._element is not None
+
+    def materialize(self):
+        if self._element is None:
+            real = self.parent.materialize()
+            for n in real.childNodes:
+                if (n.nodeType == ELEMENT_NODE
+                    and n.namespaceURI == self.namespaceURI
+                    and n.localName == self.localName):
+                    self._element = n
+                    break
+            else:
+                raise AttributeError("Cannot find %s element in %s" % (self.localName, real))
+        return self._element
+
+    def getText(self):
+        """Return the text content of the element, utf-8 encoded.
+        """
+        if self.is_materialized() or self.start is None:
+            data = StringIO()
+            printElementText(self.materialize(), data)
+            return data.getvalue()
+        res = []
+        cdata = []
+        def characters(data):
+            # printElementText ignores CDATA sections
+            if not cdata:
+                res.append(data)
+        p = expat.ParserCreate()
+        p.CharacterDataHandler = characters
+        p.StartCdataSectionHandler = lambda: cdata.append(True)
+        p.EndCdataSectionHandler = cdata.pop
+        source = self.parent.source
+        p.Parse('<?xml version="1.0" encoding="%s"?>' % source.encoding, False)
+        p.Parse(source.data[self.start:self.end], True)
+        return u''.join(res).encode('utf-8')
+
+class LazyAnnotationElement(LazyElement):
+    """Placeholder for an annotation element.
+
+    @ivar source: the raw XML source
+    @type source: Source
+    @ivar start: start offset of the element in the source
+    @ivar end: end offset of the element in the source
+    @ivar fragment: (name, attributes) of the fragment element, or
+    False if the first element is not a fragment
+    @ivar content: (attributes, start, end) of the content element, or None
+    @ivar has_meta: True if the element has a meta child
+    @ivar owner: the Annotation using the element as model
+    """
+    __slots__ = ('source', 'start', 'end', 'fragment', 'content', 'has_meta', 'owner',
+                 'parentNode', 'previousSibling', 'nextSibling')
+
+    namespaceURI = adveneNS
+    localName = 'annotation'
+    tagName = nodeName = 'annotation'
+
+    def __init__(self, source, start, attributes):
+        LazyElement.__init__(self, attributes)
+        self.source = source
+        self.start = start
+        self.end = None
+        self.fragment = None
+        self.content = None
+        self.has_meta = False
+        self.owner = None
+        self.parentNode = None
+        self.previousSibling = None
+        self.nextSibling = None
+
+    @property
+    def ownerDocument(self):
+        return self.source.document
+
+    def get_fragment_element(self):
+        return LazyChildElement(self, self.fragment[0], self.fragment[1])
+
+    def get_content_element(self):
+        if self.content is None:
+            return None
+        attributes, start, end = self.content
+        return LazyChildElement(self, _CONTENT, attributes, start, end)
+
+    def get_namespaces(self):
+        """Return the namespace declarations in scope.
+        """
+        res = []
+        seen = set()
+        node = self.parentNode
+        while node is not None and node.nodeType == ELEMENT_NODE:
+            for i in xrange(node.attributes.length):
+                a = node.attributes.item(i)
+                if a.namespaceURI != xmlnsNS:
+                    continue
+                prefix = a.localName if a.prefix else None
+                if prefix not in seen:
+                    seen.add(prefix)
+                    res.append( (prefix, a.value) )
+            node = node.parentNode
+        return res
+
+    def materialize(self):
+        """Build the DOM element and put it in place of the lazy one.
+        """
+        if self._element is not None:
+            return self._element
+        doc = self.source.document
+        parsed = self.source.parse(self.start, self.end, self.get_namespaces())
+        element = doc.importNode(parsed, True)
+        self._element = element
+        parent = self.parentNode
+        if parent is not None:
+            # Replace the lazy element by the real one
+            children = parent.childNodes
+            i = children.index(self)
+            children[i] = element
+            element.parentNode = parent
+            element.previousSibling = self.previousSibling
+            element.nextSibling = self.nextSibling
+            if self.previousSibling is not None:
+                self.previousSibling.nextSibling = element
+            if self.nextSibling is not None:
+                self.nextSibling.previousSibling = element
+            self.parentNode = self.previousSibling = self.nextSibling = None
+        if self.owner is not None:
+            self.owner._setModel(element)
+        return element
+
+    def writexml(self, writer, indent="", addindent="", newl=""):
+        if self._element is not None:
+            return self._element.writexml(writer, indent, addindent, newl)
+        writer.write(indent)
+        writer.write(self.source.data[self.start:self.end].decode(self.source.encoding))
+        writer.write(newl)
+
+class _Scanner(object):
+    """Expat handler building the lazy annotation elements.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.stack = []
+        self.current = None
+        self.elements = []
+        # Used to share identical attribute values (types, dates...)
+        self.values = {}
+
+    def intern_attributes(self, attrs):
+        values = self.values
+        return tuple( (k, v if k == 'id' else values.setdefault(v, v))
+                      for (k, v) in attrs.iteritems() )
+
+    def xml_decl(self, version, encoding, standalone):
+        if encoding:
+            self.source.encoding = encoding
+
+    def start(self, name, attrs):
+        stack = self.stack
+        current = self.current
+        if current is not None:
+            if len(stack) == 3:
+                # Direct child of the annotation
+                if name == _META:
+                    current.has_meta = True
+                elif current.fragment is None:
+                    # The fragment is the first element after meta
+                    if name == _FRAGMENT:
+                        current.fragment = (name, self.intern_attributes(attrs))
+                    else:
+                        current.fragment = False
+                elif name == _CONTENT and current.content is None:
+                    current.content = (self.intern_attributes(attrs), self.parser.CurrentByteIndex, None)
+        elif (name == _ANNOTATION and len(stack) == 2
+              and stack[0] == _PACKAGE and stack[1] == _ANNOTATIONS):
+            self.current = LazyAnnotationElement(self.source, self.parser.CurrentByteIndex, self.intern_attributes(attrs))
+        stack.append(name)
+
+    def end(self, name):
+        stack = self.stack
+        stack.pop()
+        current = self.current
+        if current is None:
+            return
+        if len(stack) == 2:
+            # End of the annotation element
+            current.end = self.source.data.index('>', self.parser.CurrentByteIndex) + 1
+            if current.fragment:
+                self.elements.append(current)
+            self.current = None
+        elif len(stack) == 3 and name == _CONTENT and current.content[2] is None:
+            attributes, start, end = current.content
+            current.content = (attributes, start, self.source.data.index('>', self.parser.CurrentByteIndex) + 1)
+
+    def scan(self):
+        p = expat.ParserCreate(namespace_separator=' ')
+        p.StartElementHandler = self.start
+        p.EndElementHandler = self.end
+        p.XmlDeclHandler = self.xml_decl
+        self.parser = p
+        p.Parse(self.source.data, True)
+        self.parser = None
+        return self.elements
+
+def parse(data):
+    """Parse the XML data, with lazy annotation elements.
+
+    @param data: the XML source
+    @type data: str
+    @return: the DOM document
+    """
+    source = Source(data)
+    elements = _Scanner(source).scan()
+    if not elements:
+        doc = xml.dom.minidom.parseString(data)
+        source.document = doc
+        return doc
+
+    # Parse the document, each lazy annotation being replaced by a
+    # processing instruction.
+    pieces = []
+    pos = 0
+    for i, e in enumerate(elements):
+        pieces.append(data[pos:e.start])
+        pieces.append('<?%s %d?>' % (_PI_TARGET, i))
+        pos = e.end
+    pieces.append(data[pos:])
+    doc = xml.dom.minidom.parseString(''.join(pieces))
+    del pieces
+    source.document = doc
+
+    # Put the lazy elements in place of the processing instructions
+    for parent in doc.documentElement.childNodes:
+        if (parent.nodeType != ELEMENT_NODE
+            or parent.namespaceURI != adveneNS
+            or parent.localName != 'annotations'):
+            continue
+        children = parent.childNodes
+        for i, n in enumerate(children):
+            if n.nodeType == n.PROCESSING_INSTRUCTION_NODE and n.target == _PI_TARGET:
+                e = elements[int(n.data)]
+                e.parentNode = parent
+                children[i] = e
+        prev = None
+        for n in children:
+            n.previousSibling = prev
+            if prev is not None:
+                prev.nextSibling = n
+            prev = n
+        if prev is not None:
+            prev.nextSibling = None
+    return doc
+
+class StreamReader:
+    """Reader with the same interface as the legacy PyExpat.Reader.
+    """
+    def fromUri(self, uri):
+        f = urlopen(uri)
+        try:
+            return parse(f.read())
+        finally:
+            f.close()
+
+    def fromStream(self, source):
+        return parse(source.read())
+
+    def fromString(self, s):
+        return parse(s)
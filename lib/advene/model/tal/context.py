@@ -17,8 +17,12 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 #
 import sys
+import time
+import threading
+import hashlib
 
 from cStringIO import StringIO
+from collections import OrderedDict
 
 from simpletal import simpleTAL
 from simpletal import simpleTALES
@@ -55,6 +59,110 @@ class DebugLogger:
             if self.verbosity > 0:
                 print >>sys.stderr, "TAL: Critical:", args
 
+class TemplateCache:
+        """Process-wide cache of compiled TAL templates.
+
+        Templates are stored by (kind, source digest), where kind is
+        'html' or 'xml'. When they come from a view, they are also
+        associated to a name (the view URI), so that they can be
+        invalidated when the view is modified or deleted, and so that
+        compile and expand times can be reported per view.
+        """
+        # Maximum number of cached templates
+        size = 100
+
+        def __init__(self):
+                self.templates = OrderedDict()
+                # name -> set of keys
+                self.names = {}
+                # name -> [compilations, compile time, expansions, expand time, max expand time]
+                self.statistics = {}
+                self.lock = threading.Lock()
+
+        def get_statistics(self, name):
+                s = self.statistics.get(name)
+                if s is None:
+                        s = self.statistics[name] = [ 0, 0.0, 0, 0.0, 0.0 ]
+                return s
+
+        def compile(self, source, kind, log=None):
+                if kind == 'html':
+                        compiler = simpleTAL.HTMLTemplateCompiler ()
+                        compiler.log = log
+                        compiler.parseTemplate (StringIO (source), 'utf-8')
+                else:
+                        compiler = simpleTAL.XMLTemplateCompiler ()
+                        compiler.log = log
+                        compiler.parseTemplate (StringIO (source))
+                return compiler.getTemplate ()
+
+        def get(self, source, kind, name=None, log=None):
+                """Return the compiled template for source.
+
+                @param source: the template source
+                @type source: str
+                @param kind: 'html' or 'xml'
+                @param name: the name of the template (view URI), if any
+                @return: the compiled template
+                """
+                key = (kind, hashlib.md5(source).digest())
+                with self.lock:
+                        template = self.templates.pop(key, None)
+                        if template is not None:
+                                # Move to the most recently used position
+                                self.templates[key] = template
+                                return template
+                t = time.time()
+                template = self.compile(source, kind, log)
+                t = time.time() - t
+                with self.lock:
+                        self.templates[key] = template
+                        if name is not None:
+                                self.names.setdefault(name, set()).add(key)
+                                s = self.get_statistics(name)
+                                s[0] += 1
+                                s[1] += t
+                        while len(self.templates) > self.size:
+                                self.templates.popitem(last=False)
+                return template
+
+        def record_expand(self, name, duration):
+                with self.lock:
+                        s = self.get_statistics(name)
+                        s[2] += 1
+                        s[3] += duration
+                        s[4] = max(s[4], duration)
+
+        def invalidate(self, name):
+                """Remove the templates compiled for the given name.
+                """
+                with self.lock:
+                        for key in self.names.pop(name, ()):
+                                self.templates.pop(key, None)
+
+        def clear(self):
+                with self.lock:
+                        self.templates.clear()
+                        self.names.clear()
+
+        def dump_statistics(self):
+                """Return the template statistics, slowest expansion first.
+
+                @return: a list of lines, one per template name
+                @rtype: list
+                """
+                res = []
+                for name, (compiled, ctime, expanded, etime, emax) in sorted(self.statistics.iteritems(),
+                                                                             key=lambda i: i[1][3],
+                                                                             reverse=True):
+                        res.append("%s: %d compilations, %.3fms average, %d expansions, %.3fms average, %.3fms max" % (
+                                name,
+                                compiled, 1000 * ctime / max(compiled, 1),
+                                expanded, 1000 * etime / max(expanded, 1), 1000 * emax))
+                return res
+
+template_cache = TemplateCache()
+
 class NoCallVariable(simpleTALES.ContextVariable):
         """Not callable variable.
 
@@ -72,9 +180,33 @@ class _advene_context (simpleTALES.Context):
        the object to which it is applied, it is searched in a set of Methods
        contained in the context."""
 
+    # Roots whose value only depends on the evaluated package
+    pure_roots = ('here', 'package', 'view', 'request', 'nothing', 'default', 'repeat', 'attrs')
+    # Pure keys of the options root
+    pure_options = ('package_url', 'namespace_prefix')
+
+    # If set to a list, the reasons why the evaluation depends on
+    # data which is not stored in the package (player, imagecache,
+    # other packages, configuration, random values...) are appended
+    # to it. See mark_volatile.
+    volatile = None
+
     def __init__ (self, options):
         simpleTALES.Context.__init__(self, options, allowPythonPath=True)
 
+    def mark_volatile(self, reason):
+        """Indicate that the result of the evaluation is volatile.
+
+        @param reason: the path element or method which makes it volatile
+        @type reason: string
+        """
+        if self.volatile is not None:
+            self.volatile.append(reason)
+
+    def evaluatePython (self, expr):
+        self.mark_volatile('python:')
+        return simpleTALES.Context.evaluatePython(self, expr)
+
     def wrap_method(self, method):
         return simpleTALES.PathFunctionVariable(method)
 
@@ -101,7 +233,10 @@ class _advene_context (simpleTALES.Context):
 
         if self.methods.has_key(path):
             #print "Evaluating %s on %s" % (path, obj)
-            val = self.methods[path](obj, self)
+            method = self.methods[path]
+            if not getattr(method, 'pure', False):
+                self.mark_volatile(path)
+            val = method(obj, self)
             # If the result is None, the method is not appliable
             # and we should try other access ways (attributes,...) on the
             # object
@@ -155,6 +290,13 @@ class _advene_context (simpleTALES.Context):
                         val = self.locals[path]
                 elif self.globals.has_key(path):
                         val = self.globals[path]
+                        if self.volatile is None:
+                                pass
+                        elif path == 'options':
+                                if len(pathList) < 2 or pathList[1] not in self.pure_options:
+                                        self.mark_volatile('/'.join(pathList[:2]))
+                        elif path not in self.pure_roots:
+                                self.mark_volatile(path)
                 else:
                         # If we can't find it then raise an exception
                         raise simpleTALES.PATHNOTFOUNDEXCEPTION
@@ -192,6 +334,10 @@ class _advene_context (simpleTALES.Context):
                         if val is not None:
                                 pass
                         elif (hasattr (temp, path)):
+                                if not hasattr (temp.__class__, path):
+                                        # Instance attribute (for
+                                        # instance package/imagecache)
+                                        self.mark_volatile(path)
                                 val = getattr (temp, path)
                         else:
                                 try:
@@ -230,6 +376,9 @@ class _advene_context (simpleTALES.Context):
 
 class AdveneContext(_advene_context):
 
+    # Cached table of the default methods
+    _default_methods = None
+
     def defaultMethods():
         return [ n
             for n in dir(global_methods)
@@ -238,6 +387,18 @@ class AdveneContext(_advene_context):
 
     defaultMethods = staticmethod(defaultMethods)
 
+    def defaultMethodTable():
+        """Return the name -> function table of the default methods.
+
+        It is computed only once, and must not be modified.
+        """
+        if AdveneContext._default_methods is None:
+            AdveneContext._default_methods = dict( (n, global_methods.__dict__[n])
+                                                   for n in AdveneContext.defaultMethods() )
+        return AdveneContext._default_methods
+
+    defaultMethodTable = staticmethod(defaultMethodTable)
+
     def __str__ (self):
         return u"<pre>AdveneContext\nGlobals:\n\t%s\nLocals:\n\t%s</pre>" % (
                 "\n\t".join([ "%s: %s" % (k, unicode(v).replace("<", "&lt;"))
@@ -246,19 +407,23 @@ class AdveneContext(_advene_context):
                               for k, v in self.locals.iteritems() ]))
 
 
-    def __init__(self, here, options=None):
+    def __init__(self, here, options=None, methods=None):
         """Creates a tales.AdveneContext object, having a global symbol 'here'
            with value 'here' and a global symbol 'options' where all the key-
            value pairs of parameter 'options' are copied. Of course, it also
            has all the standard TALES global symbols.
+
+           The optional methods parameter is a name -> function table,
+           which is copied into the context. It defaults to the
+           default methods (see defaultMethodTable).
         """
         if options is None:
                 options={}
         _advene_context.__init__(self, dict(options)) # *copy* dict 'options'
-        self.methods = {}
+        if methods is None:
+            methods = self.defaultMethodTable()
+        self.methods = dict(methods)
         self.addGlobal('here', here)
-        for dm_name in self.defaultMethods():
-            self.addMethod(dm_name, global_methods.__dict__[dm_name])
         # FIXME: debug
         self.log = DebugLogger()
 
@@ -271,30 +436,36 @@ class AdveneContext(_advene_context):
         else:
             raise AdveneTalesException("%s is not a valid method" % function)
 
-    def interpret (self, view_source, mimetype, stream=None):
+    def interpret (self, view_source, mimetype, stream=None, name=None):
         """
         Interpret the TAL template available through the stream view_source,
         with the mime-type mimetype, and print the result to the stream
         "stream". The stream is returned. If stream is not given or None, a
         StringIO will be created and returned.
+
+        Compiled templates are cached. The optional name (for
+        instance the view URI) is used to invalidate them and to
+        gather timing statistics.
         """
         if stream is None:
             stream = StringIO ()
 
-        if isinstance (view_source, str) or isinstance (view_source, unicode):
-            view_source = StringIO (unicode(view_source))
+        if not isinstance (view_source, basestring):
+            view_source = view_source.read ()
+        if isinstance (view_source, unicode):
+            view_source = view_source.encode ('utf-8')
 
         kw = {}
         if mimetype is None or mimetype.startswith('text/'):
-            compiler = simpleTAL.HTMLTemplateCompiler ()
-            compiler.log = self.log
-            compiler.parseTemplate (view_source, 'utf-8')
+            kind = 'html'
         else:
-            compiler = simpleTAL.XMLTemplateCompiler ()
-            compiler.log = self.log
-            compiler.parseTemplate (view_source)
+            kind = 'xml'
             kw["suppressXMLDeclaration"] = 1
-        compiler.getTemplate ().expand (context=self, outputFile=stream, outputEncoding='utf-8', **kw)
+        template = template_cache.get (view_source, kind, name, self.log)
+        t = time.time ()
+        template.expand (context=self, outputFile=stream, outputEncoding='utf-8', **kw)
+        if name is not None:
+            template_cache.record_expand (name, time.time () - t)
 
         return stream
 
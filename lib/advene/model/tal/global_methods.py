@@ -23,6 +23,10 @@ Note that those method must import every module they need _inside_ their body in
 order to prevent cyclic references.
 
 If called on an invalid target, the method should return None.
+
+Methods whose result only depends on the target and on the package
+data are declared pure (see the end of the module). The webserver only
+caches the responses which use pure methods.
 """
 def absolute_url(target, context):
     """Return the absolute URL of the element.
@@ -621,3 +625,12 @@ def json(target, context):
         # json is standard in 2.6. For python <= 2.5, hope that simplejson is installed.
         from simplejson import dumps
     return dumps(target, skipkeys=True, ensure_ascii=False, sort_keys=True, indent=4)
+
+# Pure methods. Others (snapshot_url, player_url, randompick,
+# representation, color) depend on the controller, its configuration
+# or on random values.
+for _method in (absolute_url, isa, meta, view, formatted, first, last, rest,
+                query, sorted, length, old_related, tag_color,
+                transition_fix_ns, transition_fix_date, urlquote, json):
+    _method.pure = True
+del _method
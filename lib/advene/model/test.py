@@ -24,6 +24,8 @@ sys.path.insert(0, ".")
 from advene.util.expat import PyExpat
 
 from modeled import Modeled
+from advene.model.package import Package
+from advene.model.fragment import MillisecondFragment
 
 class ModeledTestCase(unittest.TestCase):
 
@@ -192,8 +194,49 @@ class ModeledTestCase(unittest.TestCase):
         self.assertEqual(e,None)
 
 
+class IdIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        p = self.package = Package(uri='new_pkg', source=None)
+        s = p.createSchema(ident='s')
+        p.schemas.append(s)
+        at = s.createAnnotationType(ident='at')
+        s.annotationTypes.append(at)
+        rt = s.createRelationType(ident='rt')
+        s.relationTypes.append(rt)
+        self.a1 = p.createAnnotation(type=at, ident='a1',
+                                     fragment=MillisecondFragment(begin=0, end=10))
+        p.annotations.append(self.a1)
+        self.a2 = p.createAnnotation(type=at, ident='a2',
+                                     fragment=MillisecondFragment(begin=10, end=20))
+        p.annotations.append(self.a2)
+        self.relation = p.createRelation(type=rt, ident='r1',
+                                         members=(self.a1, self.a2))
+        p.relations.append(self.relation)
+
+    def test_get_element_by_id(self):
+        self.assert_(self.package.get_element_by_id('a1') is self.a1)
+        self.assert_(self.package.get_element_by_id('r1') is self.relation)
+        self.assertEqual(self.package.get_element_by_id('unknown'), None)
+
+    def test_remove_annotation(self):
+        self.package.get_element_by_id('a2')
+        self.package.annotations.remove(self.a2)
+        self.assertEqual(self.package.get_element_by_id('a2'), None)
+
+    def test_remove_member(self):
+        # Removing a relation member must not remove the annotation
+        self.package.get_element_by_id('a1')
+        del self.relation.members[0]
+        self.assert_(self.package.get_element_by_id('a1') is self.a1)
+        self.relation.members.append(self.a1)
+        self.assert_(self.package.get_element_by_id('a1') is self.a1)
+
 
 if __name__ == "__main__":
-    testsuite = unittest.defaultTestLoader.loadTestsFromTestCase(ModeledTestCase)
+    testsuite = unittest.TestSuite([
+            unittest.defaultTestLoader.loadTestsFromTestCase(ModeledTestCase),
+            unittest.defaultTestLoader.loadTestsFromTestCase(IdIndexTestCase),
+            ])
     testrunner = unittest.TextTestRunner()
     testrunner.run(testsuite)
@@ -59,6 +59,8 @@ class Viewable(object):
 
     __metaclass__ = auto_properties
 
+    __slots__ = ()
+
     def __init__(self):
         object.__init__(self)
 
@@ -71,6 +73,8 @@ class Viewable(object):
         """
         if viewable_class not in Viewable.__subclasses:
             class ViewableWithClass(Viewable):
+                __slots__ = ()
+
                 # getViewableClass is a static method,
                 # so a class inheriting Viewable knows its viewable class
                 def getViewableClass():
@@ -153,7 +157,7 @@ class Viewable(object):
         context.pushLocals()
         context.setLocal('here', self)
         context.setLocal('view', view)
-        context.interpret(view_source, mimetype, result)
+        context.interpret(view_source, mimetype, result, name=view.getUri(absolute=True))
         context.popLocals ()
         s=TypedUnicode(result.getvalue())
         s.contenttype=view.getContent().getMimetype()
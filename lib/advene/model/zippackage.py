@@ -54,6 +54,11 @@ import tempfile
 import re
 import shutil
 import urllib
+import struct
+import copy
+import errno
+import itertools
+import zlib
 from advene.model.exception import AdveneException
 from advene.model.resources import Resources
 import mimetypes
@@ -75,6 +80,34 @@ MIMETYPE='application/x-advene-zip-package'
 MANIFEST="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0"
 ET._namespace_map[MANIFEST]='manifest'
 
+# Mimetype prefixes of the members which are stored uncompressed,
+# since their data is usually already compressed
+STORED_MIMETYPES=('video/', 'audio/', 'image/',
+                  'application/zip', 'application/ogg', 'application/x-gzip')
+
+# Copying the compressed data of a member without recompressing it
+# relies on zipfile internals (local header layout, fp attributes,
+# _didModify) which are those of python 2.7. Other versions use
+# ZipFile.writestr.
+RAW_COPY=(sys.version_info[:2] == (2, 7)
+          and all(hasattr(zipfile, n) for n in ('structFileHeader', 'stringFileHeader',
+                                                'sizeFileHeader', '_FH_SIGNATURE',
+                                                '_FH_FILENAME_LENGTH',
+                                                '_FH_EXTRA_FIELD_LENGTH')))
+
+def _strip_zip64_extra(extra):
+    """Remove the ZIP64 fields from a zip extra data string.
+
+    They are generated again (if necessary) when writing the member.
+    """
+    res=[]
+    while len(extra) >= 4:
+        tp, ln = struct.unpack('<HH', extra[:4])
+        if tp != 1:
+            res.append(extra[:4+ln])
+        extra=extra[4+ln:]
+    return "".join(res)
+
 class ZipPackage:
     # Global method for cleaning up
     tempdir_list = []
@@ -100,6 +133,23 @@ class ZipPackage:
         # Temp. directory, a unicode string
         self._tempdir = None
         self.file_ = None
+        # Zip file the package was opened from (or last saved to)
+        self._archive = None
+        # Opened ZipFile for self._archive
+        self._zipfile = None
+        # ZipInfo of the archive file members, indexed by member
+        # name. Members are extracted to the temp. directory only
+        # when they are modified or when their path is needed.
+        self._index = {}
+        # Explicit directory entries of the archive
+        self._dirs = set()
+        # Cache for the directories of the archive members
+        self._dircache = None
+        # (size, mtime) of the extracted members, indexed by member
+        # name, used to detect modified members.
+        self._members = {}
+        # Members written through update_file since the last save
+        self._modified = set()
 
         if uri:
             # os.stat seems to not grok unicode pathnames with
@@ -140,10 +190,20 @@ class ZipPackage:
     def getContentsFile(self):
         """Return the path to the real XML file.
 
+        The file is extracted from the archive if necessary. Use
+        L{getContentsStream} to read it without extracting it.
+
         @return: the XML filename
         @rtype: string
         """
-        return self.tempfile(u'content.xml')
+        return self.extract_member(u'content.xml')
+
+    def getContentsStream(self):
+        """Return a stream on the XML data.
+
+        @return: a file-like object
+        """
+        return self.open_member(u'content.xml')
 
     def tempfile(self, *names):
         """Return a tempfile name in the filesystem encoding.
@@ -157,6 +217,261 @@ class ZipPackage:
         """
         return os.path.join(self._tempdir, *names).encode(_fs_encoding)
 
+    def _stat(self, fname):
+        st=os.stat(fname)
+        return (st.st_size, st.st_mtime)
+
+    def _crc(self, fname):
+        """Return the CRC32 of the given file, as stored in zip files.
+        """
+        crc=0
+        f=open(fname, 'rb')
+        try:
+            while True:
+                data=f.read(1 << 20)
+                if not data:
+                    break
+                crc=zlib.crc32(data, crc)
+        finally:
+            f.close()
+        return crc & 0xffffffff
+
+    def _name(self, name):
+        """Normalize a member name to a unicode string.
+        """
+        if isinstance(name, str):
+            name=unicode(name, _fs_encoding)
+        return name.strip(u'/')
+
+    def _path(self, name):
+        """Return the temp. directory path of a member.
+        """
+        if not name:
+            return self.tempfile()
+        return self.tempfile(*name.split(u'/'))
+
+    def _archive_file(self):
+        """Return the ZipFile of the archive, opening it if necessary.
+        """
+        if self._zipfile is None:
+            self._zipfile=zipfile.ZipFile(self._archive, 'r')
+        return self._zipfile
+
+    def _close_archive(self):
+        if self._zipfile is not None:
+            self._zipfile.close()
+            self._zipfile=None
+
+    def _read_index(self, z):
+        """Index the members of the given zip file.
+        """
+        self._index={}
+        self._dirs=set()
+        self._dircache=None
+        for info in z.infolist():
+            name=info.filename
+            if isinstance(name, str):
+                name=unicode(name, 'utf-8', 'replace')
+            if name.endswith(u'/'):
+                self._dirs.add(name.strip(u'/'))
+            else:
+                self._index[name]=info
+
+    def _archive_dirs(self):
+        """Return the set of directories of the archive members.
+        """
+        if self._dircache is None:
+            dirs=set(self._dirs)
+            for name in self._index:
+                l=name.split(u'/')[:-1]
+                while l:
+                    dirs.add(u'/'.join(l))
+                    l.pop()
+            self._dircache=dirs
+        return self._dircache
+
+    def _archive_children(self, name):
+        """Return the archive members below the given directory.
+        """
+        if not name:
+            return self._index.keys()
+        prefix=name + u'/'
+        return [ n for n in self._index if n.startswith(prefix) ]
+
+    def exists(self, name):
+        """Check wether the given member (file or directory) exists.
+
+        @param name: the member name (with / as path separator)
+        @type name: unicode
+        """
+        name=self._name(name)
+        return (name in self._index
+                or name in self._archive_dirs()
+                or os.path.exists(self._path(name)))
+
+    def isdir(self, name):
+        """Check wether the given member is a directory.
+        """
+        name=self._name(name)
+        if name in self._index:
+            return False
+        return name in self._archive_dirs() or os.path.isdir(self._path(name))
+
+    def listdir(self, name):
+        """Return the names of the members of the given directory.
+
+        @param name: the directory name (with / as path separator)
+        @type name: unicode
+        @return: the list of names
+        @rtype: list of unicode strings
+        """
+        name=self._name(name)
+        res=set()
+        try:
+            for n in os.listdir(self._path(name)):
+                if isinstance(n, str):
+                    n=unicode(n, _fs_encoding)
+                res.add(n)
+        except OSError:
+            pass
+        if name:
+            prefix=name + u'/'
+        else:
+            prefix=u''
+        for n in itertools.chain(self._index, self._dirs):
+            if n.startswith(prefix) and n != name:
+                res.add(n[len(prefix):].split(u'/')[0])
+        return sorted(res)
+
+    def open_member(self, name):
+        """Return a stream on the data of the given member.
+
+        The data is read from the archive if the member was not
+        extracted.
+
+        @param name: the member name (with / as path separator)
+        @type name: unicode
+        @return: a file-like object
+        """
+        name=self._name(name)
+        fname=self._path(name)
+        if name in self._index and not os.path.exists(fname):
+            return self._archive_file().open(self._index[name])
+        return open(fname, 'rb')
+
+    def read_member(self, name):
+        """Return the data of the given member.
+        """
+        f=self.open_member(name)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def extract_member(self, name):
+        """Extract the given member to the temp. directory.
+
+        A directory is extracted with all its contents. Nothing is
+        done if the member is already extracted.
+
+        @param name: the member name (with / as path separator)
+        @type name: unicode
+        @return: the path of the extracted file or directory
+        @rtype: string
+        """
+        name=self._name(name)
+        fname=self._path(name)
+        if name in self._index:
+            members=[ name ]
+        elif self.isdir(name):
+            members=self._archive_children(name)
+            if not os.path.isdir(fname):
+                os.makedirs(fname)
+        else:
+            return fname
+        for n in members:
+            path=self._path(n)
+            if os.path.exists(path):
+                continue
+            d=os.path.dirname(path)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            source=self._archive_file().open(self._index[n])
+            outfile=open(path, 'wb')
+            try:
+                shutil.copyfileobj(source, outfile, 1 << 20)
+            finally:
+                outfile.close()
+                source.close()
+            self._members[n]=self._stat(path)
+        return fname
+
+    def mkdir(self, name):
+        """Create a directory member.
+        """
+        fname=self._path(self._name(name))
+        if not os.path.isdir(fname):
+            os.makedirs(fname)
+
+    def remove(self, name):
+        """Remove the given member.
+
+        @param name: the member name (with / as path separator)
+        @type name: unicode
+        @raise OSError: if the member does not exist, or is a non-empty directory
+        """
+        name=self._name(name)
+        fname=self._path(name)
+        if self.isdir(name):
+            if self.listdir(name):
+                raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), fname)
+            if os.path.isdir(fname):
+                os.rmdir(fname)
+            self._dirs.discard(name)
+        elif name in self._index:
+            if os.path.exists(fname):
+                os.unlink(fname)
+            # Keep the containing directory, as in the filesystem
+            if u'/' in name:
+                self._dirs.add(name.rsplit(u'/', 1)[0])
+        else:
+            os.unlink(fname)
+        self._index.pop(name, None)
+        self._members.pop(name, None)
+        self._modified.discard(name)
+        self._dircache=None
+
+    def update_file(self, name, data):
+        """Update a member file with the given data.
+
+        The file is not written if its contents is the same, so that
+        the member is not considered as modified on save.
+
+        @param name: the member name (with / as path separator)
+        @type name: unicode
+        @param data: the data
+        @type data: string
+        @return: True if the file was written
+        """
+        name=self._name(name)
+        fname=self._path(name)
+        if os.path.exists(fname):
+            size=os.path.getsize(fname)
+        elif name in self._index:
+            size=self._index[name].file_size
+        else:
+            size=None
+        if size == len(data) and self.read_member(name) == data:
+            return False
+        d=os.path.dirname(fname)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        f=open(fname, 'wb')
+        f.write(data)
+        f.close()
+        self._modified.add(name)
+        return True
+
     def new(self):
         """Prepare a new AZP expanded package.
         """
@@ -167,57 +482,44 @@ class ZipPackage:
 
         os.mkdir(self.tempfile(u'resources'))
 
-    def extract(self, fname):
-        """Extract the zip file to a temporary directory.
+    def open_archive(self, fname):
+        """Open the zip file without extracting it.
+
+        The members are read from the zip file, and extracted to a
+        temporary directory only when needed.
 
         Return the temporary directory name.
         """
+        self._close_archive()
         z=zipfile.ZipFile(fname, 'r')
 
-        def recursive_mkdir(d):
-            parent=os.path.dirname(d)
-            if not os.path.exists(parent):
-                recursive_mkdir(parent)
-            os.mkdir(d)
-
         # Check the validity of mimetype
         try:
             typ = z.read('mimetype')
         except KeyError:
-            raise AdveneException(_("File %s is not an Advene zip package.") % self.file_)
+            typ = None
         if typ != MIMETYPE:
+            z.close()
             raise AdveneException(_("File %s is not an Advene zip package.") % self.file_)
 
-        # The file is an advene zip package. We can extract its contents
-        # to a temporary directory
+        self._zipfile=z
+        self._archive=fname
+        self._members={}
+        self._modified=set()
+        self._read_index(z)
+
         self._tempdir=unicode(tempfile.mkdtemp('', 'adv'), _fs_encoding)
         os.mkdir(self.tempfile(u'resources'))
         self.tempdir_list.append(self._tempdir)
+        return self._tempdir
 
-        # FIXME: check the portability (convert / to os.path.sep ?)
-        for name in z.namelist():
-            if name.endswith('/'):
-                # It is a directory name. Strip the trailing /, so
-                # that os.path.dirname(name) really returns the
-                # containing directory
-                name=name[:-1]
-                d=self.tempfile(name)
-                if not os.path.exists(d):
-                    recursive_mkdir(d)
-            else:
-                fname=self.tempfile(name)
-                if not os.path.isdir(os.path.dirname(fname)):
-                    recursive_mkdir(os.path.dirname(fname))
-                outfile = open(fname, 'wb')
-                outfile.write(z.read(name))
-                outfile.close()
-
-        z.close()
+    def extract(self, fname):
+        """Extract the zip file to a temporary directory.
 
-        # Create the resources directory if necessary
-        resource_dir = self.tempfile(u'resources' )
-        if not os.path.exists(resource_dir):
-            os.mkdir(resource_dir)
+        Return the temporary directory name.
+        """
+        self.open_archive(fname)
+        self.extract_member(u'')
         return self._tempdir
 
     def open(self, fname=None):
@@ -242,21 +544,104 @@ class ZipPackage:
             if typ != MIMETYPE:
                 raise AdveneException(_("Directory %s is not an extracted Advene zip package.") % fname)
         else:
-            self._tempdir=self.extract(fname)
+            self._tempdir=self.open_archive(fname)
 
         # FIXME: Check against the MANIFEST file
-        for (name, mimetype) in self.manifest_to_list(self.tempfile(u'META-INF', u'manifest.xml')):
+        f=self.open_member(u'META-INF/manifest.xml')
+        try:
+            manifest=self.manifest_to_list(f)
+        finally:
+            f.close()
+        for (name, mimetype) in manifest:
             if name == u'/':
-                pass
-            n=name.replace('/', os.path.sep)
-            if not os.path.exists( self.tempfile(n) ):
+                continue
+            if not self.exists(name):
                 print "Warning: missing file : %s" % name
 
         # FIXME: Make some validity checks (resources/ dir, etc)
         self.file_ = fname
 
+    def compression_type(self, name):
+        """Return the compression type to use for the given member.
+        """
+        if name == u'mimetype':
+            # As in OpenDocument, the mimetype is not compressed.
+            return zipfile.ZIP_STORED
+        (mimetype, encoding) = mimetypes.guess_type(name)
+        if encoding is not None:
+            return zipfile.ZIP_STORED
+        if (mimetype is not None
+            and mimetype.startswith(STORED_MIMETYPES)
+            and mimetype != 'image/svg+xml'):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def _copy_member(self, source, info, z):
+        """Copy a member from the source zip file.
+
+        If possible (see RAW_COPY), the compressed data is copied
+        byte-for-byte with a regenerated local header. Else the member
+        is decompressed and compressed again.
+
+        @param source: the source zip file
+        @type source: zipfile.ZipFile
+        @param info: the member info in the source zip file
+        @type info: zipfile.ZipInfo
+        @param z: the destination zip file
+        @type z: zipfile.ZipFile
+        """
+        zinfo=copy.copy(info)
+        zinfo.extra=_strip_zip64_extra(info.extra)
+        if not RAW_COPY or not self._copy_raw_member(source, info, zinfo, z):
+            z.writestr(zinfo, source.read(info))
+
+    def _copy_raw_member(self, source, info, zinfo, z):
+        """Copy the compressed data of a member from the source zip file.
+
+        @return: False if the member cannot be copied this way
+        """
+        fp=source.fp
+        fp.seek(info.header_offset)
+        fheader=fp.read(zipfile.sizeFileHeader)
+        if len(fheader) != zipfile.sizeFileHeader:
+            return False
+        fheader=struct.unpack(zipfile.structFileHeader, fheader)
+        if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            return False
+        fp.seek(info.header_offset
+                + zipfile.sizeFileHeader
+                + fheader[zipfile._FH_FILENAME_LENGTH]
+                + fheader[zipfile._FH_EXTRA_FIELD_LENGTH])
+        # Sizes and CRC are known: put them in the local header
+        # rather than in a data descriptor.
+        zinfo.flag_bits &= ~0x08
+        zinfo.header_offset=z.fp.tell()
+        z.fp.write(zinfo.FileHeader())
+        remaining=info.compress_size
+        while remaining > 0:
+            data=fp.read(min(remaining, 1 << 20))
+            if not data:
+                raise zipfile.BadZipfile(_("Truncated member %s") % info.filename)
+            z.fp.write(data)
+            remaining -= len(data)
+        z.filelist.append(zinfo)
+        z.NameToInfo[zinfo.filename]=zinfo
+        z._didModify=True
+        return True
+
     def save(self, fname=None):
         """Save the package.
+
+        When saving to a zip file, the members that were not
+        extracted, or not modified since they were extracted (or
+        since the last save) are copied from the previous zip file
+        without being compressed again. Members are considered as
+        modified if they were written through update_file, or if their
+        size, mtime or CRC changed. Media files are stored without
+        compression.
+
+        The zip file is written to a temporary file, which then
+        replaces the destination file.
         """
         if fname is None:
             fname=self.file_
@@ -266,52 +651,131 @@ class ZipPackage:
             # it.
             os.mkdir(fname)
 
+        source=None
         if os.path.isdir(fname):
             z=None
+            # The directory must contain all the members
+            self.extract_member(u'')
         else:
-            z=zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED)
+            if self._archive is not None and os.path.exists(self._archive):
+                try:
+                    source=zipfile.ZipFile(self._archive, 'r')
+                except (IOError, zipfile.BadZipfile):
+                    source=None
+            if source is None and [ n for n in self._index
+                                    if not os.path.exists(self._path(n)) ]:
+                # Some members are only available from the archive
+                raise AdveneException(_("Cannot read the original package %s") % self._archive)
+            fd, tmpname=tempfile.mkstemp('.tmp', '.' + os.path.basename(fname),
+                                         os.path.dirname(os.path.abspath(fname)))
+            os.close(fd)
+            z=zipfile.ZipFile(tmpname, 'w', zipfile.ZIP_DEFLATED)
 
         manifest=[]
+        members={}
+        # (name, filename) of the members to write. filename is None
+        # for members which are copied from the archive.
+        entries=[]
 
-        for (dirpath, dirnames, filenames) in os.walk(self._tempdir):
-            # Ignore RCS directory paths
-            for d in ('.svn', 'CVS', '_darcs', '.bzr'):
-                if d in dirnames:
-                    dirnames.remove(d)
-
-            # Remove tempdir prefix
-            zpath=dirpath.replace(self._tempdir, '')
+        try:
+            for (dirpath, dirnames, filenames) in os.walk(self._tempdir):
+                # Ignore RCS directory paths
+                for d in ('.svn', 'CVS', '_darcs', '.bzr'):
+                    if d in dirnames:
+                        dirnames.remove(d)
+
+                # Remove tempdir prefix
+                zpath=dirpath.replace(self._tempdir, '')
+
+                # Normalize os.path.sep to UNIX pathsep (/)
+                zpath=zpath.replace(os.path.sep, '/', -1)
+                if zpath and zpath[0] == '/':
+                    # We should have only a relative subdir here
+                    zpath=zpath[1:]
+
+                for f in filenames:
+                    if f == 'manifest.xml':
+                        # We will write it later on.
+                        continue
+                    if zpath:
+                        name='/'.join( (zpath, f) )
+                    else:
+                        name=f
+                    if isinstance(name, str):
+                        name=unicode(name, _fs_encoding)
+                    entries.append( (name, os.path.join(dirpath, f)) )
+
+            # Members which were not extracted, in archive order
+            extracted=set(n for (n, f) in entries)
+            for info in sorted(self._index.itervalues(), key=lambda i: i.header_offset):
+                name=info.filename
+                if isinstance(name, str):
+                    name=unicode(name, 'utf-8', 'replace')
+                if name in extracted or name.split(u'/')[-1] == u'manifest.xml':
+                    continue
+                entries.append( (name, None) )
 
-            # Normalize os.path.sep to UNIX pathsep (/)
-            zpath=zpath.replace(os.path.sep, '/', -1)
-            if zpath and zpath[0] == '/':
-                # We should have only a relative subdir here
-                zpath=zpath[1:]
+            # Write the mimetype first.
+            entries.sort(key=lambda e: e[0] != u'mimetype')
 
-            for f in filenames:
-                if f == 'manifest.xml':
-                    # We will write it later on.
+            for (name, filename) in entries:
+                manifest.append(name)
+                if filename is not None:
+                    members[name]=st=self._stat(filename)
+                if z is None:
                     continue
-                if zpath:
-                    name='/'.join( (zpath, f) )
+                arcname=name.encode('utf-8')
+                info=None
+                if source is not None and (filename is None
+                                           or (name not in self._modified
+                                               and self._members.get(name) == st)):
+                    info=source.NameToInfo.get(arcname) or source.NameToInfo.get(name)
+                    if (info is not None and filename is not None
+                        and self._crc(filename) != info.CRC & 0xffffffff):
+                        # Modified without changing its size nor mtime
+                        info=None
+                if info is not None:
+                    self._copy_member(source, info, z)
                 else:
-                    name=f
-                if isinstance(name, str):
-                    name=unicode(name, _fs_encoding)
-                manifest.append(name)
-                if z is not None:
-                    z.write( os.path.join(dirpath, f),
-                             name.encode('utf-8') )
-
-        # Generation of the manifest file
-        fname=self.tempfile(u"META-INF", u"manifest.xml")
-        tree=ET.ElementTree(self.list_to_manifest(manifest))
-        tree.write(fname, encoding='utf-8')
-        if z is not None:
+                    z.write(filename, arcname, self.compression_type(name))
+
             # Generation of the manifest file
-            z.write( fname,
-                     "META-INF/manifest.xml" )
-            z.close()
+            if not os.path.isdir(self.tempfile(u"META-INF")):
+                os.mkdir(self.tempfile(u"META-INF"))
+            manifestname=self.tempfile(u"META-INF", u"manifest.xml")
+            tree=ET.ElementTree(self.list_to_manifest(manifest))
+            tree.write(manifestname, encoding='utf-8')
+            if z is not None:
+                # Generation of the manifest file
+                z.write( manifestname,
+                         "META-INF/manifest.xml" )
+                z.close()
+        except:
+            if z is not None:
+                z.close()
+                os.unlink(tmpname)
+            raise
+        finally:
+            if source is not None:
+                source.close()
+
+        if z is not None:
+            self._close_archive()
+            if os.path.exists(fname):
+                shutil.copymode(fname, tmpname)
+                if sys.platform == 'win32':
+                    # rename does not replace existing files on win32
+                    os.unlink(fname)
+            else:
+                # mkstemp creates files readable only by the user
+                umask=os.umask(0)
+                os.umask(umask)
+                os.chmod(tmpname, 0666 & ~umask)
+            os.rename(tmpname, fname)
+            self._archive=fname
+            self._members=members
+            self._read_index(self._archive_file())
+        self._modified=set()
 
     def update_statistics(self, p):
         """Update the META-INF/statistics.xml file
@@ -319,9 +783,7 @@ class ZipPackage:
         d=self.tempfile(u'META-INF')
         if not os.path.isdir(d):
             os.mkdir(d)
-        f=open(self.tempfile(u'META-INF', u'statistics.xml'), 'w')
-        f.write(p.generate_statistics().encode('utf-8'))
-        f.close()
+        self.update_file(u'META-INF/statistics.xml', p.generate_statistics().encode('utf-8'))
         return True
 
     def list_to_manifest(self, manifest):
@@ -369,6 +831,7 @@ class ZipPackage:
     def close(self):
         """Close the package and remove temporary files.
         """
+        self._close_archive()
         shutil.rmtree(self._tempdir.encode(_fs_encoding), ignore_errors=True)
         self.tempdir_list.remove(self._tempdir)
         return True
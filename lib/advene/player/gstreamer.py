@@ -58,7 +58,7 @@ try:
     import pygst
     pygst.require('0.10')
     import gst
-    from advene.util.snapshotter import Snapshotter
+    from advene.util.snapshotter import Snapshotter, SnapshotterPool
     svgelement = None
     # First try rsvgoverlay
     if gst.element_factory_find('rsvgoverlay'):
@@ -166,7 +166,12 @@ class Player:
         self.last_timestamp_update = 0
 
         try:
-            self.snapshotter = Snapshotter(self.snapshot_taken, width=config.data.player['snapshot-width'])
+            if config.data.player['snapshotter-workers'] > 1:
+                self.snapshotter = SnapshotterPool(self.snapshot_taken,
+                                                   width=config.data.player['snapshot-width'],
+                                                   workers=config.data.player['snapshotter-workers'])
+            else:
+                self.snapshotter = Snapshotter(self.snapshot_taken, width=config.data.player['snapshot-width'])
         except Exception, e:
             self.log(u"Could not initialize snapshotter:" +  unicode(e))
             self.snapshotter = None
@@ -411,7 +416,7 @@ class Player:
         else:
             return [ ]
 
-    def fullres_snapshot_taken(self, buffer):
+    def fullres_snapshot_taken(self, buffer, throughput=None):
         if self.fullres_snapshot_callback:
             s=Snapshot( { 'data': buffer.data,
                           'type': 'PNG',
@@ -442,7 +447,7 @@ class Player:
                 self.fullres_snapshotter.start()
         self.fullres_snapshotter.enqueue(position)
 
-    def snapshot_taken(self, buffer):
+    def snapshot_taken(self, buffer, throughput=None):
         if self.snapshot_notify:
             s=Snapshot( { 'data': buffer.data,
                           'type': 'PNG',
@@ -622,11 +627,19 @@ class Player:
         self.status = s.status
         self.stream_duration = s.length
         self.current_position_value = long(s.position)
-        if self.caption.text and (s.position < self.caption.begin
-                                  or s.position > self.caption.end):
+        self.update_overlays(s.position)
+
+    def update_overlays(self, position):
+        """Remove the caption and SVG overlay outside of their time range.
+
+        It is also called by the controller with the interpolated
+        position, between two position updates.
+        """
+        if self.caption.text and (position < self.caption.begin
+                                  or position > self.caption.end):
             self.display_text('', -1, -1)
-        if self.overlay.data and (s.position < self.overlay.begin
-                                  or s.position > self.overlay.end):
+        if self.overlay.data and (position < self.overlay.begin
+                                  or position > self.overlay.end):
             self.imageoverlay.props.data=None
             self.overlay.begin=-1
             self.overlay.end=-1
@@ -634,11 +647,11 @@ class Player:
         elif not self.overlay.data and self.imageoverlay is not None and self.is_fullscreen() and config.data.player.get('fullscreen-timestamp', False):
             t = time.time()
             # Update timestamp every half second
-            if t - self.last_timestamp_update > .5 and abs(s.position - self.last_timestamp) > 10:
+            if t - self.last_timestamp_update > .5 and abs(position - self.last_timestamp) > 10:
                 self.imageoverlay.props.data = '''<svg:svg width="640pt" height="480pt" preserveAspectRatio="xMinYMin meet" version="1" viewBox="0 0 640 480" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:svg="http://www.w3.org/2000/svg">
   <text fill="white" stroke="white" style="stroke-width:1; font-family: sans-serif; font-size: 22" x="5" y="475">%s</text>
-</svg:svg>''' % format_time(s.position)
-                self.last_timestamp = s.position
+</svg:svg>''' % format_time(position)
+                self.last_timestamp = position
                 self.last_timestamp_update = t
 
     def reparent(self, xid):
@@ -17,6 +17,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 #
 
+import sys
 from gettext import gettext as _
 import gobject
 
@@ -155,11 +156,12 @@ class BrlEngine:
                 navigate_bookmark(+1)
             else:
                 # Navigate to the next annotation in the type
+                pos=self.controller.player.current_position_value
                 l=[an
-                   for an in self.controller.future_begins
-                   if an[0].type == self.currenttype ]
+                   for an in self.controller.annotation_index.starting(pos + 1, sys.maxint)
+                   if an.type == self.currenttype ]
                 if l:
-                    self.controller.queue_action(self.controller.update_status, 'set', l[0][1])
+                    self.controller.queue_action(self.controller.update_status, 'set', l[0].fragment.begin)
         elif k == brlapi.KEY_SYM_LEFT or k == ALVA_LPAD_LEFT or k == ALVA_MPAD_BUTTON1:
             if self.currenttype == 'scroll':
                 if self.char_index >= 0:
@@ -34,8 +34,8 @@ import xml.etree.ElementTree as ET
 def register(controller=None):
     controller.register_importer(MPEG7Importer)
     # Also register time formatting global methods for MPEG7 export
-    controller.register_global_method(mpeg7_time)
-    controller.register_global_method(mpeg7_duration)
+    controller.register_global_method(mpeg7_time, pure=True)
+    controller.register_global_method(mpeg7_duration, pure=True)
     return True
 
 # Should be handled by xml.utils.iso8601.parse(repr), but it fails with
@@ -26,6 +26,8 @@ Widgets can register with this trace builder to receive the trace.
 """
 
 import os
+import re
+import threading
 
 from threading import Thread
 import Queue
@@ -34,7 +36,16 @@ import time
 import socket
 import urllib
 import xml.dom
+from xml.sax.saxutils import quoteattr
 from gettext import gettext as _
+try:
+    # In python2.6 stdlib
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
 
 import advene.core.config as config
 
@@ -49,6 +60,18 @@ from advene.model.annotation import Annotation, Relation
 from advene.model.view import View
 from advene.model.package import Package
 from advene.rules.elements import ECACatalog
+from advene.rules.eventhistory import EventRecord, ElementRecord
+
+# Model classes, indexed by ElementRecord kind
+ELEMENT_CLASSES = {
+    'annotation': Annotation,
+    'relation': Relation,
+    'annotationtype': AnnotationType,
+    'relationtype': RelationType,
+    'schema': Schema,
+    'view': View,
+    'package': Package,
+    }
 
 def register(controller):
     tb = TraceBuilder(controller)
@@ -59,10 +82,16 @@ def register(controller):
 name="Trace Builder plugin"
 
 class TraceBuilder(Thread):
+    # Minimum interval (in s) between snapshot requests for events
+    snapshot_interval = 1.0
+
     def __init__ (self, controller=None, parameters=None, package=None, ntbd=False, nte=False):
         Thread.__init__(self)
         self.equeue = Queue.Queue(-1)
         self.exit_code = "###\n"
+        # Append-only log of the current trace
+        self.tracelog = None
+        self.last_snapshot = 0
         #self.close_on_package_load = False
 
         self.controller=controller
@@ -147,7 +176,8 @@ class TraceBuilder(Thread):
         self.__package=package
         if self.network_broadcasting:
             self.init_broadcasting()
-        self.controller.event_handler.register_view(self)
+        # Filtered events are not sent by the ECAEngine
+        self.controller.event_handler.register_view(self, events=self.tracemodel['operations'])
         self.traces = []
         self.trace = Trace() # current trace
         self.trace.start = config.data.startup_time
@@ -168,14 +198,12 @@ class TraceBuilder(Thread):
         while (1):
             #we shouldnt receive exception from the queue
             obj = self.equeue.get()
-            if not isinstance(obj, dict):
+            if not isinstance(obj, EventRecord):
                 if obj == self.exit_code:
                     self.on_exit()
                     break
                 else:
                     continue
-            if obj['event_name'] in self.filtered_events:
-                continue
             self.receive(obj)
 
     def on_exit(self):
@@ -186,7 +214,10 @@ class TraceBuilder(Thread):
                     self.log('Export thread still running, waiting for its death...')
                 self.texp.join()
         # Also save trace on filesystem.
-        if config.data.preferences['record-actions']:
+        if self.tracelog is not None:
+            self.tracelog.close()
+            self.log("trace saved to %s" % ", ".join(self.tracelog.filenames))
+        elif config.data.preferences['record-actions']:
             try:
                 fn = self.export()
             except Exception, e:
@@ -195,6 +226,49 @@ class TraceBuilder(Thread):
         if self.network_broadcasting:
             self.end_broadcasting()
 
+    def log_event(self, ev):
+        """Append an event to the trace log.
+
+        The log is started with the first event of the current trace.
+        """
+        if json is None or not config.data.preferences['record-actions']:
+            return
+        if self.tracelog is None or self.tracelog.trace is not self.trace:
+            if self.tracelog is not None:
+                self.tracelog.close()
+            d=config.data.advenefile('traces', category='settings')
+            if not os.path.isdir(d):
+                helper.recursive_mkdir(d)
+            self.tracelog = TraceLog(self.trace, d)
+            self.tracelog.start()
+        self.tracelog.write(ev)
+
+    def checkpoint(self):
+        """Make sure that the current trace is saved.
+
+        If the trace is logged, the log is synced to disk. Else the
+        trace is exported.
+
+        @return: the trace filename
+        """
+        if self.tracelog is not None and self.tracelog.trace is self.trace:
+            self.tracelog.sync()
+            return self.tracelog.filenames[-1] if self.tracelog.filenames else None
+        return self.export()
+
+    def request_snapshot(self):
+        """Request a snapshot of the current player position.
+
+        The requests are rate-limited by snapshot_interval, and
+        executed in the main loop.
+        """
+        now = time.time()
+        if now - self.last_snapshot < self.snapshot_interval:
+            return
+        self.last_snapshot = now
+        self.controller.queue_action(self.controller.update_snapshot,
+                                     self.controller.player.current_position_value)
+
     def init_broadcasting(self):
         self.bdq = Queue.Queue(-1)
         self.tbroad = TBroadcast(self.host, self.port, self.bdq)
@@ -218,19 +292,26 @@ class TraceBuilder(Thread):
             #self.log(_("Cannot export to %(fname)s: %(e)s") % locals())
             self.log(_("Cannot export to %(fname)s: %(e)s") % locals())
             return None
-        tr=ET.Element('trace', name=self.trace.name, start=str(self.trace.start))
-
+        # The elements are serialized one at a time, so that the
+        # whole trace tree is never built.
+        stream.write('<trace name=%s start=%s>' % (quoteattr(unicode(self.trace.name)).encode('utf-8'),
+                                                  quoteattr(str(self.trace.start))))
         for lvl in self.trace.levels:
-            grp = ET.Element(lvl)
+            elements = self.trace.levels[lvl]
+            if not elements:
+                stream.write('\n  <%s />' % lvl)
+                continue
+            stream.write('\n  <%s>' % lvl)
             #everything can be rebuild from events.
-            for (id_e, e) in enumerate(self.trace.levels[lvl]):
-                #e.to_xml_string(id_e)
-                grp.append(e.export(id_e))
-            tr.append(grp)
+            for (id_e, e) in enumerate(elements):
+                el = e.export(id_e)
+                helper.indent(el, 2)
+                el.tail = None
+                stream.write('\n    ')
+                stream.write(ET.tostring(el, encoding='utf-8'))
+            stream.write('\n  </%s>' % lvl)
             # everything except comments could be rebuild from events...
-
-        helper.indent(tr)
-        ET.ElementTree(tr).write(stream, encoding='utf-8')
+        stream.write('\n</trace>')
         stream.close()
         if self.network_exp:
             self.network_export()
@@ -288,44 +369,33 @@ class TraceBuilder(Thread):
         return True
 
     def search(self, trace, words=u'', exact=False, options=None):
+        """Search the operations of a trace.
+
+        The result is a new trace, appended to self.traces. Its
+        events and operations are shared with the searched trace.
+
+        @param trace: the searched trace
+        @param words: the searched string
+        @param exact: if True, match exact values, else substrings
+        @param options: where to search: 'oname' (object names), 'oid' (object ids), 'ocontent' (object contents)
+        @return: the result trace
+        """
         if options is None:
             options=['oname', 'oid', 'ocontent']
-        # exact will be to match exact terms or just find the terms in a string
-        # oname : objects name
-        # oid : objects id
-        # ocontent : objects content
+        matches=trace.get_index().search(words, exact, options)
         temp=Trace()
-        temp.rename('Results for \'%s\' in %s' % (words, trace.name))
+        temp.rename('Results for \'%s\' in %s' % (words, trace.name))
         temp.start = trace.start
-        for e in trace.levels['events']:
-            etemp = e.copy()
-            temp.add_to_trace('events', etemp)
+        temp.levels['events']=list(trace.levels['events'])
         for a in trace.levels['actions']:
-            atemp = a.copy()
-            atemp.operations=[]
-            temp.add_to_trace('actions', atemp)
-
-            for o in a.operations:
-                if o.concerned_object['name'] is not None:
-                    content=o.content.encode('utf-8')
-                    contentb = content.find('content="')
-                    if contentb > 0 :
-                        contentb = contentb+9
-                        contentf = content.find('"', contentb)
-                        content = urllib.unquote(content[contentb:contentf])
-                        content = unicode(content)
-                    name = unicode(o.concerned_object['name'])
-                    _id = o.concerned_object['id']
-                    found = False or (not exact and 'oname' in options and name.find(words.lower())>=0) or (exact and 'oname' in options and name==words) or (not exact and 'oid' in options and _id.lower().find(words.lower())>=0) or (exact and 'oid' in options and _id==words) or (not exact and 'ocontent' in options and content.lower().find(words.lower())>=0) or (exact and 'ocontent' in options and content==words)
-                    if found and not o in temp.levels['operations']:
-                        otemp = o.copy()
-                        temp.add_to_trace('operations', otemp)
-                        atemp.operations.append(otemp)
-
-            if len(atemp.operations)<=0:
-                temp.remove_from_trace('actions', atemp)
+            operations=[ o for o in a.operations if o in matches ]
+            if operations:
+                atemp = a.copy()
+                atemp.operations=operations
+                temp.levels['actions'].append(atemp)
+                temp.levels['operations'].extend(operations)
         self.traces.append(temp)
-        self.alert_registered(None, None, None)
+        self.alert_registered(None, None, None)
         return temp
 
     def convert_old_trace(self, fname):
@@ -405,6 +475,8 @@ class TraceBuilder(Thread):
             if not os.path.exists(fname):
                 self.log("%s not found, giving up." % fname)
                 return False
+        if fname.endswith('.log'):
+            return self.import_trace_log(fname)
         tr=handyxml.xml(fname, forced=True)
         lid=0
         if tr.node.nodeName != 'trace':
@@ -447,46 +519,7 @@ class TraceBuilder(Thread):
             evt = Event(ev.name, float(ev.time), float(ev.ac_time), ev_content, ev.movie, float(ev.m_time), ev.o_name, ev.o_id, ot, ev.o_cid)
             evt.change_comment(ev.comment)
             self.traces[-1].add_to_trace('events', evt)
-            if evt.name in self.modelmapping['operations']['actions']:
-                op = Operation(ev.name, float(ev.time), float(ev.ac_time), ev_content, ev.movie, float(ev.m_time), ev.o_name, ev.o_id, ot, ev.o_cid)
-                self.traces[-1].add_to_trace('operations', op)
-                if op is not None:
-                    if ev.name in self.modelmapping['operations']['actions']:
-                        ac_t = self.modelmapping['operations']['actions'][ev.name]
-                    else:
-                        continue
-                    typ = "Undefined"
-                    if ac_t >=0:
-                        typ = self.tracemodel['actions'][ac_t]
-                    if typ == "Undefined":
-                        if ot==advene.model.annotation.Annotation or ot==advene.model.annotation.Annotation:
-                            typ="Restructuration"
-                        elif ot==advene.model.schema.AnnotationType or ot==advene.model.schema.RelationType or ot==advene.model.schema.Schema:
-                            typ="Classification"
-                        elif ot==advene.model.view.View:
-                            typ="View building"
-                        else:
-                            print "undefined action type ! %s" % ev.o_type
-                            continue
-                    if tmp_opened_actions[typ]:
-                        # an action is already opened for this type of event
-                        ac = tmp_opened_actions[typ]
-                        #add operation to existing action
-                        ac.add_operation(op)
-                        if typ == "Navigation" and (op.name == "PlayerStop" or op.name == "PlayerPause"):
-                            # Navigation action end if PlayerStop or PlayerPause
-                            tmp_opened_actions[typ]=None
-                        continue
-                    #no corresponding action was already opened
-                    for t in tmp_opened_actions.keys():
-                        #we close every opened actions except Navigation
-                        if t != "Navigation":
-                            tmp_opened_actions[t]=None
-                    #we create the new action
-                    ac = Action(name=typ, begintime=op.time, endtime=None, acbegintime=op.activity_time, acendtime=None, content=None, movie=op.movie, movietime=op.movietime, operations=[op])
-                    self.traces[-1].add_to_trace('actions', ac)
-                    #we append the new action to the trace and flag it as opened (not yet ended)
-                    tmp_opened_actions[typ]=ac
+            self.add_imported_event(self.traces[-1], evt, tmp_opened_actions)
         # copy comments
         if hasattr(tr, 'actions'):
             for ac in tr.actions[0].action:
@@ -497,10 +530,93 @@ class TraceBuilder(Thread):
         self.log("%s events imported" % lid)
         return True
 
+    def import_trace_log(self, fname):
+        """Import a trace log written by TraceLog.
+        """
+        if json is None:
+            self.log("Cannot import trace logs: no json module.")
+            return False
+        try:
+            f=open(fname, 'rb')
+        except (OSError, IOError), e:
+            self.log(_("Cannot open %(fname)s: %(e)s") % locals())
+            return False
+        trace=Trace()
+        opened_actions=dict( (i, None) for i in self.tracemodel['actions'] )
+        lid=0
+        for line in f:
+            try:
+                d=json.loads(line)
+            except ValueError:
+                # Truncated line, if the log was not properly closed
+                continue
+            if 'trace' in d:
+                if not lid:
+                    trace.rename('%s (imported)' % d['trace'])
+                    trace.start=float(d['start'])
+                continue
+            lid = lid+1
+            evt = Event(d['name'], float(d['time']), float(d['ac_time']), d['content'], d['movie'], float(d['m_time']), d['o_name'], d['o_id'], self.imp_type(d['o_type']), d['o_cid'])
+            trace.add_to_trace('events', evt)
+            self.add_imported_event(trace, evt, opened_actions)
+        f.close()
+        self.traces.append(trace)
+        self.alert_registered(None, None, None)
+        self.log("%s events imported" % lid)
+        return True
+
+    def add_imported_event(self, trace, evt, opened_actions):
+        """Add an imported event to a trace.
+
+        The corresponding operation and action are also added.
+        """
+        ot = evt.concerned_object['type']
+        if evt.name in self.modelmapping['operations']['actions']:
+            op = Operation(evt.name, evt.time, evt.activity_time, evt.content, evt.movie, evt.movietime, evt.concerned_object['name'], evt.concerned_object['id'], ot, evt.concerned_object['cid'])
+            trace.add_to_trace('operations', op)
+            if op is not None:
+                if evt.name in self.modelmapping['operations']['actions']:
+                    ac_t = self.modelmapping['operations']['actions'][evt.name]
+                else:
+                    return
+                typ = "Undefined"
+                if ac_t >=0:
+                    typ = self.tracemodel['actions'][ac_t]
+                if typ == "Undefined":
+                    if ot==advene.model.annotation.Annotation or ot==advene.model.annotation.Annotation:
+                        typ="Restructuration"
+                    elif ot==advene.model.schema.AnnotationType or ot==advene.model.schema.RelationType or ot==advene.model.schema.Schema:
+                        typ="Classification"
+                    elif ot==advene.model.view.View:
+                        typ="View building"
+                    else:
+                        print "undefined action type ! %s" % evt.exp_type(ot)
+                        return
+                if opened_actions[typ]:
+                    # an action is already opened for this type of event
+                    ac = opened_actions[typ]
+                    #add operation to existing action
+                    ac.add_operation(op)
+                    if typ == "Navigation" and (op.name == "PlayerStop" or op.name == "PlayerPause"):
+                        # Navigation action end if PlayerStop or PlayerPause
+                        opened_actions[typ]=None
+                    return
+                #no corresponding action was already opened
+                for t in opened_actions.keys():
+                    #we close every opened actions except Navigation
+                    if t != "Navigation":
+                        opened_actions[t]=None
+                #we create the new action
+                ac = Action(name=typ, begintime=op.time, endtime=None, acbegintime=op.activity_time, acendtime=None, content=None, movie=op.movie, movietime=op.movietime, operations=[op])
+                trace.add_to_trace('actions', ac)
+                #we append the new action to the trace and flag it as opened (not yet ended)
+                opened_actions[typ]=ac
+
     def receive(self, obj):
-        # obj : received event
+        # obj : received EventRecord
         ev = op = ac = None
         ev = self.packEvent(obj)
+        self.log_event(ev)
         # broadcast reseau
         if self.network_broadcasting:
             #verifying thread is still alive
@@ -519,290 +635,135 @@ class TraceBuilder(Thread):
                 ac = self.packAction(obj, op)
         self.alert_registered(ev, op, ac)
 
-    def packEvent(self, obj):
-        #print obj['event_name']
-        if obj['event_name'] != 'SnapshotUpdate':
-            self.controller.update_snapshot(self.controller.player.current_position_value)
-        ev_time = time.time()
-        ev_activity_time = (time.time() - self.trace.start) * 1000
-        ev_name = obj['event_name']
-        ev_movie = self.controller.package.getMetaData(config.data.namespace, "mediafile")
-        ev_movie_time = self.controller.player.current_position_value
-        if not ev_movie_time:
-            ev_movie_time=0
-        ev_content = ''
-        elem = None
+    def event_parameters(self, obj):
+        """Return the parameters of an EventRecord, as a dict.
+
+        The element parameter is also stored under its kind
+        (annotation, relation...).
+        """
+        params = dict(obj.parameters)
+        elem = params.get('element')
+        if isinstance(elem, ElementRecord) and elem.kind in ELEMENT_CLASSES:
+            params[elem.kind] = elem
+        return params
+
+    def describe(self, obj):
+        """Describe the element concerned by an EventRecord.
+
+        @return: (content, name, id, type, class id, movie time) where movie time is None if it is not specified by the event
+        """
+        params = self.event_parameters(obj)
+        content = None
         elem_name = None
         elem_id = None
         elem_type = None
         elem_class_id = None
+        movie_time = None
+        elem = None
         # Logging content depending on keys
-        if 'element' in obj:
-            if isinstance(obj['element'], Annotation):
-                obj['annotation']=obj['element']
-            elif isinstance(obj['element'], Relation):
-                obj['relation']=obj['element']
-            elif isinstance(obj['element'], AnnotationType):
-                obj['annotationtype']=obj['element']
-            elif isinstance(obj['element'], RelationType):
-                obj['relationtype']=obj['element']
-            elif isinstance(obj['element'], Schema):
-                obj['schema']=obj['element']
-            elif isinstance(obj['element'], View):
-                obj['view']=obj['element']
-            elif isinstance(obj['element'], Package):
-                obj['package']=obj['element']
-        if 'uri' in obj:
-            obj['content']='movie="%s"' % str(obj['uri'])
+        for key in ('annotation', 'relation', 'annotationtype', 'relationtype', 'schema', 'view', 'package', None):
+            if key in params:
+                elem = params[key]
+                break
+        if 'uri' in params:
             elem_name='movie'
-            elem_id=str(obj['uri'])
-        elif 'annotation' in obj:
-            elem=obj['annotation']
-            if elem is not None:
-                ev_content= "\n".join(
+            elem_id=str(params['uri'])
+        elif key is None:
+            if 'position' in params:
+                #event related to the player
+                position = params['position'] or 0
+                position_before = params.get('position_before') or 0
+                content=str(time.strftime("%H:%M:%S", time.gmtime(position_before/1000)))
+                content+= '\n'
+                content+=str(time.strftime("%H:%M:%S", time.gmtime(position/1000)))
+                if not obj.name.find('Set')>0:
+                    #not a PlayerSet
+                    movie_time=position_before
+                else:
+                    movie_time=position
+        elif elem is None:
+            pass
+        elif not isinstance(elem, ElementRecord):
+            # A view parameter may be a GUI view
+            content= 'view=' + unicode(elem)
+            elem_name='not a view'
+            elem_id='undefined'
+        else:
+            elem_id=elem.id
+            elem_type=ELEMENT_CLASSES.get(elem.kind)
+            if elem.kind == 'annotation':
+                content= "\n".join(
                     ( 'annotation=' + elem.id,
-                      'type=' + elem.type.id,
-                      'mimetype=' + elem.type.mimetype,
-                      'begin=' + str(elem.fragment.begin),
-                      'end=' + str(elem.fragment.end),
-                      'content="'+ urllib.quote(elem.content.data.encode('utf-8'))+'"')
-                            )
+                      'type=' + elem.class_id,
+                      'mimetype=' + elem.mimetype,
+                      'begin=' + str(elem.begin),
+                      'end=' + str(elem.end),
+                      'content="'+ urllib.quote(elem.content.encode('utf-8'))+'"')
+                    )
                 elem_name='annotation'
-                elem_id=elem.id
-                elem_type = advene.model.annotation.Annotation
-                elem_class_id = elem.type.id
-        elif 'relation' in obj:
-            elem=obj['relation']
-            if elem is not None:
-                ev_content= "\n".join(
+                elem_class_id = elem.class_id
+            elif elem.kind == 'relation':
+                content= "\n".join(
                     ( 'relation=' + elem.id,
-                      'type=' + elem.type.id,
-                      'mimetype=' + elem.type.mimetype,
-                      'source=' + elem.members[0].id,
-                      'dest=' + elem.members[1].id,
-                      'content="'+ urllib.quote(elem.content.data.encode('utf-8'))+'"')
+                      'type=' + elem.class_id,
+                      'mimetype=' + elem.mimetype,
+                      'source=' + elem.members[0],
+                      'dest=' + elem.members[1],
+                      'content="'+ urllib.quote(elem.content.encode('utf-8'))+'"')
                     )
                 elem_name='relation'
-                elem_id=elem.id
-                elem_type = advene.model.annotation.Relation
-                elem_class_id = elem.type.id
-        elif 'annotationtype' in obj:
-            elem=obj['annotationtype']
-            if elem is not None:
-                ev_content= "\n".join(
-                    ('annotationtype='+elem.id,
-                     'schema=' + elem.schema.id,
+                elem_class_id = elem.class_id
+            elif elem.kind in ('annotationtype', 'relationtype'):
+                content= "\n".join(
+                    (elem.kind + '=' + elem.id,
+                     'schema=' + elem.class_id,
                      'mimetype=' + elem.mimetype)
                     )
                 elem_name=elem.title
-                elem_id=elem.id
-                elem_type = advene.model.schema.AnnotationType
-                elem_class_id = elem.schema.id
-        elif 'relationtype' in obj:
-            elem=obj['relationtype']
-            if elem is not None:
-                ev_content= "\n".join(
-                    ('relationtype=' + elem.id,
-                     'schema=' + elem.schema.id,
-                     'mimetype=' + elem.mimetype)
-                    )
+                elem_class_id = elem.class_id
+            elif elem.kind == 'schema':
+                content= 'schema=' + elem.id
                 elem_name=elem.title
-                elem_id=elem.id
-                elem_type = advene.model.schema.RelationType
-                elem_class_id = elem.schema.id
-        elif 'schema' in obj:
-            elem=obj['schema']
-            if elem is not None:
-                ev_content= 'schema=' + elem.id
+            elif elem.kind == 'view':
+                content= "\n".join(
+                    ('view=' + elem.id,
+                     'content="'+ urllib.quote(elem.content.encode('utf-8'))+'"')
+                    )
                 elem_name=elem.title
-                elem_id=elem.id
-                elem_type = advene.model.schema.Schema
-        elif 'view' in obj:
-            elem=obj['view']
-            if elem is not None:
-                if isinstance(elem, advene.model.view.View):
-                    ev_content= "\n".join(
-                        ('view=' + elem.id,
-                         'content="'+ urllib.quote(elem.content.data.encode('utf-8'))+'"')
-                        )
-                    elem_name=elem.title
-                    elem_id=elem.id
-                    elem_type = advene.model.view.View
-                else:
-                    ev_content= 'view=' + str(elem)
-                    elem_name='not a view'
-                    elem_id='undefined'
-        elif 'package' in obj:
-            elem=obj['package']
-            if elem is not None:
-                ev_content= 'package=' + elem.title
+            elif elem.kind == 'package':
+                content= 'package=' + elem.title
                 elem_name='package'
                 elem_id=elem.title
-                elem_type = advene.model.package.Package
-        elif 'position' in obj:
-            #event related to the player
-            if obj['position'] is None:
-                obj['position']=0
-            if obj['position_before'] is None:
-                obj['position_before']=0
-            ev_content=str(time.strftime("%H:%M:%S", time.gmtime(obj['position_before']/1000)))
-            ev_content+= '\n'
-            ev_content+=str(time.strftime("%H:%M:%S", time.gmtime(obj['position']/1000)))
-            if not obj['event_name'].find('Set')>0:
-                #not a PlayerSet
-                ev_movie_time=obj['position_before']
-            else:
-                ev_movie_time=obj['position']
-        #TODO undo ?
-        ev_undo=False
-        if 'undone' in obj:
-            ev_undo = True
-        ev = Event(ev_name, ev_time, ev_activity_time, unicode(ev_content), ev_movie, ev_movie_time, elem_name, elem_id, elem_type, elem_class_id)
-        #ev = Event(ev_name, ev_time, ev_activity_time, ev_snapshot, ev_content, ev_movie, ev_movie_time, elem_name, elem_id)
+        return (unicode(content or ''), elem_name, elem_id, elem_type, elem_class_id, movie_time)
+
+    def packEvent(self, obj):
+        #print obj.name
+        if obj.name != 'SnapshotUpdate':
+            self.request_snapshot()
+        ev_time = obj.time
+        ev_activity_time = (obj.time - self.trace.start) * 1000
+        ev_name = obj.name
+        ev_movie = self.controller.package.getMetaData(config.data.namespace, "mediafile")
+        ev_content, elem_name, elem_id, elem_type, elem_class_id, ev_movie_time = self.describe(obj)
+        if ev_movie_time is None:
+            ev_movie_time = self.controller.player.current_position_value or 0
+        ev = Event(ev_name, ev_time, ev_activity_time, ev_content, ev_movie, ev_movie_time, elem_name, elem_id, elem_type, elem_class_id)
         self.trace.add_to_trace('events', ev)
         return ev
 
     def packOperation(self, obj):
-        #op_snapshot = self.controller.package.imagecache.get(self.controller.player.current_position_value, epsilon=100)
-        op_time = time.time()
-        op_activity_time = (time.time() - self.trace.start) * 1000
-        op_name = obj['event_name']
-        #op_params = obj['parameters']
-        #for i in obj:
-        #    print "%s : %s" % (i,obj[i])
+        op_time = obj.time
+        op_activity_time = (obj.time - self.trace.start) * 1000
+        op_name = obj.name
         op_movie = self.controller.package.getMetaData(config.data.namespace, "mediafile")
-        op_movie_time = self.controller.player.current_position_value
-        if not op_movie_time:
-            op_movie_time=0
-        op_content = None
-        elem = None
-        elem_name = None
-        elem_id = None
-        elem_type = None
-        elem_class_id = None
-        # package uri annotation relation annotationtype relationtype schema
-        # Logging content depending on keys
-        if 'element' in obj:
-            if isinstance(obj['element'], advene.model.annotation.Annotation):
-                obj['annotation']=obj['element']
-            elif isinstance(obj['element'], advene.model.annotation.Relation):
-                obj['relation']=obj['element']
-            elif isinstance(obj['element'], advene.model.schema.AnnotationType):
-                obj['annotationtype']=obj['element']
-            elif isinstance(obj['element'], advene.model.schema.RelationType):
-                obj['relationtype']=obj['element']
-            elif isinstance(obj['element'], advene.model.schema.Schema):
-                obj['schema']=obj['element']
-            elif isinstance(obj['element'], advene.model.view.View):
-                obj['view']=obj['element']
-            elif isinstance(obj['element'], advene.model.package.Package):
-                obj['package']=obj['element']
-        if 'uri' in obj:
-            obj['content']='movie="'+str(obj['uri'])+'"'
-            elem_name='movie'
-            elem_id=str(obj['uri'])
-        elif 'annotation' in obj:
-            elem=obj['annotation']
-            if elem is not None:
-                op_content= "\n".join(
-                    ( 'annotation=' + elem.id,
-                      'type=' + elem.type.id,
-                      'mimetype=' + elem.type.mimetype,
-                      'begin=' + str(elem.fragment.begin),
-                      'end=' + str(elem.fragment.end),
-                      'content="'+ urllib.quote(elem.content.data.encode('utf-8'))+'"')
-                            )
-                elem_name='annotation'
-                elem_id=elem.id
-                elem_type = advene.model.annotation.Annotation
-                elem_class_id = elem.type.id
-        elif 'relation' in obj:
-            elem=obj['relation']
-            if elem is not None:
-                op_content= "\n".join(
-                    ( 'relation=' + elem.id,
-                      'type=' + elem.type.id,
-                      'mimetype=' + elem.type.mimetype,
-                      'source=' + elem.members[0].id,
-                      'dest=' + elem.members[1].id,
-                      'content="'+ urllib.quote(elem.content.data.encode('utf-8'))+'"')
-                    )
-                elem_name='relation'
-                elem_id=elem.id
-                elem_type = advene.model.annotation.Relation
-                elem_class_id = elem.type.id
-        elif 'annotationtype' in obj:
-            elem=obj['annotationtype']
-            if elem is not None:
-                op_content= "\n".join(
-                    ('annotationtype='+elem.id,
-                     'schema=' + elem.schema.id,
-                     'mimetype=' + elem.mimetype)
-                    )
-                elem_name=elem.title
-                elem_id=elem.id
-                elem_type = advene.model.schema.AnnotationType
-                elem_class_id = elem.schema.id
-        elif 'relationtype' in obj:
-            elem=obj['relationtype']
-            if elem is not None:
-                op_content= "\n".join(
-                    ('relationtype=' + elem.id,
-                     'schema=' + elem.schema.id,
-                     'mimetype=' + elem.mimetype)
-                    )
-                elem_name=elem.title
-                elem_id=elem.id
-                elem_type = advene.model.schema.RelationType
-                elem_class_id = elem.schema.id
-        elif 'schema' in obj:
-            elem=obj['schema']
-            if elem is not None:
-                op_content= 'schema=' + elem.id
-                elem_name=elem.title
-                elem_id=elem.id
-                elem_type = advene.model.schema.Schema
-        elif 'view' in obj:
-            elem=obj['view']
-            if elem is not None:
-                if isinstance(elem, advene.model.view.View):
-                    op_content= "\n".join(
-                        ('view=' + elem.id,
-                         'content="'+ urllib.quote(elem.content.data.encode('utf-8'))+'"')
-                        )
-                    elem_name=elem.title
-                    elem_id=elem.id
-                    elem_type = advene.model.view.View
-                else:
-                    op_content= 'view=' + str(elem)
-                    elem_name='not a view'
-                    elem_id='undefined'
-        elif 'package' in obj:
-            elem=obj['package']
-            if elem is not None:
-                op_content= 'package=' + elem.title
-                elem_name='package'
-                elem_id=elem.title
-                elem.type=advene.model.package.Package
-        elif 'position' in obj:
-            #event related to the player
-            if obj['position'] is None:
-                obj['position']=0
-            if obj['position_before'] is None:
-                obj['position_before']=0
-            op_content=str(time.strftime("%H:%M:%S", time.gmtime(obj['position_before']/1000)))
-            op_content+= '\n'
-            op_content+=str(time.strftime("%H:%M:%S", time.gmtime(obj['position']/1000)))
-            if not obj['event_name'].find('Set')>0:
-                #not a PlayerSet
-                op_movie_time=obj['position_before']
-            else:
-                op_movie_time=obj['position']
+        op_content, elem_name, elem_id, elem_type, elem_class_id, op_movie_time = self.describe(obj)
+        if op_movie_time is None:
+            op_movie_time = self.controller.player.current_position_value or 0
         if self.trace.levels['operations']:
             prev = self.trace.levels['operations'][-1]
             if op_name in self.editEndNames and prev.name in self.editEndNames and prev.concerned_object['id'] == elem_id:
                 return
-        op = Operation(op_name, op_time, op_activity_time, unicode(op_content), op_movie, op_movie_time, elem_name, elem_id, elem_type, elem_class_id)
+        op = Operation(op_name, op_time, op_activity_time, op_content, op_movie, op_movie_time, elem_name, elem_id, elem_type, elem_class_id)
         self.trace.add_to_trace('operations', op)
         return op
 
@@ -810,8 +771,8 @@ class TraceBuilder(Thread):
         ope = op
         ac_t = None
         # verifier l'action de l'evenement
-        if obj['event_name'] in self.modelmapping['operations']['actions']:
-            ac_t = self.modelmapping['operations']['actions'][obj['event_name']]
+        if obj.name in self.modelmapping['operations']['actions']:
+            ac_t = self.modelmapping['operations']['actions'][obj.name]
         else:
             return
         typ = "Undefined"
@@ -819,7 +780,7 @@ class TraceBuilder(Thread):
             typ = self.tracemodel['actions'][ac_t]
         if typ == "Undefined":
             # some operations can be mapped to different actions, we check that
-            typ = self.find_action_name(obj)
+            typ = self.find_action_name(self.event_parameters(obj))
         if self.opened_actions.get(typ):
             # an action is already opened for this event
             ac = self.opened_actions[typ]
@@ -870,6 +831,99 @@ class TraceBuilder(Thread):
     #def get_trace(self):
     #    return self.trace
 
+class TraceIndex(object):
+    """Index of the operations of a trace, used by TraceBuilder.search.
+
+    The operations concerning an object are indexed by the object
+    name, id and content (the content attribute of annotations,
+    relations and views). Exact values are indexed in dictionaries.
+    For substring searches, the words of the indexed values are
+    indexed: only the operations with words containing the words of
+    the query are checked.
+    """
+    fields = ('oname', 'oid', 'ocontent')
+    word_re = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self, operations=None):
+        self.lock = threading.Lock()
+        # Indexed values, indexed by operation
+        self.values = {}
+        # Operations indexed by value, for each field
+        self.exact = dict( (f, {}) for f in self.fields )
+        # Operations indexed by word, for each field
+        self.words = dict( (f, {}) for f in self.fields )
+        for o in operations or []:
+            self.add(o)
+
+    def get_values(self, o):
+        """Return the indexed values of an operation, by field.
+        """
+        name = unicode(o.concerned_object['name'])
+        id_ = unicode(o.concerned_object['id'])
+        content = o.content
+        start = content.find('content="')
+        if start > 0:
+            start = start + 9
+            content = unicode(urllib.unquote(content[start:content.find('"', start)].encode('utf-8')), 'utf-8', 'replace')
+        return { 'oname': name, 'oid': id_, 'ocontent': content }
+
+    def add(self, o):
+        if o.concerned_object['name'] is None:
+            return
+        values = self.get_values(o)
+        with self.lock:
+            self.values[o] = values
+            for f, v in values.iteritems():
+                self.exact[f].setdefault(v, []).append(o)
+                for w in set(self.word_re.findall(v.lower())):
+                    self.words[f].setdefault(w, set()).add(o)
+
+    def candidates(self, field, words):
+        """Return the operations which may contain words in the field.
+        """
+        parts = self.word_re.findall(words)
+        if not parts:
+            return self.values.keys()
+        res = None
+        index = self.words[field]
+        for p in set(parts):
+            s = set()
+            for (w, operations) in index.iteritems():
+                if p in w:
+                    s.update(operations)
+            if res is None:
+                res = s
+            else:
+                res &= s
+            if not res:
+                break
+        return res
+
+    def search(self, words, exact=False, options=None):
+        """Return the set of matching operations.
+
+        As in previous versions, substring searches are case
+        insensitive, except for object names.
+        """
+        if options is None:
+            options = self.fields
+        res = set()
+        with self.lock:
+            for f in options:
+                if not f in self.fields:
+                    continue
+                if exact:
+                    res.update(self.exact[f].get(words, ()))
+                    continue
+                lwords = words.lower()
+                for o in self.candidates(f, lwords):
+                    v = self.values[o][f]
+                    if f != 'oname':
+                        v = v.lower()
+                    if lwords in v:
+                        res.add(o)
+        return res
+
 class Trace:
     def __init__ (self):
         self.start=0
@@ -879,6 +933,17 @@ class Trace:
         'operations':[],
         'actions':[],
         }
+        # TraceIndex of the operations, built on demand
+        self._index=None
+
+    def get_index(self):
+        """Return the TraceIndex of the operations.
+
+        Once built, it is updated when operations are added.
+        """
+        if self._index is None:
+            self._index = TraceIndex(self.levels['operations'])
+        return self._index
 
     def rename(self, name):
         # rename the trace
@@ -894,6 +959,8 @@ class Trace:
         if obj is None or not self.levels.has_key(level):
             return None
         self.levels[level].append(obj)
+        if level == 'operations' and self._index is not None:
+            self._index.add(obj)
         return obj
 
     def remove_from_trace(self, level, obj):
@@ -901,6 +968,8 @@ class Trace:
         if obj is None or not self.levels.has_key(level) or obj not in self.levels[level]:
             return None
         self.levels[level].remove(obj)
+        if level == 'operations':
+            self._index=None
         return obj
 
     def add_level(self, level):
@@ -989,6 +1058,22 @@ class Event:
         e.text = self.content
         return e
 
+    def to_dict(self):
+        """Return the event attributes, as stored in the trace log.
+        """
+        return {
+            'name': self.name,
+            'time': self.time,
+            'ac_time': self.activity_time,
+            'movie': self.movie,
+            'm_time': self.movietime,
+            'o_name': self.concerned_object['name'],
+            'o_id': self.concerned_object['id'],
+            'o_type': self.exp_type(self.concerned_object['type']),
+            'o_cid': self.concerned_object['cid'],
+            'content': self.content,
+            }
+
     def to_xml_string(self, n_id):
         return ET.tostring(self.export(n_id), encoding="utf-8")
         #return "<event id='e%s' name='%s' time='%s' ac_time='%s' movie='%s' m_time='%s' comment='%s' o_name='%s' o_id='%s' o_type='%s' o_cid='%s'/>" % (str(n_id), self.name, str(self.time), str(self.activity_time), str(self.movie), str(self.movietime), self.comment, str(self.concerned_object['name']), str(self.concerned_object['id']), str(self.concerned_object['type']), str(self.concerned_object['cid']))
@@ -1199,3 +1284,104 @@ class TBroadcast(Thread):
             'host': self.host,
             'port': self.port }
         sck.close()
+
+class TraceLog(Thread):
+    """Append-only trace log.
+
+    The events of a trace are appended, from this thread, to a file
+    holding one JSON object per line. The first line of each file
+    holds the trace name and start time. The file is flushed every
+    flush_interval seconds and synced to disk every sync_interval
+    seconds. When it is larger than max_size bytes, the following
+    events are written to a new file.
+
+    @ivar filenames: the names of the written files
+    @type filenames: list
+    """
+    # Intervals (in s) between file flushes and disk syncs
+    flush_interval = 1.0
+    sync_interval = 10.0
+    # Maximum size (in bytes) of a trace log file
+    max_size = 16 * 1024 * 1024
+
+    def __init__ (self, trace, dirname):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.trace = trace
+        self.dirname = dirname
+        self.basename = time.strftime("trace_advene-%Y%m%d-%H%M%S")
+        self.queue = Queue.Queue(-1)
+        self.stream = None
+        self.filenames = []
+        self.error = None
+        self.sync_requested = False
+
+    def write(self, event):
+        """Append an event to the log.
+        """
+        if self.error is None:
+            self.queue.put(event)
+
+    def sync(self):
+        """Request a disk sync of the log.
+        """
+        self.sync_requested = True
+        self.queue.put(False)
+
+    def close(self):
+        """Write the pending events and close the log.
+        """
+        self.queue.put(None)
+        self.join()
+
+    def open_stream(self):
+        if self.filenames:
+            name = '%s-%d.log' % (self.basename, len(self.filenames) + 1)
+        else:
+            name = self.basename + '.log'
+        fname = os.path.join(self.dirname, name)
+        self.stream = open(fname, 'ab')
+        self.filenames.append(fname)
+        self.write_line({ 'trace': self.trace.name,
+                          'start': self.trace.start,
+                          'part': len(self.filenames) })
+
+    def close_stream(self):
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+        self.stream.close()
+        self.stream = None
+
+    def write_line(self, d):
+        self.stream.write(json.dumps(d, separators=(',', ':')))
+        self.stream.write('\n')
+
+    def run(self):
+        last_flush = last_sync = time.time()
+        try:
+            self.open_stream()
+            while True:
+                try:
+                    ev = self.queue.get(timeout=self.flush_interval)
+                except Queue.Empty:
+                    ev = False
+                if ev is None:
+                    break
+                if ev:
+                    self.write_line(ev.to_dict())
+                    if self.stream.tell() > self.max_size:
+                        self.close_stream()
+                        self.open_stream()
+                now = time.time()
+                if self.sync_requested or now - last_sync >= self.sync_interval:
+                    self.sync_requested = False
+                    self.stream.flush()
+                    os.fsync(self.stream.fileno())
+                    last_flush = last_sync = now
+                elif now - last_flush >= self.flush_interval:
+                    self.stream.flush()
+                    last_flush = now
+            self.close_stream()
+        except (OSError, IOError), e:
+            self.error = unicode(e)
+            print "Cannot write trace log: %s" % self.error
@@ -21,6 +21,7 @@ import subprocess
 import os
 import signal
 import sys
+import threading
 
 import advene.core.config as config
 from advene.rules.elements import RegisteredAction
@@ -81,15 +82,22 @@ def register(controller=None):
                     ( 'annotation/content/data', _("The annotation content") ),
                     )},
             category='sound',
+            threadsafe=True,
             ))
 
 class TTSEngine:
     """Generic TTSEngine.
+
+    The Pronounce action may be executed by the action workers, with
+    an already evaluated message (see
+    L{advene.rules.ecaengine.ResolvedContext}). The engines are not
+    thread-safe, so the calls to pronounce are serialized by self.lock.
     """
     def __init__(self, controller=None):
         self.controller=controller
         self.gui=self.controller.gui
         self.language=None
+        self.lock=threading.Lock()
 
     def can_run():
         """Can this engine run ?
@@ -129,7 +137,8 @@ class TTSEngine:
         """Pronounce action.
         """
         message=self.parse_parameter(context, parameters, 'message', _("No message..."))
-        self.pronounce(message)
+        with self.lock:
+            self.pronounce(message)
         return True
 ENGINES['generic'] = TTSEngine
 
@@ -282,7 +291,9 @@ class SAPITTSEngine(TTSEngine):
 
     def __init__(self, controller=None):
         TTSEngine.__init__(self, controller=controller)
-        self.sapi=None
+        # The COM objects can only be used from the thread which
+        # created them.
+        self.local=threading.local()
 
     def can_run():
         """Can this engine run ?
@@ -296,10 +307,14 @@ class SAPITTSEngine(TTSEngine):
     can_run=staticmethod(can_run)
 
     def pronounce (self, sentence):
-        if self.sapi is None:
+        sapi=getattr(self.local, 'sapi', None)
+        if sapi is None:
+            import pythoncom
             import win32com.client
-            self.sapi=win32com.client.Dispatch("sapi.SPVoice")
-        self.sapi.Speak( sentence.encode(config.data.preferences['tts-encoding'], 'ignore'), self.SPF_ASYNC | self.SPF_PURGEBEFORESPEAK )
+            # COM must be initialized in each thread using it
+            pythoncom.CoInitialize()
+            sapi=self.local.sapi=win32com.client.Dispatch("sapi.SPVoice")
+        sapi.Speak( sentence.encode(config.data.preferences['tts-encoding'], 'ignore'), self.SPF_ASYNC | self.SPF_PURGEBEFORESPEAK )
         return True
 ENGINES['sapi'] = SAPITTSEngine
 
@@ -19,13 +19,28 @@
 """Undo manager.
 
 It provides a basic framework for simple undos.
+
+The undo history of each package is stored in an L{UndoJournal}. Its
+memory usage is bounded by the undo-memory-limit preference (in MB):
+older operations are spilled to an append-only log stored next to the
+package file (with the .undo extension), and read back when they are
+undone. The number of operations is bounded by the undo-depth
+preference. Content changes are stored as deltas.
 """
 
+import os
+import zlib
+import urllib
+import weakref
+from cPickle import dumps, loads, dump, load, HIGHEST_PROTOCOL
+
+from gettext import gettext as _
+
+import advene.core.config as config
 from advene.model.annotation import Annotation
 from advene.model.fragment import MillisecondFragment
 from advene.model.view import View
 from advene.model.query import Query
-from cPickle import dumps, loads
 
 name="Undo Manager"
 
@@ -33,17 +48,313 @@ def register(controller):
     controller.undomanager=UndoHistory(controller)
     controller.undomanager.register()
 
-class UndoHistory:
+def common_length(a, b, limit, suffix=False):
+    """Return the length of the common prefix (or suffix) of a and b.
+
+    It uses a binary search on string slices, which are compared
+    natively.
+    """
+    lo, hi = 0, limit
+    while lo < hi:
+        mid=(lo + hi + 1) // 2
+        if suffix:
+            same=(a[len(a) - mid:] == b[len(b) - mid:])
+        else:
+            same=(a[:mid] == b[:mid])
+        if same:
+            lo=mid
+        else:
+            hi=mid - 1
+    return lo
+
+def content_delta(old, new):
+    """Return the delta needed to restore old from new.
+
+    The delta is a (prefix, suffix, middle, checksum) tuple: the
+    length of the common prefix and suffix of old and new, the
+    differing part of old, and the checksum of new.
+    """
+    n=min(len(old), len(new))
+    prefix=common_length(old, new, n)
+    suffix=common_length(old, new, n - prefix, suffix=True)
+    return (prefix, suffix, old[prefix:len(old) - suffix], zlib.crc32(new))
+
+def apply_delta(new, delta):
+    """Restore the old content from new and a content_delta.
+
+    @return: the old content, or None if new does not match the delta
+    """
+    prefix, suffix, middle, checksum = delta
+    if zlib.crc32(new) != checksum:
+        return None
+    return new[:prefix] + middle + new[len(new) - suffix:]
+
+def entry_size(entry):
+    """Return the approximate size in bytes of a history entry.
+    """
+    action, element, data = entry
+    if action == 'batch':
+        return sum(entry_size(e) for e in data)
+    if isinstance(data, dict):
+        data=data.values()
+    elif action == 'changed':
+        data=[ v for (k, v) in data ]
+    else:
+        return 64
+    size=64
+    for v in data:
+        if isinstance(v, basestring):
+            size += len(v)
+        elif isinstance(v, tuple):
+            size += sum(len(i) for i in v if isinstance(i, basestring))
+        else:
+            size += 8
+    return size
+
+# Tag of the (ELEMENT_REFERENCE, id) tuples which replace package
+# elements in logged history entries. Plugins are loaded with
+# generated module names, so we do not pickle instances of a class
+# defined here.
+ELEMENT_REFERENCE='\x00element'
+
+class UndoJournal(object):
+    """Bounded undo history of a package.
+
+    The most recent operations are kept in memory, older ones are
+    spilled to an append-only log. Each record of the log is pickled
+    and is either ('op', entry) or ('saved', mtime). The saved record
+    is written when the package is saved. When the journal is opened
+    again (for instance after a crash), only the operations preceding
+    the last saved record matching the package file are kept.
+
+    @ivar memory: the in-memory history entries
+    @type memory: list
+    @ivar offsets: the log offsets of the spilled entries
+    @type offsets: list
+    @ivar filename: the log file, or None
+    """
+    def __init__(self, package):
+        self.memory=[]
+        self._sizes=[]
+        self.offsets=[]
+        # Number of discarded operations still present in the log
+        self._garbage=0
+        self.filename=None
+        self.package_file=None
+        uri=package.uri
+        if uri and uri.startswith('file://'):
+            uri=urllib.url2pathname(uri[7:])
+        if uri and os.path.isfile(uri):
+            self.package_file=uri
+            self.filename=uri + '.undo'
+            self.read_log()
+
+    def __len__(self):
+        return len(self.memory) + len(self.offsets)
+
+    def get_depth(self):
+        return config.data.preferences['undo-depth']
+
+    def get_memory_limit(self):
+        """Return the memory budget in bytes (0 for no limit).
+        """
+        return config.data.preferences['undo-memory-limit'] * 1024 * 1024
+
+    def read_log(self):
+        """Read the offsets of the valid operations of the log.
+        """
+        offsets=[]
+        valid=(0, [])
+        try:
+            mtime=os.path.getmtime(self.package_file)
+            f=open(self.filename, 'rb')
+        except (OSError, IOError):
+            return
+        try:
+            while True:
+                pos=f.tell()
+                try:
+                    kind, value = load(f)
+                except EOFError:
+                    break
+                if kind == 'op':
+                    offsets.append(pos)
+                elif kind == 'saved' and value == mtime:
+                    valid=(f.tell(), offsets[:])
+        except Exception:
+            # Truncated record, or invalid log.
+            pass
+        f.close()
+        end, offsets = valid
+        # Discard the operations that were not saved in the package
+        self.truncate(end)
+        depth=self.get_depth()
+        if depth and len(offsets) > depth:
+            self._garbage=len(offsets) - depth
+            offsets=offsets[-depth:]
+        self.offsets=offsets
+
+    def truncate(self, offset):
+        try:
+            f=open(self.filename, 'r+b')
+            f.truncate(offset)
+            f.close()
+        except (OSError, IOError):
+            pass
+
+    def encode(self, value):
+        """Replace package elements by references in a history entry.
+        """
+        if hasattr(value, 'getOwnerPackage'):
+            return (ELEMENT_REFERENCE, value.id)
+        elif isinstance(value, list):
+            return [ self.encode(v) for v in value ]
+        elif isinstance(value, tuple):
+            return tuple(self.encode(v) for v in value)
+        elif isinstance(value, dict):
+            return dict( (k, self.encode(v)) for (k, v) in value.iteritems() )
+        return value
+
+    def decode(self, value, package):
+        """Resolve the element references of a history entry.
+        """
+        if isinstance(value, list):
+            return [ self.decode(v, package) for v in value ]
+        elif isinstance(value, tuple):
+            if len(value) == 2 and value[0] == ELEMENT_REFERENCE:
+                return package.get_element_by_id(value[1])
+            return tuple(self.decode(v, package) for v in value)
+        elif isinstance(value, dict):
+            return dict( (k, self.decode(v, package)) for (k, v) in value.iteritems() )
+        return value
+
+    def append(self, entry):
+        self.memory.append(entry)
+        self._sizes.append(entry_size(entry))
+        self.update()
+
+    def update(self):
+        """Enforce the depth and memory limits.
+
+        It should be called when a batch entry has been modified.
+        """
+        if self.memory and self.memory[-1][0] == 'batch':
+            self._sizes[-1]=entry_size(self.memory[-1])
+        depth=self.get_depth()
+        if depth and len(self) > depth:
+            # Discard the oldest operations
+            n=len(self) - depth
+            dropped=min(n, len(self.offsets))
+            if dropped:
+                del self.offsets[:dropped]
+                self._garbage += dropped
+                if self._garbage > depth:
+                    self.compact()
+            del self.memory[:n - dropped]
+            del self._sizes[:n - dropped]
+        limit=self.get_memory_limit()
+        if limit:
+            total=sum(self._sizes)
+            n=0
+            # Always keep the last entry, which may be an active batch
+            while total > limit and n < len(self.memory) - 1:
+                total -= self._sizes[n]
+                n += 1
+            if n:
+                self.spill(n)
+
+    def spill(self, count):
+        """Move the count oldest in-memory entries to the log.
+
+        If there is no log, they are discarded.
+        """
+        entries=self.memory[:count]
+        del self.memory[:count]
+        del self._sizes[:count]
+        if self.filename is None:
+            return
+        try:
+            f=open(self.filename, 'ab')
+            for e in entries:
+                self.offsets.append(f.tell())
+                dump(('op', self.encode(e)), f, HIGHEST_PROTOCOL)
+            f.close()
+        except (OSError, IOError):
+            pass
+
+    def compact(self):
+        """Rewrite the log, without the discarded operations.
+
+        The saved records are also removed.
+        """
+        self._garbage=0
+        entries=[]
+        try:
+            f=open(self.filename, 'rb')
+            for pos in self.offsets:
+                f.seek(pos)
+                entries.append(load(f)[1])
+            f.close()
+            self.offsets=[]
+            f=open(self.filename, 'wb')
+            for e in entries:
+                self.offsets.append(f.tell())
+                dump(('op', e), f, HIGHEST_PROTOCOL)
+            f.close()
+        except (OSError, IOError, EOFError):
+            self.offsets=[]
+            self.truncate(0)
+
+    def pop(self, package):
+        """Remove and return the last entry.
+
+        @param package: the package used to resolve logged entries
+        @return: the (action, element, data) entry, or None
+        """
+        if self.memory:
+            self._sizes.pop()
+            return self.memory.pop()
+        if not self.offsets:
+            return None
+        pos=self.offsets.pop()
+        try:
+            f=open(self.filename, 'rb')
+            f.seek(pos)
+            kind, entry = load(f)
+            f.close()
+        except (OSError, IOError, EOFError):
+            self.offsets=[]
+            self.truncate(0)
+            return None
+        self.truncate(pos)
+        return self.decode(entry, package)
+
+    def saved(self):
+        """Record that the package has been saved.
+
+        All operations are written to the log, so that they are
+        available when the package is loaded again.
+        """
+        if self.filename is None or not os.path.isfile(self.package_file):
+            return
+        self.spill(len(self.memory))
+        try:
+            f=open(self.filename, 'ab')
+            dump(('saved', os.path.getmtime(self.package_file)), f, HIGHEST_PROTOCOL)
+            f.close()
+        except (OSError, IOError):
+            pass
+
+class UndoHistory(object):
     def __init__(self, controller=None):
         self.controller=controller
 
-        # FIXME: history and _edits should be specific to each package
-
-        # In history, store triples (action, element, values)
+        # The history of each package is an UndoJournal. It stores
+        # triples (action, element, values)
         # where action is 'batch', 'changed', 'deleted' or 'created'.
         # If action is 'batch', then its element is the batch id, and
         # its values is a history-like structure.
-        self.history=[]
+        self.journals=weakref.WeakKeyDictionary()
 
         # Hold intermediate batch_history. Only 1 batch can be active
         # at a time.
@@ -53,6 +364,18 @@ class UndoHistory:
         self._rules=[]
         self._edits={}
 
+    def get_journal(self, package=None):
+        """Return the undo journal of the package (by default, the current one).
+        """
+        if package is None:
+            package=self.controller.package
+        try:
+            return self.journals[package]
+        except KeyError:
+            j=self.journals[package]=UndoJournal(package)
+            return j
+    history=property(get_journal)
+
     def register(self):
         """Register to the appropriate events.
         """
@@ -73,6 +396,7 @@ class UndoHistory:
             ('QueryEditEnd', self.element_edit_end),
             ('QueryDelete', self.element_delete),
 
+            ('PackageSave', self.package_save),
             ):
             r=self.controller.event_handler.internal_rule(event=event, method=method)
             r.immediate=True
@@ -82,6 +406,16 @@ class UndoHistory:
         for r in self._rules:
             self.controller.event_handler.remove_rule(r, 'internal')
 
+    def package_save(self, context, parameters):
+        """Write the journal of the saved package.
+        """
+        p=context.evaluateValue('package')
+        if p in self.journals:
+            # Close the current batch, which is written to the log
+            self.batch_id=None
+            self.batch_history=[]
+            self.journals[p].saved()
+
     def get_cached_representation(self, el):
         """Return a cached representation of an element.
         """
@@ -142,9 +476,18 @@ class UndoHistory:
         if element in self._edits:
             cached=self._edits[element]
             new=self.get_cached_representation(element)
-            changed=[ (k, v) for (k, v) in cached.iteritems() if new[k] != v ]
+            changed=[]
+            for (k, v) in cached.iteritems():
+                if new[k] == v:
+                    continue
+                if k == 'content':
+                    # Store the content as a delta
+                    changed.append( ('content-delta', content_delta(v, new[k])) )
+                else:
+                    changed.append( (k, v) )
             # Store changed elements in history
             history.append( ('changed', element, changed) )
+            self.history.update()
             self._edits[element]=new
             #print "Saving diff for ", element
 
@@ -177,6 +520,7 @@ class UndoHistory:
 
         # Store created elements in history.
         history.append( ('created', element, element.id) )
+        self.history.update()
 
     def element_delete(self, context, parameters):
         """Record the deleted elements.
@@ -209,6 +553,7 @@ class UndoHistory:
             # Store deleted elements in history. We store here the
             # element type (annotation, view...) as second parameter
             history.append( ('deleted', el, self._edits[element]) )
+            self.history.update()
             del self._edits[element]
             #print "Saving content for ", el
 
@@ -221,9 +566,14 @@ class UndoHistory:
         if operation is not None:
             (action, element, data)=operation
         else:
-            if not self.history:
+            operation=self.history.pop(self.controller.package)
+            if operation is None:
                 return
-            (action, element, data)=self.history.pop()
+            (action, element, data)=operation
+
+        if element is None:
+            self.log(_("Cannot undo %s: the element does not exist anymore") % action)
+            return
 
         if action == 'changed':
             for (k, v) in data:
@@ -231,6 +581,12 @@ class UndoHistory:
                     setattr(element, k, v)
                 elif k == 'content':
                     element.content.data=v
+                elif k == 'content-delta':
+                    v=apply_delta(str(element.content.data), v)
+                    if v is None:
+                        self.log(_("Cannot undo the content modification of %s: the content has changed") % element.id)
+                    else:
+                        element.content.data=v
                 elif k == 'mimetype':
                     element.content.mimetype=v
                 elif k == 'begin':
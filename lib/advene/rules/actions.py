@@ -643,6 +643,7 @@ class DefaultActionsRepository:
             return True
         try:
             self.controller.player.set_rate(int(rate))
+            self.controller.position_clock.invalidate()
         except AttributeError:
             self.controller.log(_("The set_rate method is unavailable."))
         return True
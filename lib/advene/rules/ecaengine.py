@@ -30,8 +30,12 @@ import threading
 import copy
 import StringIO
 import urllib
+import Queue
+from gettext import gettext as _
 
 import advene.rules.elements
+from advene.model.tal.context import AdveneTalesException
+from advene.rules.eventhistory import EventHistory
 
 class MyThread(threading.Thread):
     """Override the standard run() method.
@@ -47,6 +51,215 @@ class MyThread(threading.Thread):
         if self._target:
             self._target()
 
+class ResolvedContext(object):
+    """Context holding the evaluated parameters of an action.
+
+    Thread-safe actions are executed by the ActionPool workers, but
+    the model and the TALES contexts are not thread-safe. So their
+    parameters are evaluated in the main thread, and the action only
+    gets the resulting values through evaluateValue.
+    """
+    def __init__(self, action, context):
+        """Evaluate the action parameters in the given context.
+
+        @param action: the action
+        @type action: Action
+        @param context: the context
+        @type context: AdveneContext
+        """
+        self.values={}
+        # The rule name is used in error messages
+        for expr in action.parameters.values() + [ 'rule' ]:
+            try:
+                self.values[expr]=context.evaluateValue(expr)
+            except Exception, e:
+                # Raise it again in the action
+                self.values[expr]=e
+
+    def evaluateValue(self, expr):
+        try:
+            v=self.values[expr]
+        except KeyError:
+            raise AdveneTalesException('%s is not an evaluated parameter' % expr)
+        if isinstance(v, Exception):
+            raise v
+        return v
+
+class ActionPool(object):
+    """Pool of worker threads executing thread-safe actions.
+
+    Actions whose RegisteredAction is declared thread-safe are
+    executed by the workers, so that a slow action (external command,
+    network access...) does not block the other ones. A watchdog
+    thread checks the running actions every watchdog_interval
+    seconds: an action running longer than its timeout is reported,
+    and its worker is replaced so that the pool keeps its capacity.
+    The action itself cannot be interrupted.
+
+    The number of workers is given by the action-workers preference.
+
+    @ivar engine: the ECAEngine
+    @type engine: ECAEngine
+    @ivar statistics: [ count, total time, max time, timeouts ] (in s), indexed by action name
+    @type statistics: dict
+    @ivar max_queue_depth: maximum number of pending actions
+    @type max_queue_depth: int
+    """
+    # Interval (in s) between two checks of the running actions
+    watchdog_interval=1.0
+
+    def __init__(self, engine):
+        self.engine=engine
+        self.queue=Queue.Queue()
+        self.lock=threading.Lock()
+        # Worker thread -> (start time, action) if busy, None if idle
+        self.workers={}
+        # Timed out workers, which will exit once their action is done
+        self.detached=set()
+        self.statistics={}
+        self.max_queue_depth=0
+        self.watchdog=None
+        self.stopped=threading.Event()
+
+    def get_size(self):
+        """Return the configured number of workers.
+        """
+        return config.data.preferences['action-workers']
+
+    def is_enabled(self):
+        return self.get_size() > 0
+
+    def is_worker(self, thread=None):
+        """Check if the thread (by default the current one) is a worker thread.
+        """
+        if thread is None:
+            thread=threading.currentThread()
+        return thread in self.workers or thread in self.detached
+
+    def queue_depth(self):
+        """Return the number of pending actions.
+        """
+        return self.queue.qsize()
+
+    def get_timeout(self, action):
+        return action.timeout or config.data.preferences['action-timeout']
+
+    def submit(self, action, context):
+        """Queue an action for execution by the workers.
+
+        @param action: the action to be executed
+        @type action: Action
+        @param context: the context parameter for the action. It should not be shared with other actions.
+        @type context: AdveneContext
+        """
+        with self.lock:
+            self.check_workers()
+            self.queue.put( (action, context) )
+            depth=self.queue.qsize()
+            if depth > self.max_queue_depth:
+                self.max_queue_depth=depth
+
+    def check_workers(self):
+        """Replace timed out workers and start missing ones.
+
+        It must be called with self.lock held.
+        """
+        now=time.time()
+        for t, state in self.workers.items():
+            if state is None:
+                continue
+            start, action = state
+            timeout=self.get_timeout(action)
+            if timeout and now - start > timeout:
+                del self.workers[t]
+                self.detached.add(t)
+                self.timed_out(action, now - start)
+        while len(self.workers) < self.get_size():
+            t=threading.Thread(target=self.run, name="ActionWorker")
+            t.setDaemon(True)
+            self.workers[t]=None
+            t.start()
+        if self.watchdog is None and self.workers:
+            self.stopped.clear()
+            self.watchdog=threading.Thread(target=self.watch, name="ActionWatchdog")
+            self.watchdog.setDaemon(True)
+            self.watchdog.start()
+
+    def watch(self):
+        """Watchdog thread main loop.
+
+        It reports the actions exceeding their timeout, even if no
+        other action is submitted.
+        """
+        while not self.stopped.wait(self.watchdog_interval):
+            with self.lock:
+                self.check_workers()
+
+    def timed_out(self, action, duration):
+        """Report an action exceeding its timeout.
+        """
+        self.statistics.setdefault(action.name, [ 0, 0, 0, 0 ])[3] += 1
+        self.engine.controller.queue_action(self.engine.controller.log,
+                                            _("Action %(name)s is running for %(duration).1fs") % {
+                'name': action.name,
+                'duration': duration })
+
+    def run(self):
+        """Worker thread main loop.
+        """
+        me=threading.currentThread()
+        while True:
+            item=self.queue.get()
+            if item is None:
+                with self.lock:
+                    self.workers.pop(me, None)
+                return
+            action, context = item
+            start=time.time()
+            with self.lock:
+                self.workers[me]=(start, action)
+            try:
+                action.execute(context)
+            except Exception, e:
+                self.engine.controller.queue_action(self.engine.controller.log,
+                                                    _("Exception in action %(name)s: %(error)s") % {
+                        'name': action.name,
+                        'error': unicode(e) })
+            duration=time.time() - start
+            with self.lock:
+                stats=self.statistics.setdefault(action.name, [ 0, 0, 0, 0 ])
+                stats[0] += 1
+                stats[1] += duration
+                if duration > stats[2]:
+                    stats[2] = duration
+                if me in self.detached:
+                    # We have been replaced by another worker.
+                    self.detached.remove(me)
+                    return
+                timeout=self.get_timeout(action)
+                if timeout and duration > timeout:
+                    self.timed_out(action, duration)
+                self.workers[me]=None
+
+    def clear(self):
+        """Remove pending actions.
+        """
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+
+    def stop(self):
+        """Remove pending actions and stop the workers.
+        """
+        self.clear()
+        with self.lock:
+            self.stopped.set()
+            self.watchdog=None
+            for t in self.workers:
+                self.queue.put(None)
+
 class ECAEngine:
     """ECAEngine class.
 
@@ -60,10 +273,16 @@ class ECAEngine:
     indexed by class name ('internal', 'default', 'user'). Upon every
     update, it rebuilds the L{self.ruledict} dictionary, which is
     indexed by EventName and keeps a list of all rules associated to
-    this EventName.
+    this EventName, sorted by decreasing priority. The rule
+    conditions are compiled at the same time into the
+    L{self.dispatch_table} dictionary.
 
     @ivar ruledict: the global rules dictionary, indexed by EventName
     @type ruledict: dict
+    @ivar dispatch_table: list of (rule, compiled condition) tuples, indexed by EventName
+    @type dispatch_table: dict
+    @ivar dispatch_statistics: [ count, total time, max time ] (in s) of event dispatching, indexed by EventName
+    @type dispatch_statistics: dict
     @ivar rulesets: dictionary holding the rules indexed by classname
     @type rulesets: dict
     @ivar controller: the Advene controller
@@ -74,6 +293,8 @@ class ECAEngine:
     @type scheduler: sched.scheduler
     @ivar schedulerthread: the scheduler's execution thread
     @type schedulerthread: threading.Thread
+    @ivar action_pool: the worker threads for thread-safe actions
+    @type action_pool: ActionPool
     """
     def __init__ (self, controller):
         """Initialize the ECAEngine.
@@ -81,15 +302,17 @@ class ECAEngine:
         @param controller: the Advene controller
         @type controller: advene.core.controller.Controller
         """
-        self.clear_state()
         self.ruledict = {}
+        self.dispatch_table = {}
+        self.dispatch_statistics = {}
+        self.clear_state()
         # History of events
-        self.event_history = []
+        self.event_history = EventHistory(config.data.preferences['event-history-size'])
         self.controller=controller
         self.catalog=advene.rules.elements.ECACatalog()
         self.scheduler=sched.scheduler(time.time, time.sleep)
         self.schedulerthread=MyThread(target=self.scheduler.run)
-        self.views_to_notify=[]
+        self.action_pool=ActionPool(self)
 
     def get_state(self):
         """Return a state of the current rulesets.
@@ -191,10 +414,38 @@ class ECAEngine:
         for type_ in ('internal', 'default', 'user'):
             for rule in self.rulesets[type_]:
                 self.ruledict.setdefault(rule.event, []).append(rule)
+        # The sort is stable, so the class order is kept for rules
+        # with the same priority.
+        for rules in self.ruledict.itervalues():
+            rules.sort(key=lambda r: r.priority, reverse=True)
+        self.dispatch_table = dict( (event, [ (rule, rule.condition.compile()) for rule in rules ])
+                                    for (event, rules) in self.ruledict.iteritems() )
+
+    def copy_context(self, context):
+        """Return a copy of the context, with its own locals.
+
+        It is used for actions executed asynchronously, since the
+        original context is modified after the scheduling.
+
+        @param context: the context to copy
+        @type context: AdveneContext
+        @return: the new context
+        @rtype: AdveneContext
+        """
+        c=copy.copy(context)
+        c.locals=context.locals.copy()
+        c.localStack=context.localStack[:]
+        c.repeatStack=context.repeatStack[:]
+        return c
 
     def schedule(self, action, context, delay=0, immediate=False):
         """Schedule an action for execution.
 
+        Thread-safe actions are executed by the action pool, with
+        their parameters evaluated beforehand (see ResolvedContext).
+        Other non-immediate actions, and all actions triggered from a
+        pool worker, are executed in the main loop.
+
         @param action: the action to be executed
         @type action: Action
         @param context: the context parameter for the action
@@ -209,6 +460,25 @@ class ECAEngine:
 
         if action.immediate or immediate:
             action.execute(context)
+        elif (action.threadsafe and self.action_pool.is_enabled()
+              and not self.action_pool.is_worker()):
+            # The parameters must be evaluated in this thread
+            context=ResolvedContext(action, context)
+            if delay:
+                t=threading.Timer(delay, self.action_pool.submit, (action, context))
+                t.setDaemon(True)
+                t.start()
+            else:
+                self.action_pool.submit(action, context)
+        elif self.action_pool.is_worker():
+            # Marshal the action back to the main loop
+            context=self.copy_context(context)
+            if delay:
+                t=threading.Timer(delay, self.controller.queue_action, (action.execute, context))
+                t.setDaemon(True)
+                t.start()
+            else:
+                self.controller.queue_action(action.execute, context)
         else:
             #print "Scheduling %s with delay %f" % (action.name, delay)
             if delay:
@@ -230,6 +500,7 @@ class ECAEngine:
         """
         for i in self.scheduler.queue:
             self.scheduler.cancel(i[0])
+        self.action_pool.clear()
 
     def build_context(self, event, **kw):
         """Build an AdveneContext.
@@ -268,11 +539,20 @@ class ECAEngine:
         """
         self.catalog.register_action(registered_action)
 
-    def register_view(self, view):
-        self.views_to_notify.append(view)
+    def register_view(self, view, events=None):
+        """Register a view to receive the recorded events.
+
+        The view (should only be TraceBuilder plugin or other trace
+        building system) receives the EventRecords in its equeue.
+
+        @param view: the view
+        @param events: the event names to receive. If None, all events are received.
+        @type events: list
+        """
+        self.event_history.subscribe(view, view.equeue.put, events)
 
     def unregister_view(self, view):
-        self.views_to_notify.remove(view)
+        self.event_history.unsubscribe(view)
 
 
     def internal_rule(self, event=None, condition=None, method=None):
@@ -341,6 +621,23 @@ class ECAEngine:
             res.append("%s: %s" % (k, len(self.ruledict[k])))
         return res
 
+    def dump_statistics(self):
+        """Return the event dispatching statistics.
+
+        @return: a list of lines, one per event
+        @rtype: list
+        """
+        res=[]
+        for k in sorted(self.dispatch_statistics.keys()):
+            count, total, maximum = self.dispatch_statistics[k]
+            res.append("%s: %d events, %.3fms average, %.3fms max" % (k, count, 1000 * total / count, 1000 * maximum))
+        pool=self.action_pool
+        for k in sorted(pool.statistics.keys()):
+            count, total, maximum, timeouts = pool.statistics[k]
+            res.append("Action %s: %d executions, %.3fms average, %.3fms max, %d timeouts" % (k, count, 1000 * total / max(count, 1), 1000 * maximum, timeouts))
+        res.append("Action queue: %d pending, %d max" % (pool.queue_depth(), pool.max_queue_depth))
+        return res
+
     def notify (self, event_name, *param, **kw):
         """Invoked by the application on the occurence of an event.
 
@@ -361,16 +658,6 @@ class ECAEngine:
         """
         #print "notify %s for %s" % (event_name, str(kw))
 
-        if config.data.preferences['record-actions']:
-            # FIXME: we should not store the whole element, it is too costly
-            d=dict(kw)
-            d['event_name'] = event_name
-            d['parameters'] = param
-            self.event_history.append(d)
-            for v in self.views_to_notify:
-                # should only be TraceBuilder plugin or other trace building system
-                #v.receive(d)
-                v.equeue.put(d)
         immediate=False
         if 'immediate' in kw:
             immediate=True
@@ -382,17 +669,45 @@ class ECAEngine:
             del kw['delay']
             print "Delay specified: %f" % delay
 
-        context=self.build_context(event_name, **kw)
+        if config.data.preferences['record-actions']:
+            self.event_history.record(event_name, kw, param)
+
+        start=time.time()
         try:
-            a=self.ruledict[event_name]
+            self.dispatch(event_name, kw, delay=delay, immediate=immediate)
+        finally:
+            duration=time.time() - start
+            try:
+                stats=self.dispatch_statistics[event_name]
+                stats[0] += 1
+                stats[1] += duration
+                if duration > stats[2]:
+                    stats[2] = duration
+            except KeyError:
+                self.dispatch_statistics[event_name] = [ 1, duration, duration ]
+
+    def dispatch(self, event_name, kw, delay=0, immediate=False):
+        """Execute the rules matching an event.
+
+        The context is only built if there are rules for the event.
+
+        @param event_name: the event name
+        @type event_name: string
+        @param kw: the event parameters
+        @type kw: dict
+        @param delay: a delay for execution (in s)
+        @type delay: float
+        @param immediate: execute the actions immediately
+        @type immediate: boolean
+        """
+        try:
+            a=self.dispatch_table[event_name]
         except KeyError:
             return
 
-        rules=sorted( (rule
-                       for rule in a
-                       if rule.condition.match(context) ),
-                      key=lambda e: e.priority,
-                      reverse=True)
+        context=self.build_context(event_name, **kw)
+        # Rules are already sorted by decreasing priority
+        rules=[ rule for (rule, match) in a if match(context) ]
 
         context.pushLocals()
         for rule in rules:
@@ -32,6 +32,7 @@ from advene.model.annotation import Annotation
 from advene.model.fragment import MillisecondFragment
 
 from advene.util.odict import odict
+import advene.rules.queryplanner as queryplanner
 from gettext import gettext as _
 
 class Event(str):
@@ -112,6 +113,26 @@ class ConditionList(list):
         """The ConditionList is never True by default."""
         return False
 
+    def compile(self):
+        """Compile the condition list into a function.
+
+        @return: a function taking a context as parameter and returning a boolean value
+        """
+        conditions=[ c.compile() for c in self ]
+        if self.composition == "and":
+            def match(context):
+                for condition in conditions:
+                    if not condition(context):
+                        return False
+                return True
+        else:
+            def match(context):
+                for condition in conditions:
+                    if condition(context):
+                        return True
+                return False
+        return match
+
     def match(self, context):
         """Test is the context matches the ConditionList.
         """
@@ -189,84 +210,82 @@ class Condition:
 
     def match(self, context):
         """Test if the condition matches the context."""
-        if self.operator in self.binary_operators:
-            # Binary operator
-            left=context.evaluateValue(self.lhs)
-            right=context.evaluateValue(self.rhs)
-            if self.operator == 'equals':
-                return self.convert_value(left) == self.convert_value(right)
-            elif self.operator == 'different':
-                return self.convert_value(left) != self.convert_value(right)
-            elif self.operator == 'contains':
-                return right in left
-            elif self.operator == 'greater':
-                # If it is possible to convert the values to
-                # floats, then do it. Else, compare string values
-                lv=self.convert_value(left, 'end')
-                rv=self.convert_value(right, 'begin')
-                return lv >= rv
-            elif self.operator == 'lower' or self.operator == 'before':
-                # If it is possible to convert the values to
-                # floats, then do it. Else, compare string values
-                lv=self.convert_value(left, 'end')
-                rv=self.convert_value(right, 'begin')
-                return lv <= rv
-            elif self.operator == 'matches':
-                return re.search(rv, lv)
-            elif self.operator == 'meets':
-                lv=self.convert_value(left, 'end')
-                rv=self.convert_value(right, 'begin')
-                return lv == rv
-            elif self.operator == 'overlaps':
-                if isinstance(left, Annotation):
-                    lv=left.fragment
-                elif isinstance(left, MillisecondFragment):
-                    lv=left
-                else:
-                    raise Exception(_("Unknown type for overlaps comparison"))
-                if isinstance(right, Annotation):
-                    rv=right.fragment
-                elif isinstance(right, MillisecondFragment):
-                    rv=right
-                else:
-                    raise Exception(_("Unknown type for overlaps comparison"))
-                return (lv.begin in rv or rv.begin in lv)
-            elif self.operator == 'during':
-                if isinstance(left, Annotation):
-                    lv=left.fragment
-                elif isinstance(left, MillisecondFragment):
-                    lv=left
-                else:
-                    raise Exception(_("Unknown type for during comparison"))
-                if isinstance(right, Annotation):
-                    rv=right.fragment
-                elif isinstance(right, MillisecondFragment):
-                    rv=right
-                else:
-                    raise Exception(_("Unknown type for during comparison"))
-                return lv in rv
-            elif self.operator == 'starts':
-                lv=self.convert_value(left, 'begin')
-                rv=self.convert_value(right, 'begin')
-                return lv == rv
-            elif self.operator == 'finishes':
-                lv=self.convert_value(left, 'end')
-                rv=self.convert_value(right, 'end')
-                return lv == rv
-            else:
-                raise Exception("Unknown operator: %s" % self.operator)
-        elif self.operator in self.unary_operators:
-            # Unary operator
+        return self.compile()(context)
+
+    def get_fragment(self, element):
+        """Return the fragment of an Annotation or Fragment element.
+        """
+        if isinstance(element, Annotation):
+            return element.fragment
+        elif isinstance(element, MillisecondFragment):
+            return element
+        else:
+            raise Exception(_("Unknown type for %s comparison") % self.operator)
+
+    def get_comparator(self):
+        """Return the comparison function for a binary operator.
+
+        @return: a function taking the (lhs, rhs) values as parameters, or None
+        """
+        convert=self.convert_value
+        fragment=self.get_fragment
+        return {
+            'equals': lambda l, r: convert(l) == convert(r),
+            'different': lambda l, r: convert(l) != convert(r),
+            'contains': lambda l, r: r in l,
+            # If it is possible to convert the values to
+            # floats, then do it. Else, compare string values
+            'greater': lambda l, r: convert(l, 'end') >= convert(r, 'begin'),
+            'lower': lambda l, r: convert(l, 'end') <= convert(r, 'begin'),
+            'before': lambda l, r: convert(l, 'end') <= convert(r, 'begin'),
+            'matches': lambda l, r: re.search(r, l),
+            'meets': lambda l, r: convert(l, 'end') == convert(r, 'begin'),
+            'overlaps': lambda l, r: (fragment(l).begin in fragment(r)
+                                      or fragment(r).begin in fragment(l)),
+            'during': lambda l, r: fragment(l) in fragment(r),
+            'starts': lambda l, r: convert(l, 'begin') == convert(r, 'begin'),
+            'finishes': lambda l, r: convert(l, 'end') == convert(r, 'end'),
+            }.get(self.operator)
+
+    def compile(self):
+        """Compile the condition into a function.
+
+        The operator is resolved once, so that the returned function
+        only has to evaluate the TALES expressions. The compiled
+        function is cached as long as the condition is not modified.
+
+        @return: a function taking a context as parameter and returning a boolean value
+        """
+        if self.is_true():
+            return self.truematch
+        key=(self.operator, self.lhs, self.rhs)
+        try:
+            k, f = self._compiled
+            if k == key:
+                return f
+        except AttributeError:
+            pass
+
+        lhs=self.lhs
+        rhs=self.rhs
+        compare=self.get_comparator()
+
+        if self.operator in self.binary_operators and compare is not None:
+            def match(context):
+                return compare(context.evaluateValue(lhs), context.evaluateValue(rhs))
+        elif self.operator == 'not':
             # Note: self.rhs is ignored, whatever its value is.
-            left=context.evaluateValue(self.lhs)
-            if self.operator == 'not':
-                return not left
-            elif self.operator == 'value':
-                return left
-            else:
-                raise Exception("Unknown operator: %s" % self.operator)
+            def match(context):
+                return not context.evaluateValue(lhs)
+        elif self.operator == 'value':
+            def match(context):
+                return context.evaluateValue(lhs)
         else:
-            raise Exception("Unknown operator: %s" % self.operator)
+            message="Unknown operator: %s" % self.operator
+            def match(context):
+                raise Exception(message)
+        self._compiled=(key, match)
+        return match
 
     def truematch(self, context):
         """Condition which always return True.
@@ -330,6 +349,10 @@ class Action:
     @ivar registeredaction: the corresponding registeredaction
     @ivar immediate: indicates that the action should be executed at once and not scheduled
     @type immediate: boolean
+    @ivar threadsafe: indicates that the action can be executed in a worker thread
+    @type threadsafe: boolean
+    @ivar timeout: expected maximum duration (in s) of the action, None for the default value
+    @type timeout: float
     """
     def __init__ (self, registeredaction=None, method=None,
                   catalog=None, doc="", category="generic"):
@@ -342,6 +365,8 @@ class Action:
             self.doc=registeredaction.description
             self.registeredaction=registeredaction
             self.immediate=registeredaction.immediate
+            self.threadsafe=registeredaction.threadsafe
+            self.timeout=registeredaction.timeout
             self.category=registeredaction.category
         elif method is not None:
             self.bind(method)
@@ -351,6 +376,8 @@ class Action:
             self.catalog=catalog
             self.category=category
             self.immediate=False
+            self.threadsafe=False
+            self.timeout=None
         else:
             raise Exception("Error in Action constructor.")
 
@@ -799,6 +826,17 @@ class SimpleQuery(EtreeMixin):
                 # It is either a real list or a Bundle
                 # (for isinstance(someBundle, list) == False !
                 # FIXME: should we use a Bundle ?
+                matching=queryplanner.filter_elements(list(s), self.condition, context)
+                if matching is not None:
+                    if self.rvalue is None or self.rvalue == 'element':
+                        result.extend(matching)
+                    else:
+                        context.pushLocals()
+                        for e in matching:
+                            context.setLocal('element', e)
+                            result.append(context.evaluateValue(self.rvalue))
+                        context.popLocals()
+                    continue
                 context.pushLocals()
                 for e in s:
                     context.setLocal('element', e)
@@ -903,6 +941,10 @@ class RegisteredAction:
     @type: a dict whith list of couples as values or a method m(controller, item)
     @ivar immediate: if True, the action is immediately executed, else scheduled
     @type immediate: boolean
+    @ivar threadsafe: if True, the action does not access the GUI nor the model, and can be executed in a worker thread. Its parameters are then evaluated beforehand in the main thread (see L{advene.rules.ecaengine.ResolvedContext}).
+    @type threadsafe: boolean
+    @ivar timeout: expected maximum duration (in s), None for the action-timeout preference
+    @type timeout: float
     """
     def __init__(self,
                  name=None,
@@ -912,7 +954,9 @@ class RegisteredAction:
                  category="generic",
                  immediate=False,
                  predefined=None,
-                 defaults=None):
+                 defaults=None,
+                 threadsafe=False,
+                 timeout=None):
         self.name=name
         # The method attribute is in fact ignored, since we always lookup in the
         # ECACatalog for each invocation
@@ -932,6 +976,10 @@ class RegisteredAction:
         # If immediate, the action will be run in the main thread, and not
         # in the scheduler thread.
         self.immediate=immediate
+        # If threadsafe, the action may be run in a worker thread of
+        # the ECAEngine action pool.
+        self.threadsafe=threadsafe
+        self.timeout=timeout
         # The available categories are described in Catalog
         self.category=category
         self.predefined=predefined
@@ -1014,6 +1062,7 @@ class ECACatalog:
         'PlayerResume':           _("Player resume"),
         'PlayerSet':              _("Going to a given position"),
         'PackageLoad':            _("Loading a new package"),
+        'PackageLoadProgress':    _("Progress of the loading of a package"),
         'PackageActivate':        _("Activating a package"),
         'PackageSave':            _("Saving the package"),
         'ViewActivation':         _("Start of the dynamic view"),
@@ -0,0 +1,200 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Event history.
+
+When the record-actions preference is set, the ECAEngine records the
+notified events in an L{EventHistory}. It is a fixed-capacity ring
+buffer of L{EventRecord} instances, which do not hold references to
+the package elements: elements are replaced by L{ElementRecord}
+instances holding their ids and scalar attributes.
+
+The records are also dispatched to subscribers (for instance the
+TraceBuilder), which only receive the events they subscribed to.
+"""
+
+import time
+from collections import deque, namedtuple
+
+from advene.model.package import Package
+from advene.model.annotation import Annotation, Relation
+from advene.model.schema import AnnotationType, RelationType
+from advene.model.view import View
+
+class ElementRecord(namedtuple('ElementRecord',
+                               'kind id class_id title mimetype begin end members content')):
+    """Immutable description of a package element.
+
+    kind is the element kind (annotation, relation, annotationtype,
+    relationtype, schema, view, package...). class_id is the id of the
+    type of annotations and relations, or of the schema of types.
+    content is only stored for events sent to subscribers.
+    """
+    __slots__ = ()
+
+def element_record(el, with_content=True):
+    """Build the ElementRecord describing a package element.
+
+    @param with_content: store the element content
+    @type with_content: boolean
+    """
+    class_id=title=mimetype=begin=end=content=None
+    members=()
+    if isinstance(el, Annotation):
+        kind='annotation'
+        class_id=el.type.id
+        mimetype=el.type.mimetype
+        begin=el.fragment.begin
+        end=el.fragment.end
+        if with_content:
+            content=el.content.data
+    elif isinstance(el, Relation):
+        kind='relation'
+        class_id=el.type.id
+        mimetype=el.type.mimetype
+        members=tuple(m.id for m in el.members)
+        if with_content:
+            content=el.content.data
+    elif isinstance(el, (AnnotationType, RelationType)):
+        kind=el.__class__.__name__.lower()
+        class_id=el.schema.id
+        title=el.title
+        mimetype=el.mimetype
+    elif isinstance(el, View):
+        kind='view'
+        title=el.title
+        if with_content:
+            content=el.content.data
+    elif isinstance(el, Package):
+        return ElementRecord('package', el.uri, None, el.title, None, None, None, (), None)
+    else:
+        kind=el.__class__.__name__.lower()
+        title=getattr(el, 'title', None)
+    return ElementRecord(kind, el.id, class_id, title, mimetype, begin, end, members, content)
+
+def compact_value(v, with_content=True):
+    """Return an immutable representation of an event parameter.
+
+    Package elements are converted to ElementRecord, other objects to
+    their string representation. Elements in sequences are represented
+    by their id.
+    """
+    if v is None or isinstance(v, (basestring, bool, int, long, float)):
+        return v
+    elif isinstance(v, Package) or hasattr(v, 'getOwnerPackage'):
+        return element_record(v, with_content)
+    elif isinstance(v, (tuple, list)):
+        return tuple(i.id if hasattr(i, 'getOwnerPackage') else compact_value(i)
+                     for i in v)
+    try:
+        return unicode(v)
+    except UnicodeError:
+        return repr(v)
+
+class EventRecord(namedtuple('EventRecord', 'name time parameters')):
+    """Immutable record of a notified event.
+
+    parameters is a tuple of (name, value) pairs, whose values are
+    built by compact_value. time is the notification time, in seconds.
+    """
+    __slots__ = ()
+
+    def get(self, key, default=None):
+        """Return the value of the given parameter.
+        """
+        for (k, v) in self.parameters:
+            if k == key:
+                return v
+        return default
+
+    def has_parameter(self, key):
+        for (k, v) in self.parameters:
+            if k == key:
+                return True
+        return False
+
+class EventHistory(object):
+    """Ring buffer of EventRecords, with subscribers.
+
+    @ivar records: the most recent records
+    @type records: deque
+    """
+    def __init__(self, capacity=10000):
+        """
+        @param capacity: the number of records kept. 0 means no limit.
+        @type capacity: int
+        """
+        self.records=deque(maxlen=capacity or None)
+        # List of (key, callback, event names) tuples
+        self.subscribers=[]
+        # Dispatch cache: callbacks indexed by event name
+        self._callbacks={}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def subscribe(self, key, callback, events=None):
+        """Subscribe to the recorded events.
+
+        @param key: the key used to unsubscribe
+        @param callback: the function called with each EventRecord
+        @type callback: method
+        @param events: the event names to receive. If None, receive all events.
+        @type events: list
+        """
+        if events is not None:
+            events=frozenset(events)
+        self.subscribers.append( (key, callback, events) )
+        self._callbacks.clear()
+
+    def unsubscribe(self, key):
+        self.subscribers=[ s for s in self.subscribers if s[0] is not key ]
+        self._callbacks.clear()
+
+    def get_callbacks(self, event_name):
+        try:
+            return self._callbacks[event_name]
+        except KeyError:
+            l=self._callbacks[event_name]=[ callback
+                                            for (key, callback, events) in self.subscribers
+                                            if events is None or event_name in events ]
+            return l
+
+    def record(self, event_name, kw, args=()):
+        """Record an event and dispatch it to its subscribers.
+
+        @param event_name: the event name
+        @param kw: the event parameters
+        @type kw: dict
+        @param args: the anonymous parameters
+        @return: the EventRecord
+        """
+        callbacks=self.get_callbacks(event_name)
+        # The element contents are only needed by subscribers
+        with_content=bool(callbacks)
+        params=[ (k, compact_value(v, with_content)) for (k, v) in kw.iteritems() ]
+        if args:
+            params.append( ('parameters', compact_value(args)) )
+        r=EventRecord(event_name, time.time(), tuple(params))
+        self.records.append(r)
+        for callback in callbacks:
+            callback(r)
+        return r
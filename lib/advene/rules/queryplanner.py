@@ -0,0 +1,272 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Query planner for SimpleQuery.
+
+Conditions whose left-hand side is a common annotation path
+(element/fragment/begin, element/type/id, element/content/data...)
+and whose right-hand side does not depend on the element are
+evaluated over columns of annotation attributes, instead of
+evaluating the TALES expressions for each element. Numerical
+comparisons and Allen relations are vectorised with NumPy when it is
+available. Other conditions are evaluated through TALES for the
+remaining elements.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from advene.model.annotation import Annotation
+from advene.model.fragment import MillisecondFragment
+
+# Recognized lhs expressions, and the corresponding column
+PATHS = {
+    'element': 'element',
+    'element/id': 'id',
+    'element/fragment/begin': 'begin',
+    'element/fragment/end': 'end',
+    'element/fragment/duration': 'duration',
+    'element/type/id': 'type',
+    'element/tags': 'tags',
+    'element/content/data': 'data',
+    }
+
+NUMERIC_COLUMNS = ('begin', 'end', 'duration')
+
+# For each operator, the (lhs, rhs) conversion modes used by
+# Condition.convert_value, and the numerical comparison
+NUMERIC_OPERATORS = {
+    'equals': ('begin', 'begin', lambda l, r: l == r),
+    'different': ('begin', 'begin', lambda l, r: l != r),
+    'greater': ('end', 'begin', lambda l, r: l >= r),
+    'lower': ('end', 'begin', lambda l, r: l <= r),
+    'before': ('end', 'begin', lambda l, r: l <= r),
+    'meets': ('end', 'begin', lambda l, r: l == r),
+    'starts': ('begin', 'begin', lambda l, r: l == r),
+    'finishes': ('end', 'end', lambda l, r: l == r),
+    }
+
+class Columns(object):
+    """Attribute columns of a list of annotations, built on demand.
+    """
+    def __init__(self, annotations):
+        self.annotations = annotations
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.annotations)
+
+    def get(self, name):
+        """Return the list of values for the given column.
+        """
+        try:
+            return self._columns[name]
+        except KeyError:
+            pass
+        annotations = self.annotations
+        if name == 'element':
+            c = annotations
+        elif name == 'id':
+            c = [ a.id for a in annotations ]
+        elif name == 'begin':
+            c = [ a.fragment.begin for a in annotations ]
+        elif name == 'end':
+            c = [ a.fragment.end for a in annotations ]
+        elif name == 'duration':
+            c = [ a.fragment.duration for a in annotations ]
+        elif name == 'type':
+            c = [ a.type.id for a in annotations ]
+        elif name == 'tags':
+            c = [ a.tags for a in annotations ]
+        elif name == 'data':
+            c = [ a.content.data for a in annotations ]
+        else:
+            raise KeyError(name)
+        self._columns[name] = c
+        return c
+
+    def array(self, name):
+        """Return the numerical column as a NumPy array.
+        """
+        key = (name, 'array')
+        try:
+            return self._columns[key]
+        except KeyError:
+            pass
+        if name == 'element':
+            raise KeyError(name)
+        c = self._columns[key] = numpy.array(self.get(name), dtype=numpy.float64)
+        return c
+
+def _is_number(v):
+    return isinstance(v, (int, long, float)) and not isinstance(v, bool)
+
+def _fragment_bounds(v):
+    """Return the (begin, end) of an annotation or fragment, or None.
+    """
+    if isinstance(v, Annotation):
+        v = v.fragment
+    if isinstance(v, MillisecondFragment):
+        return (v.begin, v.end)
+    return None
+
+def _vector_filter(condition, column, columns, rv):
+    """Try to evaluate the condition with NumPy.
+
+    @return: a boolean array, or None if it is not possible
+    """
+    op = condition.operator
+    if op in NUMERIC_OPERATORS:
+        lmode, rmode, compare = NUMERIC_OPERATORS[op]
+        try:
+            r = condition.convert_value(rv, rmode)
+        except Exception:
+            return None
+        if not _is_number(r):
+            return None
+        if column == 'element':
+            column = lmode
+        return compare(columns.array(column), float(r))
+    elif op in ('overlaps', 'during') and column == 'element':
+        bounds = _fragment_bounds(rv)
+        if bounds is None:
+            return None
+        rb, re = bounds
+        b = columns.array('begin')
+        e = columns.array('end')
+        if op == 'overlaps':
+            return ((rb <= b) & (b <= re)) | ((b <= rb) & (rb <= e))
+        else:
+            return (rb <= b) & (e <= re)
+    return None
+
+def plan(condition):
+    """Check whether a condition can be evaluated over columns.
+
+    @return: the column name, or None
+    """
+    if condition.is_true():
+        return None
+    column = PATHS.get(condition.lhs)
+    if column is None:
+        return None
+    if condition.operator in ('value', 'not'):
+        return column
+    if (condition.operator in condition.binary_operators
+        and condition.get_comparator() is not None
+        and condition.rhs is not None
+        and not 'element' in condition.rhs):
+        return column
+    return None
+
+def evaluate(condition, column, columns, context):
+    """Evaluate a planned condition over the columns.
+
+    @return: a list (or array) of booleans
+    """
+    values = columns.get(column)
+    op = condition.operator
+    if op == 'value':
+        return [ bool(v) for v in values ]
+    elif op == 'not':
+        return [ not v for v in values ]
+    rv = context.evaluateValue(condition.rhs)
+    if numpy is not None and (column == 'element' or column in NUMERIC_COLUMNS):
+        mask = _vector_filter(condition, column, columns, rv)
+        if mask is not None:
+            return mask
+    compare = condition.get_comparator()
+    return [ bool(compare(v, rv)) for v in values ]
+
+def filter_elements(elements, condition, context):
+    """Return the elements matching condition.
+
+    Planned conditions are evaluated over columns, the other ones
+    through TALES with the 'element' local variable set, as in
+    SimpleQuery.
+
+    @param elements: the elements
+    @type elements: list
+    @param condition: the condition
+    @type condition: Condition or ConditionList
+    @param context: the TALES context
+    @return: the list of matching elements, or None if the query cannot be planned
+    """
+    if not elements:
+        return None
+    for e in elements:
+        if not isinstance(e, Annotation) or not isinstance(e.fragment, MillisecondFragment):
+            return None
+    if hasattr(condition, 'composition'):
+        conditions = list(condition)
+        composition = condition.composition
+    else:
+        conditions = [ condition ]
+        composition = 'and'
+    planned = []
+    remaining = []
+    for c in conditions:
+        column = plan(c)
+        if column is None:
+            remaining.append(c)
+        else:
+            planned.append( (c, column) )
+    if not planned or (remaining and composition != 'and'):
+        return None
+
+    columns = Columns(elements)
+    mask = None
+    for c, column in planned:
+        try:
+            m = evaluate(c, column, columns, context)
+        except Exception:
+            # Let the standard evaluation handle (and report) the error
+            return None
+        if mask is None:
+            mask = m
+        elif numpy is not None and (isinstance(mask, numpy.ndarray) or isinstance(m, numpy.ndarray)):
+            if composition == 'and':
+                mask = numpy.logical_and(mask, m)
+            else:
+                mask = numpy.logical_or(mask, m)
+        elif composition == 'and':
+            mask = [ a and b for (a, b) in zip(mask, m) ]
+        else:
+            mask = [ a or b for (a, b) in zip(mask, m) ]
+
+    if numpy is not None and isinstance(mask, numpy.ndarray):
+        result = [ elements[i] for i in numpy.flatnonzero(mask) ]
+    else:
+        result = [ e for (e, m) in zip(elements, mask) if m ]
+
+    if remaining:
+        matches = [ c.compile() for c in remaining ]
+        context.pushLocals()
+        res = []
+        for e in result:
+            context.setLocal('element', e)
+            for match in matches:
+                if not match(context):
+                    break
+            else:
+                res.append(e)
+        context.popLocals()
+        result = res
+    return result
@@ -133,6 +133,11 @@ class GenericImporter(object):
     """
     name = _("Generic importer")
 
+    # Number of annotations created in a single operation by
+    # convert. Importers whose iterator looks up the previously
+    # converted annotations in the package should set it to 1.
+    batch_size = 1000
+
     def __init__(self, author=None, package=None, defaulttype=None, controller=None, callback=None):
         self.package=package
         if author is None:
@@ -142,6 +147,8 @@ class GenericImporter(object):
         self.timestamp=time.strftime("%Y-%m-%d")
         self.defaulttype=defaulttype
         self.callback=callback
+        # Last progress value
+        self.progress_value=None
         # Default offset in ms
         self.offset=0
         # Dictionary holding the number of created elements
@@ -179,6 +186,7 @@ class GenericImporter(object):
         cancelled by returning False. In this case, the Importer
         should take this information into account and cleanly exit.
         """
+        self.progress_value=value
         if self.callback:
             return self.callback(min(value, 1.0), label)
         else:
@@ -228,8 +236,8 @@ class GenericImporter(object):
         else:
             print " ".join(p)
 
-    def update_statistics(self, elementtype):
-        self.statistics[elementtype] = self.statistics.get(elementtype, 0) + 1
+    def update_statistics(self, elementtype, count=1):
+        self.statistics[elementtype] = self.statistics.get(elementtype, 0) + count
 
     def ensure_new_type(self, prefix="at_converted", title="Converted data", schemaid=None):
         """Create a new type.
@@ -299,10 +307,39 @@ class GenericImporter(object):
                            timestamp=None, title=None):
         """Create an annotation in the package
         """
-        begin += self.offset
-        end += self.offset
         if ident is None and self.controller is not None:
             ident=self.controller.package._idgenerator.get_id(Annotation)
+        a=self.build_annotation(type_, begin, end, data, ident, author, timestamp, title)
+        self.package.annotations.append(a)
+        self.update_statistics('annotation')
+        return a
+
+    def create_annotations(self, batch):
+        """Create annotations in the package, in a single operation.
+
+        @param batch: the create_annotation parameters of each annotation
+        @type batch: list of dict
+        @return: the created annotations
+        @rtype: list
+        """
+        if self.controller is not None:
+            l=[ d for d in batch if d.get('ident') is None ]
+            if l:
+                ids=self.controller.package._idgenerator.get_ids(Annotation, len(l))
+                for (d, i) in zip(l, ids):
+                    d['ident']=i
+        annotations=[ self.build_annotation(**d) for d in batch ]
+        self.package.annotations.extend(annotations)
+        self.update_statistics('annotation', len(annotations))
+        return annotations
+
+    def build_annotation (self, type_=None, begin=None, end=None,
+                          data=None, ident=None, author=None,
+                          timestamp=None, title=None):
+        """Build an annotation, without adding it to the package.
+        """
+        begin += self.offset
+        end += self.offset
 
         if ident is None:
             a=self.package.createAnnotation(type=type_,
@@ -315,8 +352,6 @@ class GenericImporter(object):
         a.date=timestamp
         a.title=title
         a.content.data = data
-        self.package.annotations.append(a)
-        self.update_statistics('annotation')
         return a
 
     def statistics_formatted(self):
@@ -375,9 +410,17 @@ class GenericImporter(object):
           - notify: if True, then each annotation creation will generate a AnnotationCreate signal
           - complete: boolean. Used to mark the completeness of the annotation.
           - send: yield should return the created annotation
+
+        The annotations are created in batches of batch_size
+        elements. The annotations with notify or send are created
+        immediately.
         """
         if self.package is None:
             self.package, self.defaulttype=self.init_package(annotationtypeid='imported', schemaid='imported-schema')
+        # List of (create_annotation parameters, source dict)
+        batch=[]
+        count=0
+        t=reported=time.time()
         for d in source:
             try:
                 begin=helper.parse_time(d['begin'])
@@ -429,15 +472,46 @@ class GenericImporter(object):
             except KeyError:
                 timestamp=self.timestamp
 
-            a=self.create_annotation (type_=type_,
-                                      begin=begin,
-                                      end=end,
-                                      data=content,
-                                      ident=ident,
-                                      author=author,
-                                      title=title,
-                                      timestamp=timestamp)
-            self.package._modified = True
+            batch.append( (dict(type_=type_,
+                                begin=begin,
+                                end=end,
+                                data=content,
+                                ident=ident,
+                                author=author,
+                                title=title,
+                                timestamp=timestamp), d) )
+            if (len(batch) >= self.batch_size
+                or d.get('notify') or 'send' in d):
+                self.convert_batch(batch, source)
+                count += len(batch)
+                batch=[]
+                now=time.time()
+                if now - reported > .5:
+                    reported=now
+                    if not self.progress(self.progress_value or 0.0,
+                                         _("Converted %(count)d annotations (%(rate)d/s)") % {
+                            'count': count,
+                            'rate': count / (now - t) }):
+                        break
+        if batch:
+            self.convert_batch(batch, source)
+            count += len(batch)
+        duration=time.time() - t
+        if count > self.batch_size:
+            self.log(_("Converted %(count)d annotations in %(duration).2fs (%(rate)d/s)") % {
+                    'count': count,
+                    'duration': duration,
+                    'rate': count / duration if duration else 0 })
+
+    def convert_batch(self, batch, source):
+        """Create the annotations for a batch of source elements.
+
+        @param batch: list of (create_annotation parameters, source dict) tuples
+        @param source: the source iterator
+        """
+        annotations=self.create_annotations([ params for (params, d) in batch ])
+        self.package._modified = True
+        for (a, (params, d)) in zip(annotations, batch):
             if 'complete' in d:
                 a.complete=d['complete']
             if 'notify' in d and d['notify'] and self.controller is not None:
@@ -984,6 +1058,8 @@ class ElanImporter(GenericImporter):
     """Elan importer.
     """
     name=_("ELAN importer")
+    # The iterator looks up the related annotations
+    batch_size = 1
 
     def __init__(self, **kw):
         super(ElanImporter, self).__init__(**kw)
@@ -1560,6 +1636,8 @@ class IRIImporter(GenericImporter):
     """IRI importer.
     """
     name = _("IRI importer")
+    # The iterator looks up the referenced annotations
+    batch_size = 1
 
     def __init__(self, **kw):
         super(IRIImporter, self).__init__(**kw)
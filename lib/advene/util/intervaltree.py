@@ -0,0 +1,360 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Interval index module.
+
+The L{IntervalTree} class stores (begin, end) intervals indexed by a
+unique key. It is implemented as two randomized balanced trees
+(treaps), one ordered by begin and augmented with the maximum end
+value of each subtree, one ordered by end. It answers the following
+queries in logarithmic time (plus the size of the result):
+  - at(t): intervals active at time t (begin <= t < end)
+  - starting(t1, t2): intervals beginning in [t1, t2)
+  - ending(t1, t2): intervals ending in [t1, t2)
+  - next_boundary(t): first begin or end value after t
+
+Insertion, removal and update are also logarithmic.
+
+The L{AnnotationIndex} class specializes it for the annotations of a
+package.
+"""
+
+import random
+
+class _Node(object):
+    __slots__ = ('key', 'value', 'priority', 'left', 'right', 'maxend')
+
+    def __init__(self, key, value, priority=None):
+        self.key = key
+        self.value = value
+        if priority is None:
+            priority = random.random()
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.maxend = key[1]
+
+def _fix(node):
+    """Update the maxend augmentation of node.
+    """
+    m = node.key[1]
+    if node.left is not None and node.left.maxend > m:
+        m = node.left.maxend
+    if node.right is not None and node.right.maxend > m:
+        m = node.right.maxend
+    node.maxend = m
+
+def _rotate_right(node):
+    l = node.left
+    node.left = l.right
+    l.right = node
+    _fix(node)
+    _fix(l)
+    return l
+
+def _rotate_left(node):
+    r = node.right
+    node.right = r.left
+    r.left = node
+    _fix(node)
+    _fix(r)
+    return r
+
+def _insert(node, new):
+    if node is None:
+        return new
+    if new.key < node.key:
+        node.left = _insert(node.left, new)
+        if node.left.priority > node.priority:
+            return _rotate_right(node)
+    else:
+        node.right = _insert(node.right, new)
+        if node.right.priority > node.priority:
+            return _rotate_left(node)
+    _fix(node)
+    return node
+
+def _merge(left, right):
+    """Merge two treaps, all keys of left being lower than keys of right.
+    """
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _fix(left)
+        return left
+    else:
+        right.left = _merge(left, right.left)
+        _fix(right)
+        return right
+
+def _delete(node, key):
+    if node is None:
+        raise KeyError(key)
+    if key < node.key:
+        node.left = _delete(node.left, key)
+    elif key > node.key:
+        node.right = _delete(node.right, key)
+    else:
+        return _merge(node.left, node.right)
+    _fix(node)
+    return node
+
+def _range(node, lo, hi, out):
+    """Append to out the values whose key[0] is in [lo, hi), in key order.
+    """
+    if node is None:
+        return
+    k = node.key[0]
+    if k >= lo:
+        _range(node.left, lo, hi, out)
+        if k < hi:
+            out.append(node.value)
+    if k < hi:
+        _range(node.right, lo, hi, out)
+
+def _stab(node, t, out):
+    """Append to out the values such that key[0] <= t < key[1], in key order.
+    """
+    if node is None or node.maxend <= t:
+        return
+    _stab(node.left, t, out)
+    if node.key[0] <= t:
+        if node.key[1] > t:
+            out.append(node.value)
+        _stab(node.right, t, out)
+
+def _first(node, lo):
+    """Return the smallest key[0] greater than or equal to lo, or None.
+    """
+    res = None
+    while node is not None:
+        if node.key[0] >= lo:
+            res = node.key[0]
+            node = node.left
+        else:
+            node = node.right
+    return res
+
+def _build(keys, values):
+    """Build a balanced treap from a sorted list of keys.
+
+    values is a dict mapping key[2] to the stored value. Priorities
+    decrease with the depth of the node, so that the heap property is
+    respected.
+    """
+    if not keys:
+        return None
+    depth = float(len(keys).bit_length() + 1)
+    nodes = [ None ] * len(keys)
+    root = None
+    # Breadth-first traversal of the implicit balanced tree
+    queue = [ (0, len(keys), None, False, 0) ]
+    for lo, hi, parent, is_left, level in queue:
+        mid = (lo + hi) // 2
+        key = keys[mid]
+        n = _Node(key, values[key[2]][2], 1.0 - (level + 1) / depth)
+        nodes[mid] = n
+        if parent is None:
+            root = n
+        elif is_left:
+            parent.left = n
+        else:
+            parent.right = n
+        if lo < mid:
+            queue.append( (lo, mid, n, True, level + 1) )
+        if mid + 1 < hi:
+            queue.append( (mid + 1, hi, n, False, level + 1) )
+    # Fix the maxend augmentation bottom-up
+    for i in xrange(len(queue) - 1, -1, -1):
+        lo, hi = queue[i][:2]
+        _fix(nodes[(lo + hi) // 2])
+    return root
+
+class IntervalTree(object):
+    """Index of (begin, end) intervals identified by a unique key.
+
+    The stored value (by default the key itself) is returned by
+    queries, in begin (resp. end) order.
+    """
+    def __init__(self, items=None):
+        # key -> (begin, end, value)
+        self._intervals = {}
+        self._by_begin = None
+        self._by_end = None
+        if items is not None:
+            self.build(items)
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def __contains__(self, key):
+        return key in self._intervals
+
+    def get(self, key, default=None):
+        """Return the (begin, end) interval for key.
+        """
+        try:
+            b, e, v = self._intervals[key]
+            return (b, e)
+        except KeyError:
+            return default
+
+    def clear(self):
+        self._intervals.clear()
+        self._by_begin = None
+        self._by_end = None
+
+    def build(self, items):
+        """Rebuild the index from an iterable of (key, begin, end, value).
+        """
+        self.clear()
+        intervals = self._intervals
+        for key, b, e, v in items:
+            intervals[key] = (b, e, v)
+        begins = sorted( (b, e, key) for key, (b, e, v) in intervals.iteritems() )
+        self._by_begin = _build(begins, intervals)
+        ends = sorted( (e, e, key) for key, (b, e, v) in intervals.iteritems() )
+        self._by_end = _build(ends, intervals)
+
+    def add(self, key, begin, end, value=None):
+        """Add an interval. If key already exists, it is updated.
+        """
+        if value is None:
+            value = key
+        if key in self._intervals:
+            self.remove(key)
+        self._intervals[key] = (begin, end, value)
+        self._by_begin = _insert(self._by_begin, _Node((begin, end, key), value))
+        self._by_end = _insert(self._by_end, _Node((end, end, key), value))
+
+    def remove(self, key):
+        """Remove the interval identified by key.
+
+        @raise KeyError: if the key is not in the index
+        """
+        b, e, v = self._intervals.pop(key)
+        self._by_begin = _delete(self._by_begin, (b, e, key))
+        self._by_end = _delete(self._by_end, (e, e, key))
+
+    def update(self, key, begin, end, value=None):
+        """Update the interval for key, if it has changed.
+        """
+        try:
+            b, e, v = self._intervals[key]
+        except KeyError:
+            b = e = v = None
+        if value is None:
+            value = v if v is not None else key
+        if b != begin or e != end or v is not value:
+            self.add(key, begin, end, value)
+
+    def at(self, t):
+        """Return the values active at t (begin <= t < end), in begin order.
+        """
+        res = []
+        _stab(self._by_begin, t, res)
+        return res
+
+    def starting(self, t1, t2):
+        """Return the values beginning in [t1, t2), in begin order.
+        """
+        res = []
+        _range(self._by_begin, t1, t2, res)
+        return res
+
+    def ending(self, t1, t2):
+        """Return the values ending in [t1, t2), in end order.
+        """
+        res = []
+        _range(self._by_end, t1, t2, res)
+        return res
+
+    def next_boundary(self, t):
+        """Return the first begin or end value greater than or equal to t.
+
+        @return: the boundary value, or None if there is none
+        """
+        b = _first(self._by_begin, t)
+        e = _first(self._by_end, t)
+        if b is None:
+            return e
+        if e is None:
+            return b
+        return min(b, e)
+
+class AnnotationIndex(IntervalTree):
+    """Interval index over the annotations of a package.
+
+    Keys are annotation ids, values are the annotations themselves.
+
+    Modifications of the annotation fragments are reported by the
+    package change listeners, and applied on the next check().
+    """
+    def __init__(self, package=None):
+        IntervalTree.__init__(self)
+        self.package = package
+        # Annotations modified since the last check
+        self._changed = set()
+        if package is not None:
+            package._change_listeners.append(self.element_changed)
+            self.rebuild()
+
+    def rebuild(self):
+        """Rebuild the index from the package annotations.
+        """
+        self._changed.clear()
+        self.build( (a.id, a.fragment.begin, a.fragment.end, a)
+                    for a in self.package.annotations )
+
+    def element_changed(self, element):
+        """Package change listener.
+        """
+        if element.id in self._intervals:
+            self._changed.add(element)
+
+    def add_annotation(self, a):
+        self.add(a.id, a.fragment.begin, a.fragment.end, a)
+
+    def update_annotation(self, a):
+        self.update(a.id, a.fragment.begin, a.fragment.end, a)
+
+    def remove_annotation(self, a):
+        try:
+            self.remove(a.id)
+        except KeyError:
+            pass
+
+    def check(self):
+        """Update the index with the modified fragments.
+
+        It is rebuilt if it is obviously out of sync with the package,
+        since bulk operations (imports, merges) may add or remove
+        annotations without notifying each of them.
+        """
+        if len(self) != len(self.package.annotations):
+            self.rebuild()
+        elif self._changed:
+            changed = self._changed
+            self._changed = set()
+            for a in changed:
+                if a.id in self._intervals:
+                    self.update_annotation(a)
+        return self
@@ -31,6 +31,7 @@ This will capture snapshots for the given timestamps (in ms) and save them into
 """
 import sys
 import os
+import time
 
 import gobject
 import gst
@@ -114,26 +115,56 @@ class Snapshotter(object):
 
     Basic idea: define a "notify" method, which will get a gst.Buffer
     as parameter. The buffer contains the PNG-encoded snapshot (and
-    its timestamp in buffer.timestamp).
+    its timestamp in buffer.timestamp). The notify method also gets
+    the current throughput (in snapshots per second) as "throughput"
+    keyword parameter.
 
     When you need to have a snapshot at a specific timestamp, call
     s.enqueue class with the timestamp. You notify method will be
     called with the result.
 
+    Pending timestamps are processed by sorted batches of timestamps
+    close enough to each other (less than step_threshold ms), so that
+    the pipeline decodes forward with a step event instead of doing a
+    flushing accurate seek, which avoids decoding again from the
+    previous keyframe. A batch holds at most batch_size timestamps,
+    and its share of the pending timestamps when the queue is shared
+    by several snapshotters.
+
     Setup note: the Snapshotter class runs a daemon thread
     continuously waiting for timestamps to process. Thus you should:
     * call gtk.gdk.threads_init() at the beginning of you application
     * invoke the "start" method to start the thread.
     """
-    def __init__(self, notify=None, width=None):
+    # Maximum distance (in ms) for which we decode forward instead of seeking
+    step_threshold = 2000
+    # Maximum number of timestamps processed in a batch
+    batch_size = 50
+    # Maximum time (in s) to wait for a snapshot
+    timeout = 10
+
+    def __init__(self, notify=None, width=None, queue=None):
         self.notify=notify
-        # Snapshot queue handling
-        self.timestamp_queue=UniquePriorityQueue()
+        # Snapshot queue handling. The queue may be shared with other
+        # snapshotters (see SnapshotterPool).
+        if queue is None:
+            queue=UniquePriorityQueue()
+        self.timestamp_queue=queue
+        # Number of snapshotters sharing the queue
+        self.workers=1
 
         self.snapshot_ready=Event()
+        self.snapshot_ready.set()
         self.thread_running=False
         self.should_clear = False
 
+        # Timestamp (in ms) of the last captured buffer
+        self.last_position = None
+        # Throughput (in snapshots per second) for the current batch
+        self.throughput = 0.0
+        self.batch_start = None
+        self.batch_count = 0
+
         # Pipeline building
         self.videobin=gst.Bin()
 
@@ -179,7 +210,7 @@ class Snapshotter(object):
         if message.structure.get_name() != 'missing-plugin':
             print "Bus message::", message.structure.get_name()
 
-    def simple_notify(self, buffer):
+    def simple_notify(self, buffer, throughput=None):
         """Basic single-snapshot method.
 
         Used for debugging.
@@ -189,18 +220,29 @@ class Snapshotter(object):
         f=open(fname, 'w')
         f.write(buffer.data)
         f.close()
-        print "Snapshot written to", fname
+        print "Snapshot written to", fname, "(%.1f snapshots/s)" % (throughput or 0)
         return True
 
     def snapshot(self, t):
         """Set movie time to a specific time.
+
+        If t is a little after the last captured position, decode
+        forward with a step event. Else do a flushing accurate seek.
         """
         p = long(t * gst.MSECOND)
+        self.player.set_state(gst.STATE_PAUSED)
+        if (self.last_position is not None
+            and 0 < t - self.last_position <= self.step_threshold
+            and hasattr(gst, 'event_new_step')):
+            event = gst.event_new_step(gst.FORMAT_TIME,
+                                       long((t - self.last_position) * gst.MSECOND),
+                                       1.0, True, False)
+            if self.player.send_event(event):
+                return True
         event = gst.event_new_seek(1.0, gst.FORMAT_TIME,
                                    gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE,
                                    gst.SEEK_TYPE_SET, p,
                                    gst.SEEK_TYPE_NONE, 0)
-        self.player.set_state(gst.STATE_PAUSED)
         res = self.player.send_event(event)
         if not res:
             print "snapshotter: error when sending event"
@@ -211,7 +253,41 @@ class Snapshotter(object):
         """
         for t in l:
             self.timestamp_queue.put_nowait( (t, t) )
-        self.snapshot_ready.set()
+
+    def get_batch(self):
+        """Get a sorted batch of timestamps from the queue.
+
+        This method blocks until at least 1 timestamp is available.
+        """
+        q = self.timestamp_queue
+        batch = [ q.get()[0] ]
+        # Leave their share of the pending timestamps to the other
+        # snapshotters
+        size = min(self.batch_size, max(1, (q.qsize() + 1) // self.workers))
+        try:
+            while len(batch) < size:
+                item = q.get_nowait()
+                if item[0] - batch[-1] > self.step_threshold:
+                    # It would need a seek: let any snapshotter take it
+                    q.put_nowait(item)
+                    break
+                batch.append(item[0])
+        except Queue.Empty:
+            pass
+        return batch
+
+    def flush_queue(self):
+        """Remove all pending timestamps from the queue.
+        """
+        self.should_clear = False
+        while True:
+            try:
+                # FIXME: this could potentially deadlock, if
+                # there is a producer thread that continuously
+                # adds new elements.
+                self.timestamp_queue.get_nowait()
+            except Queue.Empty:
+                break
 
     def process_queue(self):
         """Process the timestamp queue.
@@ -220,25 +296,21 @@ class Snapshotter(object):
         """
         self.thread_running=True
         while True:
-            #print "Waiting for event"
-            self.snapshot_ready.wait()
-            #print "Getting timestamp"
             if self.should_clear:
-                # Clear the queue
-                self.should_clear = False
-                while True:
-                    try:
-                        # FIXME: this could potentially deadlock, if
-                        # there is a producer thread that continuously
-                        # adds new elements.
-                        self.timestamp_queue.get_nowait()
-                    except Queue.Empty:
-                        break
-            (t, dummy) = self.timestamp_queue.get()
-            #print "Clearing event"
-            self.snapshot_ready.clear()
-            #print "Snapshot", t
-            self.snapshot(t)
+                self.flush_queue()
+            batch = self.get_batch()
+            self.batch_start = time.time()
+            self.batch_count = 0
+            for t in batch:
+                if self.should_clear:
+                    break
+                self.snapshot_ready.clear()
+                self.snapshot(t)
+                if not self.snapshot_ready.wait(self.timeout):
+                    # No buffer (e.g. beyond the end of the
+                    # stream). Seek for the next timestamp.
+                    self.last_position = None
+                    self.snapshot_ready.set()
         return True
 
     def clear(self):
@@ -254,8 +326,14 @@ class Snapshotter(object):
         It processes the captured buffer and unlocks the
         snapshot_event to process further timestamps.
         """
+        self.last_position = buffer.timestamp / gst.MSECOND
+        self.batch_count += 1
+        if self.batch_start is not None:
+            duration = time.time() - self.batch_start
+            if duration > 0:
+                self.throughput = self.batch_count / duration
         if self.notify is not None:
-            self.notify(buffer)
+            self.notify(buffer, throughput=self.throughput)
         # We are ready to process the next snapshot
         self.snapshot_ready.set()
         return True
@@ -267,6 +345,59 @@ class Snapshotter(object):
         t.setDaemon(True)
         t.start()
 
+class SnapshotterPool(object):
+    """Pool of snapshotters sharing a single timestamp queue.
+
+    Each snapshotter runs its own pipeline in its own thread, so that
+    independent parts of the movie are decoded in parallel. The API is
+    the same as the Snapshotter one. The throughput given to the
+    notify method is the sum of the throughputs of all snapshotters.
+    """
+    def __init__(self, notify=None, width=None, workers=2):
+        self.notify=notify
+        self.timestamp_queue=UniquePriorityQueue()
+        self.snapshotters=[ Snapshotter(self.queue_notify, width=width, queue=self.timestamp_queue)
+                            for i in xrange(max(1, workers)) ]
+        for s in self.snapshotters:
+            s.workers=len(self.snapshotters)
+
+    @property
+    def thread_running(self):
+        return all(s.thread_running for s in self.snapshotters)
+
+    @property
+    def throughput(self):
+        return sum(s.throughput for s in self.snapshotters)
+
+    def set_uri(self, uri):
+        for s in self.snapshotters:
+            s.set_uri(uri)
+
+    def enqueue(self, *l):
+        """Enqueue timestamps to capture.
+        """
+        for t in l:
+            self.timestamp_queue.put_nowait( (t, t) )
+
+    def clear(self):
+        """Clear the queue.
+        """
+        for s in self.snapshotters:
+            s.clear()
+        return True
+
+    def queue_notify(self, buffer, throughput=None):
+        if self.notify is not None:
+            self.notify(buffer, throughput=self.throughput)
+        return True
+
+    def start(self):
+        """Start the snapshotter threads.
+        """
+        for s in self.snapshotters:
+            if not s.thread_running:
+                s.start()
+
 if __name__ == '__main__':
     try:
         uri=sys.argv[1]
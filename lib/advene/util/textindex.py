@@ -0,0 +1,253 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Text index module.
+
+The L{TextIndex} class is an inverted index over the annotations of a
+package, used by the quicksearch. It indexes:
+  - the n-grams (trigrams by default) of the lower-cased annotation
+    contents. A searched string is first looked up through the n-grams
+    it contains, and the candidates are then checked against the
+    indexed content, so that the result is the same as a substring
+    search.
+  - the tags of annotations and relations.
+
+The index is built on the first query, and updated incrementally
+afterwards, from the controller events and from the package change
+listeners (for modifications which are not notified).
+"""
+
+import itertools
+
+class TextIndex(object):
+    """Inverted index over annotation contents and element tags.
+    """
+    # Length of the indexed n-grams
+    ngram = 3
+
+    def __init__(self, package=None):
+        self.package = package
+        # annotation -> lower-cased content data
+        self._data = None
+        # n-gram -> set of annotations
+        self._ngrams = {}
+        # element -> tuple of lower-cased tags
+        self._element_tags = {}
+        # lower-cased tag -> set of elements
+        self._tags = {}
+        # Elements modified since the last check
+        self._changed = set()
+        if package is not None:
+            package._change_listeners.append(self.element_changed)
+
+    def __len__(self):
+        if self._data is None:
+            return 0
+        return len(self._data)
+
+    def is_built(self):
+        return self._data is not None
+
+    def clear(self):
+        self._data = None
+        self._ngrams.clear()
+        self._element_tags.clear()
+        self._tags.clear()
+        self._changed.clear()
+
+    def get_ngrams(self, s):
+        """Return the set of n-grams of the string s.
+        """
+        n = self.ngram
+        return set( s[i:i+n] for i in xrange(len(s) - n + 1) )
+
+    def rebuild(self):
+        """Rebuild the index from the package annotations and relations.
+        """
+        self.clear()
+        self._data = {}
+        for a in self.package.annotations:
+            self._add_annotation(a)
+        for r in self.package.relations:
+            self._add_tags(r)
+
+    def check(self):
+        """Build the index if necessary.
+
+        It is also rebuilt if it is obviously out of sync with the
+        package, since bulk operations (imports, merges) may add or
+        remove annotations without notifying each of them.
+        """
+        if self._data is None or len(self._data) != len(self.package.annotations):
+            self.rebuild()
+        elif self._changed:
+            changed = self._changed
+            self._changed = set()
+            for e in changed:
+                if e in self._data:
+                    # Fragment modifications are also reported
+                    if (self._data[e] != e.content.data.lower()
+                        or self._element_tags.get(e) != tuple( t.lower() for t in e.tags )):
+                        self.update_annotation(e)
+                elif e in self._element_tags:
+                    self.update_element(e)
+        return self
+
+    def element_changed(self, element):
+        """Package change listener.
+        """
+        if self._data is not None:
+            self._changed.add(element)
+
+    def _add_annotation(self, a):
+        data = a.content.data.lower()
+        self._data[a] = data
+        ngrams = self._ngrams
+        for g in self.get_ngrams(data):
+            s = ngrams.get(g)
+            if s is None:
+                s = ngrams[g] = set()
+            s.add(a)
+        self._add_tags(a)
+
+    def _add_tags(self, e):
+        tags = tuple( t.lower() for t in e.tags )
+        self._element_tags[e] = tags
+        for t in tags:
+            self._tags.setdefault(t, set()).add(e)
+
+    def _remove_tags(self, e):
+        for t in self._element_tags.pop(e, ()):
+            s = self._tags.get(t)
+            if s is not None:
+                s.discard(e)
+                if not s:
+                    del self._tags[t]
+
+    def remove_annotation(self, a):
+        if self._data is None:
+            return
+        data = self._data.pop(a, None)
+        if data is not None:
+            for g in self.get_ngrams(data):
+                s = self._ngrams.get(g)
+                if s is not None:
+                    s.discard(a)
+                    if not s:
+                        del self._ngrams[g]
+        self._remove_tags(a)
+
+    def update_annotation(self, a):
+        """Update (or add) the indexed data for the annotation a.
+        """
+        if self._data is None:
+            return
+        self.remove_annotation(a)
+        self._add_annotation(a)
+
+    def update_element(self, e):
+        """Update the indexed tags of a non-annotation element.
+        """
+        if self._data is None:
+            return
+        self._remove_tags(e)
+        self._add_tags(e)
+
+    def remove_element(self, e):
+        if self._data is None:
+            return
+        self._remove_tags(e)
+
+    def covers(self, e):
+        """Check whether the content of e is indexed.
+        """
+        return self._data is not None and e in self._data
+
+    def covers_tags(self, e):
+        """Check whether the tags of e are indexed.
+        """
+        return e in self._element_tags
+
+    def matching(self, s, case_sensitive=False):
+        """Return the set of annotations whose content contains s.
+        """
+        l = s.lower()
+        data = self._data
+        if len(l) < self.ngram:
+            candidates = data.iterkeys()
+        else:
+            sets = sorted( (self._ngrams.get(g, ()) for g in self.get_ngrams(l)), key=len )
+            if not sets[0]:
+                return set()
+            candidates = sets[0].intersection(*sets[1:])
+        if case_sensitive:
+            return set( a for a in candidates if s in a.content.data )
+        else:
+            return set( a for a in candidates if l in data[a] )
+
+    def tagged(self, tag, case_sensitive=False):
+        """Return the set of elements tagged with tag.
+        """
+        candidates = self._tags.get(tag.lower(), ())
+        if case_sensitive:
+            return set( e for e in candidates if tag in e.tags )
+        else:
+            return set(candidates)
+
+    def search(self, sourcedata, mandatory=None, exceptions=None, normal=None,
+               tags=False, case_sensitive=False, fallback=None):
+        """Filter the elements of sourcedata.
+
+        An element is kept if it matches all mandatory words, none of
+        the exceptions and, if normal words are given, one of them.
+
+        @param sourcedata: the elements to filter
+        @type sourcedata: iterable
+        @param tags: search the tags rather than the contents
+        @type tags: boolean
+        @param fallback: predicate used for elements which are not indexed
+        @type fallback: function
+        @return: the matching elements, in sourcedata order
+        @rtype: list
+        """
+        if tags:
+            match = lambda w: self.tagged(w, case_sensitive)
+            covers = self.covers_tags
+        else:
+            match = lambda w: self.matching(w, case_sensitive)
+            covers = self.covers
+
+        selected = None
+        for w in mandatory or ():
+            s = match(w)
+            selected = s if selected is None else selected & s
+        if normal:
+            s = set(itertools.chain(*[ match(w) for w in normal ]))
+            selected = s if selected is None else selected & s
+        excluded = set()
+        for w in exceptions or ():
+            excluded |= match(w)
+
+        res = []
+        for e in sourcedata:
+            if covers(e):
+                if (selected is None or e in selected) and e not in excluded:
+                    res.append(e)
+            elif fallback is not None and fallback(e):
+                res.append(e)
+        return res
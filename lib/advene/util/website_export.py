@@ -25,6 +25,18 @@ import re
 import urllib
 import mimetypes
 import shutil
+import hashlib
+import threading
+import Queue
+from cStringIO import StringIO
+try:
+    # In python2.6 stdlib
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
 
 import advene.core.config as config
 import advene.util.helper as helper
@@ -38,20 +50,148 @@ tales_re=re.compile('(\w+)/(.+)')
 player_re=re.compile(r'/media/play(/|\?position=)(\d+)(/(\d+))?')
 overlay_replace_re=re.compile(r'/media/overlay/([^/]+)/([\w\d]+)(/.+)?')
 
+class FileWriter(object):
+    """Bounded pool of threads writing the exported files.
+
+    The data is prepared by the caller (the model is not thread-safe),
+    so that the threads only hash and write it. The submission blocks
+    when too many files are pending.
+
+    Files whose content did not change since the previous export,
+    according to the C{files} dictionary (relative filename -> md5
+    digest, updated as files are written) are not written again.
+
+    @ivar submitted: the number of submitted files
+    @ivar done: the number of processed files
+    @ivar written: the number of actually written files
+    @ivar completed: the names of the files whose data is on disk
+    (written, or identical to the previous export)
+    @ivar errors: a list of (filename, exception) tuples
+    """
+    def __init__(self, destination, files, workers=4):
+        self.destination=destination
+        self.files=files
+        self.queue=Queue.Queue(workers * 4)
+        self.lock=threading.Lock()
+        self.names=set()
+        self.directories=set()
+        self.submitted=0
+        self.done=0
+        self.written=0
+        self.completed=set()
+        self.errors=[]
+        self.cancelled=False
+        self.threads=[]
+        for i in xrange(workers):
+            t=threading.Thread(target=self._run)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def write(self, name, data):
+        """Submit the data to be written in the name file.
+
+        @param name: the filename, relative to the destination directory
+        @param data: the data
+        @type data: string
+        """
+        self.names.add(name)
+        # Create directories here, to avoid races between the threads
+        d=os.path.dirname(os.path.join(self.destination, name))
+        if not d in self.directories:
+            if not os.path.isdir(d):
+                helper.recursive_mkdir(d)
+            self.directories.add(d)
+        self.submitted += 1
+        self.queue.put( (name, data) )
+
+    def _run(self):
+        while True:
+            item=self.queue.get()
+            if item is None:
+                return
+            name, data = item
+            try:
+                if not self.cancelled:
+                    self._write(name, data)
+            except Exception, e:
+                with self.lock:
+                    self.errors.append( (name, e) )
+            with self.lock:
+                self.done += 1
+
+    def _write(self, name, data):
+        if isinstance(data, unicode):
+            data=data.encode('utf-8')
+        digest=hashlib.md5(data).hexdigest()
+        filename=os.path.join(self.destination, name)
+        if self.files.get(name) == digest and os.path.exists(filename):
+            with self.lock:
+                self.completed.add(name)
+            return
+        f=open(filename, 'wb')
+        f.write(data)
+        f.close()
+        with self.lock:
+            self.files[name]=digest
+            self.written += 1
+            self.completed.add(name)
+
+    def wait(self, timeout=None):
+        """Wait for the submitted files to be processed.
+
+        @return: True if all submitted files have been processed.
+        """
+        t=time.time()
+        while self.done < self.submitted:
+            if timeout is not None and time.time() - t >= timeout:
+                return False
+            time.sleep(.02)
+        return True
+
+    def close(self, cancel=False):
+        """Stop the threads.
+
+        @param cancel: if True, pending files are not written
+        """
+        self.cancelled=cancel
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
 class WebsiteExporter(object):
     """Export a set of static views to a directory.
 
     The intent of this export is to be able to quickly publish a
     comment in the form of a set of static views.
 
+    The views are rendered in the calling thread, and the files are
+    written by a pool of threads (see L{FileWriter}). A manifest
+    stored in the destination directory holds the digests of the
+    written files, and the data of each exported page. If the
+    package and export parameters did not change since the previous
+    (even interrupted) export, already exported pages are not
+    rendered again.
+
     @param destination: the destination directory
     @type destination: path
     @param views: the list of views to export
     @param max_depth: maximum recursion depth
     @param progress_callback: if defined, the method will be called with a float in 0..1 and a message indicating progress
+    @param workers: the number of threads writing the files
     """
-    def __init__(self, controller, destination='/tmp/n', views=None, max_depth=3, progress_callback=None, video_url=None):
+    # Manifest file, in the destination directory
+    manifest_name='.advene-export-manifest.json'
+    manifest_version=1
+
+    def __init__(self, controller, destination='/tmp/n', views=None, max_depth=3, progress_callback=None, video_url=None, workers=4):
         self.controller=controller
+        self.workers=workers
+        self.writer=None
 
         # Directory creation/checks
         self.destination=destination
@@ -159,10 +299,17 @@ class WebsiteExporter(object):
     def translate_links(self, content, baseurl=None, max_depth_exceeded=False):
         """Translate links from the given content.
 
-        This method updates self.url_translation.
+        This method updates self.url_translation. The translations
+        added for this content are also stored in self.page_translations.
 
         It returns a list of URLs that should be processed in the next stage (depth+1).
         """
+        url_translation=self.url_translation
+        self.page_translations=page_translations={}
+        def translate(url, value):
+            url_translation[url]=value
+            page_translations[url]=value
+
         res=set()
         used_snapshots=set()
         used_overlays=set()
@@ -177,13 +324,13 @@ class WebsiteExporter(object):
             original_url=url
 
             if url.startswith('javascript:'):
-                self.url_translation[original_url]=original_url
+                translate(original_url, original_url)
                 continue
 
             m=snapshot_re.search(url)
             # Image translation. Add a .png extension.
             if m:
-                self.url_translation[original_url]="imagecache/%s.png" % m.group(1)
+                translate(original_url, "imagecache/%s.png" % m.group(1))
                 used_snapshots.add(m.group(1))
                 continue
 
@@ -194,11 +341,11 @@ class WebsiteExporter(object):
                 # FIXME: not robust wrt. multiple packages/videos
                 a=self.controller.package.get_element_by_id(ident)
                 if not a:
-                    self.url_translation[original_url]=self.unconverted(url, 'non-existent annotation')
+                    translate(original_url, self.unconverted(url, 'non-existent annotation'))
                     self.log("Cannot find annotation %s for overlaying" % ident)
                     continue
                 name=ident+tales.replace('/', '_')
-                self.url_translation[original_url]='imagecache/overlay_%s.png' % name
+                translate(original_url, 'imagecache/overlay_%s.png' % name)
                 used_overlays.add( (ident, tales) )
                 continue
 
@@ -206,7 +353,7 @@ class WebsiteExporter(object):
 
             if l.startswith('http:'):
                 # It is an external url
-                self.url_translation[url]=url
+                translate(url, url)
                 continue
 
             fragment=None
@@ -218,8 +365,8 @@ class WebsiteExporter(object):
                     # Empty URL: we are addressing ourselves.
                     continue
                 if url in self.url_translation:
-                    self.url_translation[original_url]="%s#%s" % (self.url_translation[url],
-                                                                  fragment)
+                    translate(original_url, "%s#%s" % (self.url_translation[url],
+                                                       fragment))
                     # URL already processed
                     continue
 
@@ -238,7 +385,7 @@ class WebsiteExporter(object):
                 if m:
                     if m.group(1) == 'resources':
                         # We have a resource.
-                        self.url_translation[url]=tales
+                        translate(url, tales)
                         used_resources.add(m.group(2))
                         continue
                     elif m.group(1) in ('view', 'annotations', 'relations',
@@ -289,22 +436,22 @@ class WebsiteExporter(object):
                         res.add(original_url)
                 else:
                     output=tales.replace('/', '_')
-                self.url_translation[url]=output
+                translate(url, output)
                 if fragment:
-                    self.url_translation[original_url]="%s#%s" % (output, fragment)
+                    translate(original_url, "%s#%s" % (output, fragment))
             elif self.video_url and player_re.search(url):
                 m=player_re.search(url)
                 if not 'stbv' in url:
-                    self.url_translation[original_url]=self.video_player.player_url(m.group(2), m.group(4))
+                    translate(original_url, self.video_player.player_url(m.group(2), m.group(4)))
                 else:
-                    self.url_translation[original_url]=self.unconverted(url, 'need advene')
+                    translate(original_url, self.unconverted(url, 'need advene'))
             else:
                 # It is another element.
-                self.url_translation[url]=self.unconverted(url, 'unhandled url')
+                translate(url, self.unconverted(url, 'unhandled url'))
         if max_depth_exceeded:
             # Max depth exceeded: all new links should be marked as unconverted
             for url in res:
-                self.url_translation[url]=self.unconverted(url, 'max depth exceeded')
+                translate(url, self.unconverted(url, 'max depth exceeded'))
             res=set()
         return res, used_snapshots, used_overlays, used_resources
 
@@ -364,21 +511,23 @@ class WebsiteExporter(object):
 
     def write_data(self, url, content, used_snapshots, used_overlays, used_resources):
         """Write the converted content as well as associated data.
+
+        The files are written by self.writer. Associated data is
+        written only once per export.
+
+        @param content: the converted content, or None if it is already written
         """
         # Write the content.
-        output=self.url_translation[url]
-        f=open(os.path.join(self.destination, output), 'w')
-        f.write(content)
-        f.close()
+        if content is not None:
+            self.writer.write(self.url_translation[url], content)
 
         # Copy snapshots
         for t in used_snapshots:
             # FIXME: not robust wrt. multiple packages/videos
-            if not os.path.isdir(self.imgdir):
-                helper.recursive_mkdir(self.imgdir)
-            f=open(os.path.join(self.imgdir, '%s.png' % t), 'wb')
-            f.write(str(self.controller.package.imagecache[t]))
-            f.close()
+            name='imagecache/%s.png' % t
+            if name in self.writer:
+                continue
+            self.writer.write(name, str(self.controller.package.imagecache[t]))
 
         # Copy overlays
         for (ident, tales) in used_overlays:
@@ -387,33 +536,75 @@ class WebsiteExporter(object):
             if not a:
                 print "Cannot find annotation %s for overlaying"
                 continue
-            name=ident+tales.replace('/', '_')
-            if not os.path.isdir(self.imgdir):
-                helper.recursive_mkdir(self.imgdir)
-            f=open(os.path.join(self.imgdir, 'overlay_%s.png' % name), 'wb')
+            name='imagecache/overlay_%s.png' % (ident+tales.replace('/', '_'))
+            if name in self.writer:
+                continue
             if tales:
                 # There is a TALES expression
                 ctx=self.controller.build_context(here=a)
                 data=ctx.evaluateValue('here' + tales)
             else:
                 data=a.content.data
-            f.write(str(self.controller.gui.overlay(self.controller.package.imagecache[a.fragment.begin], data)))
-            f.close()
+            self.writer.write(name, str(self.controller.gui.overlay(self.controller.package.imagecache[a.fragment.begin], data)))
 
         # Copy resources
         for path in used_resources:
-            dest=os.path.join(self.destination, 'resources', path)
-
-            d=os.path.dirname(dest)
-            if not os.path.isdir(d):
-                helper.recursive_mkdir(d)
-
+            name='resources/%s' % path
+            if name in self.writer:
+                continue
             r=self.controller.package.resources
             for element in path.split('/'):
                 r=r[element]
-            output=open(dest, 'wb')
-            output.write(r.data)
-            output.close()
+            self.writer.write(name, r.data)
+
+    def get_fingerprint(self):
+        """Return a fingerprint of the export inputs.
+
+        It covers the package data and the export parameters. Pages
+        from a previous export are reused only if the fingerprint is
+        the same.
+        """
+        h=hashlib.md5()
+        s=StringIO()
+        self.controller.package.serialize(s)
+        h.update(s.getvalue())
+        h.update(repr( (self.max_depth,
+                        self.video_url,
+                        self.controller.get_urlbase(),
+                        self.controller.get_default_media(),
+                        [ v.id for v in self.views ]) ))
+        return h.hexdigest()
+
+    def load_manifest(self):
+        """Load the manifest of the previous export.
+
+        @return: the manifest (an empty one if it does not exist)
+        @rtype: dict
+        """
+        manifest={ 'version': self.manifest_version,
+                   'fingerprint': None,
+                   'files': {},
+                   'pages': {} }
+        if json is None:
+            return manifest
+        try:
+            f=open(os.path.join(self.destination, self.manifest_name), 'rb')
+            try:
+                m=json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return manifest
+        if m.get('version') == self.manifest_version:
+            manifest.update(m)
+        return manifest
+
+    def save_manifest(self, manifest):
+        if json is None:
+            return
+        f=open(os.path.join(self.destination, self.manifest_name), 'wb')
+        json.dump(manifest, f)
+        f.close()
 
     def website_export(self):
         main_step=1.0/self.max_depth
@@ -445,34 +636,95 @@ class WebsiteExporter(object):
 
         links_to_be_processed=view_url.values()
 
-        while depth <= self.max_depth:
-            max_depth_exceeded = (depth == self.max_depth)
-            step=main_step / (len(links_to_be_processed) or 1)
-            if not self.progress_callback(progress, _("Depth %d") % depth):
-                return
-            links=set()
-            for url in links_to_be_processed:
-                if not self.progress_callback(progress, _("Depth %(depth)d: processing %(url)s") % locals()):
+        manifest=self.load_manifest()
+        fingerprint=self.get_fingerprint()
+        if manifest['fingerprint'] == fingerprint:
+            previous_pages=manifest['pages']
+        else:
+            previous_pages={}
+        pages=manifest['pages']={}
+        # Urls of the pages rendered in this export
+        rendered=set()
+        manifest['fingerprint']=fingerprint
+        self.writer=FileWriter(self.destination, manifest['files'], self.workers)
+        completed=False
+        try:
+            while depth <= self.max_depth:
+                max_depth_exceeded = (depth == self.max_depth)
+                # Page rendering is 90% of the export progress.
+                step=main_step * .9 / (len(links_to_be_processed) or 1)
+                if not self.progress_callback(progress, _("Depth %d") % depth):
+                    return
+                links=set()
+                for url in links_to_be_processed:
+                    if not self.progress_callback(progress, _("Depth %(depth)d: processing %(url)s") % locals()):
+                        return
+                    progress += step
+
+                    page=previous_pages.get(url)
+                    if (page is not None
+                        and page['depth'] == depth
+                        and page['output'] in self.writer.files
+                        and os.path.exists(os.path.join(self.destination, page['output']))):
+                        # The page was already exported with the same
+                        # inputs. Reuse its data.
+                        self.url_translation.update(page['translations'])
+                        new_links=set(page['links'])
+                        used_snapshots=set(page['snapshots'])
+                        used_overlays=set(tuple(o) for o in page['overlays'])
+                        used_resources=set(page['resources'])
+                        content=None
+                    else:
+                        content=self.get_contents(url)
+
+                        (new_links,
+                         used_snapshots,
+                         used_overlays,
+                         used_resources)=self.translate_links(content,
+                                                              url,
+                                                              max_depth_exceeded)
+                        page={ 'depth': depth,
+                               'output': self.url_translation[url],
+                               'translations': self.page_translations,
+                               'links': list(new_links),
+                               'snapshots': list(used_snapshots),
+                               'overlays': list(used_overlays),
+                               'resources': list(used_resources) }
+                        content=self.fix_links(content)
+                        rendered.add(url)
+                    pages[url]=page
+                    links.update(new_links)
+
+                    # Write contents
+                    self.write_data(url, content,
+                                    used_snapshots,
+                                    used_overlays,
+                                    used_resources)
+
+                links_to_be_processed=links
+                depth += 1
+
+            # Wait for the files to be written
+            writer=self.writer
+            while not writer.wait(.2):
+                if not self.progress_callback(.91 + .04 * writer.done / (writer.submitted or 1),
+                                              _("Writing files (%(done)d/%(total)d)") % {
+                        'done': writer.done,
+                        'total': writer.submitted }):
                     return
-                progress += step
-                content=self.get_contents(url)
-
-                (new_links,
-                 used_snapshots,
-                 used_overlays,
-                 used_resources)=self.translate_links(content,
-                                                      url,
-                                                      max_depth_exceeded)
-                links.update(new_links)
-
-                # Write contents
-                self.write_data(url, self.fix_links(content),
-                                used_snapshots,
-                                used_overlays,
-                                used_resources)
-
-            links_to_be_processed=links
-            depth += 1
+            completed=True
+        finally:
+            self.writer.close(cancel=not completed)
+            # Do not record the rendered pages whose output was not
+            # written (cancelled export or write error): the previous
+            # version of the file may still be there.
+            for url in rendered:
+                if pages[url]['output'] not in self.writer.completed:
+                    del pages[url]
+            self.save_manifest(manifest)
+            for name, e in self.writer.errors:
+                self.log(_("Cannot write %(name)s: %(error)s") % { 'name': name,
+                                                                   'error': unicode(e) })
 
         if not self.progress_callback(0.95, _("Finalizing")):
             return
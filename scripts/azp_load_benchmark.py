@@ -0,0 +1,91 @@
+#! /usr/bin/python
+#
+# This file is part of Advene.
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""AZP loading benchmark.
+
+It measures the time-to-first-annotation (time needed to open a .azp
+package and access its first annotation) for the demo packages in
+examples/, with the lazy opening of the zip file and with the full
+extraction of its members to a temporary directory, as done before.
+
+If a size (in MB) is given, a copy of the first demo package with a
+media resource of this size is also measured.
+
+Usage: azp_load_benchmark.py [resource_size_mb]
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from advene.model.package import Package
+from advene.model.zippackage import ZipPackage
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples')
+
+lazy_open_archive = ZipPackage.open_archive
+
+def eager_open_archive(self, fname):
+    """Open the archive and extract all its members, as done before.
+    """
+    res = lazy_open_archive(self, fname)
+    self.extract_member(u'')
+    return res
+
+def first_annotation(fname):
+    t = time.time()
+    p = Package(uri=fname)
+    a = p.annotations[0]
+    d = time.time() - t
+    p.close()
+    return d, a.id
+
+def measure(fname, count=5):
+    res = []
+    for method in (eager_open_archive, lazy_open_archive):
+        ZipPackage.open_archive = method
+        res.append(min(first_annotation(fname)[0] for i in xrange(count)))
+    ZipPackage.open_archive = lazy_open_archive
+    eager, lazy = res
+    print "%-40s %8.1f KB  extract %8.1f ms  lazy %8.1f ms  %.1fx" % (
+        os.path.basename(fname), os.path.getsize(fname) / 1024.0,
+        eager * 1000, lazy * 1000, eager / lazy if lazy else 0)
+
+def main(size=0):
+    examples = sorted(glob.glob(os.path.join(EXAMPLES, '*.azp')))
+    for fname in examples:
+        measure(fname)
+    if size and examples:
+        d = tempfile.mkdtemp('', 'adv')
+        try:
+            fname = os.path.join(d, 'large_resource.azp')
+            shutil.copy(examples[0], fname)
+            z = zipfile.ZipFile(fname, 'a', zipfile.ZIP_STORED)
+            z.writestr('resources/movie.ogv', os.urandom(size * 1024 * 1024))
+            z.close()
+            measure(fname, count=2)
+        finally:
+            shutil.rmtree(d, ignore_errors=True)
+
+if __name__ == '__main__':
+    main(*[ int(a) for a in sys.argv[1:2] ])
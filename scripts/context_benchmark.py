@@ -0,0 +1,75 @@
+#! /usr/bin/python
+#
+# This file is part of Advene.
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Micro-benchmark for TALES context creation.
+
+It compares the cost of building an AdveneContext with the method
+table computed for each context (as done before caching) and with the
+cached method table, as done by AdveneController.build_context for
+each event, condition evaluation or web request.
+
+Usage: context_benchmark.py [count]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from advene.model.package import Package
+from advene.model.tal.context import AdveneContext
+import advene.model.tal.global_methods as global_methods
+
+OPTIONS = {
+    u'package_url': u'/packages/advene',
+    u'snapshot': None,
+    u'namespace_prefix': {},
+    u'config': {},
+    u'aliases': {},
+    u'controller': None,
+    }
+
+def uncached_context(here):
+    """Context creation, as implemented before caching.
+    """
+    c = AdveneContext(here, options=OPTIONS, methods={})
+    for name in dir(global_methods):
+        if not name.startswith('_'):
+            c.addMethod(name, global_methods.__dict__[name])
+    return c
+
+def cached_context(here):
+    return AdveneContext(here, options=OPTIONS)
+
+def measure(label, func, here, count):
+    t = time.time()
+    for i in xrange(count):
+        func(here)
+    d = time.time() - t
+    print "%-16s %8.3f s  %8.1f us/context" % (label, d, d * 1e6 / count)
+    return d
+
+def main(count=20000):
+    p = Package(uri='new_pkg', source=None)
+    print "%d contexts, %d default methods" % (count, len(AdveneContext.defaultMethodTable()))
+    before = measure("uncached", uncached_context, p, count)
+    after = measure("cached", cached_context, p, count)
+    print "Speedup: %.1fx" % (before / after if after else 0)
+
+if __name__ == '__main__':
+    main(*[ int(a) for a in sys.argv[1:2] ])
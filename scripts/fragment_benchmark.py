@@ -0,0 +1,92 @@
+#! /usr/bin/python
+#
+# This file is part of Advene.
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Micro-benchmark for fragment attribute access.
+
+It compares the cost of reading the begin/end values of annotation
+fragments through the cached values and directly through the DOM,
+and reports the memory used by each fragment instance.
+
+Usage: fragment_benchmark.py [package_file] [repeat]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from advene.model.package import Package
+from advene.model.fragment import MillisecondFragment
+
+def dom_begin(f):
+    """Uncached access, as implemented before caching.
+    """
+    return long(f._getModel().getAttributeNS(None, 'begin'))
+
+def dom_end(f):
+    return long(f._getModel().getAttributeNS(None, 'end'))
+
+def measure(label, func, fragments, repeat):
+    t = time.time()
+    for i in xrange(repeat):
+        for f in fragments:
+            func(f)
+    d = time.time() - t
+    n = len(fragments) * repeat
+    print "%-24s %8.3f s  %8.1f ns/access" % (label, d, d * 1e9 / n)
+    return d
+
+def instance_size(o):
+    size = sys.getsizeof(o)
+    d = getattr(o, '__dict__', None)
+    if d is not None:
+        size += sys.getsizeof(d)
+    return size
+
+def main(filename=None, repeat=20):
+    if filename is None:
+        p = Package(uri='new_pkg', source=None)
+        s = p.createSchema(ident='s')
+        p.schemas.append(s)
+        at = s.createAnnotationType(ident='at')
+        s.annotationTypes.append(at)
+        for i in xrange(5000):
+            a = p.createAnnotation(type=at,
+                                   ident='a%d' % i,
+                                   fragment=MillisecondFragment(begin=i * 1000, duration=500))
+            p.annotations.append(a)
+    else:
+        p = Package(uri=filename)
+    annotations = list(p.annotations)
+    fragments = [ a.fragment for a in annotations ]
+    print "%d annotations, %d iterations" % (len(annotations), repeat)
+
+    dom = measure("DOM begin+end", lambda f: (dom_begin(f), dom_end(f)), fragments, repeat)
+    cached = measure("cached begin+end", lambda f: (f.begin, f.end), fragments, repeat)
+    measure("cached duration", lambda f: f.duration, fragments, repeat)
+    print "Speedup: %.1fx" % (dom / cached if cached else 0)
+
+    sizes = [ instance_size(f) for f in fragments ]
+    print "Fragment instance size: %d bytes (has __dict__: %s)" % (
+        sum(sizes) / len(sizes) if sizes else 0,
+        hasattr(fragments[0], '__dict__') if fragments else None)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(args[0] if args else None,
+         int(args[1]) if len(args) > 1 else 20)
@@ -0,0 +1,58 @@
+#! /usr/bin/python
+#
+# This file is part of Advene.
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Importer benchmark.
+
+It measures the GenericImporter.convert throughput for a generated
+source of annotations, with the batched creation and with the
+creation of each annotation, as done before.
+
+Usage: import_benchmark.py [count]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from advene.util.importer import GenericImporter
+
+def source(count):
+    for i in xrange(count):
+        yield {
+            'begin': i * 40,
+            'end': i * 40 + 30,
+            'content': 'Annotation %d' % i,
+            }
+
+def measure(label, batch_size, count):
+    i = GenericImporter()
+    i.batch_size = batch_size
+    t = time.time()
+    i.convert(source(count))
+    d = time.time() - t
+    print "%-12s %8d annotations %8.2f s  %8d/s" % (label, len(i.package.annotations), d, count / d if d else 0)
+    return d
+
+def main(count=10000):
+    before = measure("unbatched", 1, count)
+    after = measure("batched", GenericImporter.batch_size, count)
+    print "Speedup: %.1fx" % (before / after if after else 0)
+
+if __name__ == '__main__':
+    main(*[ int(a) for a in sys.argv[1:2] ])
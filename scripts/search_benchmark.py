@@ -0,0 +1,128 @@
+#! /usr/bin/python
+#
+# This file is part of Advene.
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Quicksearch benchmark.
+
+It compares the linear scan of annotation contents with the
+TextIndex lookup, on a generated package, and checks that both
+return the same results.
+
+Usage: search_benchmark.py [annotation_count]
+"""
+import os
+import sys
+import time
+import random
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from advene.model.package import Package
+from advene.util.textindex import TextIndex
+
+WORDS = [ u'vampire', u'castle', u'ship', u'letter', u'rat', u'coffin', u'night',
+          u'Hutter', u'Ellen', u'Knock', u'Orlok', u'plague', u'sun', u'shadow',
+          u'window', u'sea', u'town', u'doctor', u'house', u'dawn' ]
+
+QUERIES = [ u'vampire', u'cas', u'+ship +sea', u'night -sun', u'rat coffin',
+            u'shadow window', u'+Orlok -dawn', u'xyz', u'town house +doctor' ]
+
+def build_package(count):
+    """Generate a package with count annotations.
+
+    The XML source is generated directly, since adding annotations one
+    by one through the model is much slower.
+    """
+    r = random.Random(0)
+    data = StringIO()
+    data.write("""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://experience.univ-lyon1.fr/advene/ns" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<imports/>
+<annotations>""")
+    for i in xrange(count):
+        data.write("""<annotation id="a%d" type="#at"><millisecond-fragment begin="%d" end="%d"/><content mime-type="text/plain">%s</content></annotation>\n""" % (
+            i, i * 1000, i * 1000 + 500,
+            " ".join(r.choice(WORDS) for j in xrange(8)).encode('utf-8')))
+    data.write("""</annotations>
+<queries/>
+<schemas><schema id="s"><annotation-types><annotation-type id="at"><content mime-type="text/plain"/></annotation-type></annotation-types><relation-types/></schema></schemas>
+<views/>
+</package>""")
+    data.seek(0)
+    return Package(uri='benchmark.xml', source=data)
+
+def parse(searched):
+    words = searched.split()
+    mandatory = [ w[1:] for w in words if w.startswith('+') ]
+    exceptions = [ w[1:] for w in words if w.startswith('-') ]
+    normal = [ w for w in words if not w.startswith('+') and not w.startswith('-') ]
+    return mandatory, exceptions, normal
+
+def linear_search(annotations, mandatory, exceptions, normal):
+    """Linear scan, as done before indexing.
+    """
+    data_func = lambda e: e.content.data.lower()
+    sourcedata = annotations
+    for w in mandatory:
+        w = w.lower()
+        sourcedata = [ e for e in sourcedata if w in data_func(e) ]
+    for w in exceptions:
+        w = w.lower()
+        sourcedata = [ e for e in sourcedata if w not in data_func(e) ]
+    if not normal:
+        return list(sourcedata)
+    normal = [ w.lower() for w in normal ]
+    result = []
+    for e in sourcedata:
+        data = data_func(e)
+        for w in normal:
+            if w in data:
+                result.append(e)
+                break
+    return result
+
+def main(count=100000):
+    t = time.time()
+    p = build_package(count)
+    print "%d annotations generated in %.1fs" % (count, time.time() - t)
+    annotations = list(p.annotations)
+
+    index = TextIndex(p)
+    t = time.time()
+    index.check()
+    print "Index built in %.2fs (%d n-grams)" % (time.time() - t, len(index._ngrams))
+
+    total_linear = total_index = 0
+    for q in QUERIES:
+        mandatory, exceptions, normal = parse(q)
+        t = time.time()
+        expected = linear_search(annotations, mandatory, exceptions, normal)
+        linear = time.time() - t
+        t = time.time()
+        found = index.search(annotations, mandatory, exceptions, normal)
+        indexed = time.time() - t
+        total_linear += linear
+        total_index += indexed
+        print "%-22s %7d results  linear %8.1fms  index %8.1fms  %s" % (
+            q, len(found), linear * 1000, indexed * 1000,
+            "OK" if found == expected else "MISMATCH")
+    print "Total: linear %.2fs, index %.2fs, speedup %.1fx" % (
+        total_linear, total_index, total_linear / total_index if total_index else 0)
+
+if __name__ == '__main__':
+    main(*[ int(a) for a in sys.argv[1:2] ])